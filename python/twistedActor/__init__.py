@@ -1,6 +1,15 @@
+from .clock import *
+from .durationStats import *
 from .command import *
+from .cmdCoalescer import *
+from .cmdWindow import *
+from .connPool import *
+from .replyRouter import *
+from .cmdEventBus import *
 from .commandQueue import *
 from .device import *
+from .deviceSupervisor import *
+from .pollScheduler import *
 from .deviceSet import *
 from .baseActor import *
 from .actor import *
@@ -13,6 +13,7 @@ from .linkCommands import LinkCommands
 from .command import CommandError, UserCmd
 from .device import DeviceCollection
 from .log import log
+from .pollScheduler import PollScheduler
 
 __all__ = ["Actor"]
 
@@ -72,6 +73,13 @@ class Actor(BaseActor):
                 self.locCmdDict[cmdVerb] = getattr(self, attrName)
         cmdVerbSet = set(self.locCmdDict.keys())
 
+        # command queues whose metrics are reported by the queueStats command: a dict of name: CommandQueue;
+        # subclasses that use command queues should add them
+        self.cmdQueueDict = dict()
+
+        # shared scheduler for device status polls, created on first use (see pollScheduler)
+        self._pollScheduler = None
+
         self.dev = DeviceCollection(devs) # the short name "dev" allows easy access, e.g. self.dev.dev1Name
 
         # add device-specific commands
@@ -114,6 +122,16 @@ class Actor(BaseActor):
         if doConnect:
             self.initialConn()
 
+    @property
+    def pollScheduler(self):
+        """!Return the shared scheduler for device status polls (a PollScheduler), creating it if needed
+
+        Subclasses should add polls using self.pollScheduler.addPoll; actors that add none do not construct one.
+        """
+        if self._pollScheduler is None:
+            self._pollScheduler = PollScheduler()
+        return self._pollScheduler
+
     def close(self):
         """!Close the connection and cancel any timers
         """
@@ -190,15 +208,9 @@ class Actor(BaseActor):
         if self.commandSet is not None:
             cmd.parsedCommand = self.commandSet.parse(cmd.cmdBody)
 
-        cmd.cmdVerb = ""
-        cmd.cmdArgs = ""
-        if cmd.cmdBody:
-            res = cmd.cmdBody.split(None, 1)
-            if len(res) > 1:
-                cmd.cmdVerb, cmd.cmdArgs = res
-            else:
-                cmd.cmdVerb = res[0]
-            cmd.cmdVerb = cmd.cmdVerb.lower()
+        # UserCmd.parseCmdStr has already split cmdBody into a verb and arguments
+        cmd.cmdVerb = cmd.bodyVerb
+        cmd.cmdArgs = cmd.bodyArgs
 
         # see if command is a local command
         cmdFunc = self.locCmdDict.get(cmd.cmdVerb)
@@ -417,6 +429,59 @@ class Actor(BaseActor):
             raise RuntimeError("Unrecognized argument %r; must be 'on' or 'off'" % (cmd.cmdArgs,))
         self.writeToUsers("i", 'Text="Debugging messages %s"' % (arg,), cmd=cmd)
 
+    def cmd_queueStats(self, cmd):
+        """![reset]: show command queue metrics; if "reset" then reset the metrics after showing them"""
+        arg = cmd.cmdArgs.lower()
+        if arg not in ("", "reset"):
+            raise RuntimeError("Unrecognized argument %r; must be blank or 'reset'" % (cmd.cmdArgs,))
+        for name, cmdQueue in sorted(self.cmdQueueDict.iteritems()):
+            self.showQueueStats(name, cmdQueue, cmd=cmd)
+            if arg == "reset":
+                cmdQueue.resetMetrics()
+
+    def showQueueStats(self, name, cmdQueue, cmd=None):
+        """!Show the metrics for one command queue
+
+        @param[in] name  name of queue
+        @param[in] cmdQueue  the command queue (a CommandQueue)
+        @param[in] cmd  user command (a UserCmd), or None
+        """
+        metrics = cmdQueue.getMetrics()
+        qName = quoteStr(name)
+        ruleCounts = metrics["ruleCounts"]
+        msgStrList = [
+            "queueDepth=%s, %d, %d" % (qName, metrics["depth"], metrics["maxDepth"]),
+            "queueDepthHist=%s, %s" % (qName, ", ".join(str(count) for minDepth, maxDepth, count in metrics["depthHistogram"])),
+            "queueCancels=%s, %d, %d, %d, %d, %d, %d" % (qName,
+                ruleCounts[cmdQueue.CancelNew], ruleCounts[cmdQueue.CancelQueued], ruleCounts[cmdQueue.KillRunning],
+                metrics["numPreempted"], metrics["numShed"], metrics["numExpired"]),
+        ]
+        for cmdVerb, verbStats in sorted(metrics["verbStats"].iteritems()):
+            msgStrList.append("queueVerbStats=%s, %s, %d, %0.3f, %0.3f, %d, %0.3f, %0.3f" % (qName, quoteStr(cmdVerb),
+                verbStats["numStarted"], verbStats["meanWait"], verbStats["maxWait"],
+                verbStats["numRun"], verbStats["meanRun"], verbStats["maxRun"]))
+        for msgStr in msgStrList:
+            self.writeToOneUser("i", msgStr, cmd=cmd)
+
+    def cmd_pollStats(self, cmd):
+        """![reset]: show device status poll metrics; if "reset" then reset the metrics after showing them"""
+        arg = cmd.cmdArgs.lower()
+        if arg not in ("", "reset"):
+            raise RuntimeError("Unrecognized argument %r; must be blank or 'reset'" % (cmd.cmdArgs,))
+        if self._pollScheduler is None:
+            self.writeToOneUser("i", "pollTicks=0, 0", cmd=cmd)
+            return
+        metrics = self._pollScheduler.getMetrics()
+        self.writeToOneUser("i", "pollTicks=%d, %d" % (metrics["numTicks"], metrics["maxPollsPerTick"]), cmd=cmd)
+        for name, pollMetrics in sorted(metrics["polls"].iteritems()):
+            msgStr = "pollStats=%s, %s, %s, %0.3f, %d, %d, %d, %0.3f, %0.3f, %0.3f, %0.3f" % (
+                quoteStr(name), quoteStr(pollMetrics["device"]), pollMetrics["regime"], pollMetrics["interval"],
+                pollMetrics["numSent"], pollMetrics["numSkipped"], pollMetrics["numFailed"],
+                pollMetrics["meanCost"], pollMetrics["maxCost"], pollMetrics["meanJitter"], pollMetrics["maxJitter"])
+            self.writeToOneUser("i", msgStr, cmd=cmd)
+        if arg == "reset":
+            self._pollScheduler.resetMetrics()
+
     def cmd_debugRefCounts(self, cmd):
         """!print the reference count for each object"""
         d = {}
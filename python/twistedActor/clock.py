@@ -0,0 +1,229 @@
+from __future__ import absolute_import, division, print_function
+"""!Clocks that supply the current time and one-shot timers; the default clock uses the twisted reactor
+
+Code that reads the time or starts timers (e.g. CommandQueue and BaseCmd time limits) gets them
+from a clock, so that tests and simulations can substitute a FakeClock, which runs in virtual time:
+nothing happens until you advance the clock, and then timers fire instantly, in order.
+"""
+import heapq
+import itertools
+import time
+
+from RO.Comm.TwistedTimer import Timer
+
+__all__ = ["Clock", "FakeClock", "FakeTimer", "getClock", "setClock"]
+
+class Clock(object):
+    """!The real clock: time.time and twisted reactor timers
+    """
+    def time(self):
+        """!Return the current time (unix seconds)
+        """
+        return time.time()
+
+    def Timer(self, sec=None, callFunc=None, *args, **kwargs):
+        """!Return a one-shot timer (an RO.Comm.TwistedTimer.Timer), started if sec is not None
+        """
+        return Timer(sec, callFunc, *args, **kwargs)
+
+    def __repr__(self):
+        return "%s()" % (type(self).__name__,)
+
+
+class _FakeDelayedCall(object):
+    """!A call scheduled by FakeClock.callLater
+    """
+    __slots__ = ("clock", "time", "func", "args", "kwargs", "called", "cancelled")
+    def __init__(self, clock, time, func, args, kwargs):
+        self.clock = clock
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.called = False
+        self.cancelled = False
+
+    def active(self):
+        return not (self.called or self.cancelled)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.clock._numCancelled += 1
+
+
+class FakeTimer(object):
+    """!A one-shot timer driven by a FakeClock; it has the same interface as RO.Comm.TwistedTimer.Timer
+    """
+    def __init__(self, clock, sec=None, callFunc=None, *args, **kwargs):
+        """!Start or set up a one-shot timer
+
+        @param[in] clock  the FakeClock
+        @param[in] sec  interval, in seconds (float); if None then the timer is not started
+        @param[in] callFunc  function to call when the timer fires
+        @param[in] args  positional arguments for callFunc
+        @param[in] kwargs  keyword arguments for callFunc; must not include "clock", "sec" or "callFunc"
+        """
+        self._clock = clock
+        self._call = None
+        if sec is not None:
+            self.start(sec, callFunc, *args, **kwargs)
+
+    def start(self, sec, callFunc, *args, **kwargs):
+        """!Start or restart the timer, cancelling a pending timer if present; negative sec is treated as 0
+        """
+        self.cancel()
+        self._call = self._clock.callLater(sec, callFunc, *args, **kwargs)
+
+    def cancel(self):
+        """!Cancel the timer; a no-op if the timer is not active
+
+        @return True if the timer was running, False otherwise
+        """
+        if self.isActive:
+            self._call.cancel()
+            return True
+        return False
+
+    @property
+    def isActive(self):
+        """!Return True if the timer is active
+        """
+        return self._call is not None and self._call.active()
+
+
+class FakeClock(object):
+    """!A clock that runs in virtual time, for deterministic tests and fast simulations
+
+    Time stands still until you call advance or run; these fire due timers in order of time
+    (timers due at the same time fire in the order they were started), setting the time
+    to each timer's due time as it fires. Nothing uses the reactor, so a simulation of
+    hours of queued commands runs as fast as the code can execute.
+
+    Typical use:
+
+        clock = FakeClock()
+        setClock(clock) # for BaseCmd time limits; or pass clock=clock to CommandQueue
+        try:
+            ...queue commands...
+            clock.run()
+        finally:
+            setClock(None)
+    """
+    _MinHeapSizeToCompact = 64 # compact the heap of calls when at least this big and mostly cancelled
+
+    def __init__(self, startTime=0.0):
+        """!Construct a FakeClock
+
+        @param[in] startTime  initial virtual time (sec)
+        """
+        self._now = float(startTime)
+        self._heap = [] # heap of (time, sequence number, _FakeDelayedCall)
+        self._seqNumIter = itertools.count()
+        self._numCancelled = 0 # number of cancelled calls still in _heap
+        self.numCalls = 0 # number of timer calls made
+
+    def time(self):
+        """!Return the current virtual time (sec)
+        """
+        return self._now
+
+    def Timer(self, sec=None, callFunc=None, *args, **kwargs):
+        """!Return a one-shot timer (a FakeTimer), started if sec is not None
+        """
+        return FakeTimer(self, sec, callFunc, *args, **kwargs)
+
+    def callLater(self, sec, callFunc, *args, **kwargs):
+        """!Call a function after sec seconds of virtual time; negative sec is treated as 0
+
+        @return a delayed call with methods active and cancel
+        """
+        call = _FakeDelayedCall(self, self._now + max(0.0, float(sec)), callFunc, args, kwargs)
+        heapq.heappush(self._heap, (call.time, next(self._seqNumIter), call))
+        if self._numCancelled > len(self._heap) // 2 and len(self._heap) >= self._MinHeapSizeToCompact:
+            self._heap = [entry for entry in self._heap if entry[2].active()]
+            heapq.heapify(self._heap)
+            self._numCancelled = 0
+        return call
+
+    @property
+    def numPending(self):
+        """!Return the number of pending (active) timers
+        """
+        return len(self._heap) - self._numCancelled
+
+    @property
+    def nextTime(self):
+        """!Return the time at which the next pending timer fires, or None if none are pending
+        """
+        self._discardCancelled()
+        return self._heap[0][0] if self._heap else None
+
+    def advance(self, sec):
+        """!Advance virtual time by sec seconds, firing all timers that come due, in order
+
+        @return the number of timers fired
+        """
+        return self._runUntil(self._now + max(0.0, float(sec)))
+
+    def run(self, maxTime=None):
+        """!Fire timers in order until none are pending
+
+        @param[in] maxTime  if not None then stop when the next timer is due after this time
+            (leaving the virtual time at maxTime); use this for simulations that never go idle,
+            e.g. because they poll
+        @return the number of timers fired
+        """
+        return self._runUntil(maxTime)
+
+    def _runUntil(self, endTime):
+        """!Fire timers in order until none are pending or the next is due after endTime (if not None)
+
+        @return the number of timers fired
+        """
+        numCalls = 0
+        while True:
+            self._discardCancelled()
+            heap = self._heap
+            if not heap or (endTime is not None and heap[0][0] > endTime):
+                break
+            callTime, seqNum, call = heapq.heappop(heap)
+            self._now = max(self._now, callTime)
+            call.called = True
+            numCalls += 1
+            call.func(*call.args, **call.kwargs)
+        if endTime is not None:
+            self._now = max(self._now, endTime)
+        self.numCalls += numCalls
+        return numCalls
+
+    def _discardCancelled(self):
+        """!Pop cancelled calls off the top of the heap
+        """
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._numCancelled -= 1
+
+    def __repr__(self):
+        return "%s(time=%s, numPending=%s)" % (type(self).__name__, self._now, self.numPending)
+
+
+_realClock = Clock()
+_currClock = _realClock
+
+def getClock():
+    """!Return the current default clock: the real clock unless setClock has been called
+    """
+    return _currClock
+
+def setClock(clock=None):
+    """!Set the default clock, used by objects constructed after this call
+
+    @param[in] clock  the new clock (e.g. a FakeClock), or None to restore the real clock
+    @return the previous default clock
+    """
+    global _currClock
+    prevClock = _currClock
+    _currClock = clock if clock is not None else _realClock
+    return prevClock
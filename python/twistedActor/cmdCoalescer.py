@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function
+"""!Coalesce identical idempotent device commands and cache their results
+"""
+from .clock import getClock
+
+__all__ = ["CmdCoalescer"]
+
+class CmdCoalescer(object):
+    """!Coalesce identical idempotent device commands and cache their results
+
+    Use this to avoid swamping a slow device with duplicate queries, e.g. when several users
+    (or scripts) ask for status at nearly the same time. For commands whose verb is listed as idempotent:
+    - If an identical command (same command string) is running, the new command tracks it
+        instead of being sent to the device.
+    - If an identical command succeeded less than cacheTime seconds ago and the new command
+        has no user command, the new command is set done at once, with the cached textMsg and hubMsg.
+        The replies the device output while running the original command are not repeated,
+        so the cache only serves commands no user is waiting on (e.g. polls, whose replies
+        just refresh the device's model); a command started for a user is always coalesced or sent,
+        so the user sees the device's replies.
+
+    Device.startCmd uses this automatically; devices that override startCmd should call attach
+    before sending a new command.
+
+    Attributes for monitoring performance:
+    - numSent: number of idempotent commands that had to be sent to the device
+    - numCoalesced: number of commands that tracked an identical running command
+    - numCacheHits: number of commands that were satisfied from the cache
+    """
+    def __init__(self, verbs=(), cacheTime=0):
+        """!Construct a CmdCoalescer
+
+        @param[in] verbs  a collection of idempotent command verbs (case is ignored)
+        @param[in] cacheTime  time (sec) for which the result of a successful command is cached;
+            if 0 or None then results are not cached (but running commands are still coalesced)
+        """
+        self.verbs = frozenset(verb.lower() for verb in verbs)
+        self.cacheTime = float(cacheTime) if cacheTime else 0
+        self._runningCmdDict = dict() # dict of cmdStr: running command
+        self._resultDict = dict() # dict of cmdStr: (time finished, textMsg, hubMsg)
+        self._clock = getClock()
+        self.numSent = 0
+        self.numCoalesced = 0
+        self.numCacheHits = 0
+
+    def isIdempotent(self, cmdStr):
+        """!Return True if the command verb of cmdStr is idempotent
+        """
+        cmdVerb = cmdStr.split(None, 1)[0].lower() if cmdStr.strip() else ""
+        return cmdVerb in self.verbs
+
+    def attach(self, devCmd):
+        """!Satisfy a new command from an identical running command or the cache, if possible
+
+        @param[in] devCmd  new device command (a BaseCmd), not yet sent to the device
+        @return True if devCmd has been handled (it must not be sent);
+            False if devCmd must be sent to the device as usual
+        """
+        cmdStr = devCmd.cmdStr
+        if not self.isIdempotent(cmdStr):
+            return False
+
+        cachedResult = self._resultDict.get(cmdStr)
+        if cachedResult is not None and getattr(devCmd, "userCmd", None) is None:
+            doneTime, textMsg, hubMsg = cachedResult
+            if self._clock.time() - doneTime <= self.cacheTime:
+                self.numCacheHits += 1
+                devCmd.setState(devCmd.Done, textMsg=textMsg, hubMsg=hubMsg)
+                return True
+            del self._resultDict[cmdStr]
+
+        runningCmd = self._runningCmdDict.get(cmdStr)
+        if runningCmd is not None:
+            self.numCoalesced += 1
+            devCmd.trackCmd(runningCmd)
+            return True
+
+        self.numSent += 1
+        self._runningCmdDict[cmdStr] = devCmd
+        devCmd.addCallback(self._cmdCallback)
+        return False
+
+    def clear(self):
+        """!Clear the cache and forget about running commands
+
+        Call this when the device is disconnected or initialized.
+        """
+        for runningCmd in self._runningCmdDict.itervalues():
+            runningCmd.removeCallback(self._cmdCallback, doRaise=False)
+        self._runningCmdDict = dict()
+        self._resultDict = dict()
+
+    def _cmdCallback(self, devCmd):
+        """!Callback for commands sent to the device
+        """
+        if not devCmd.isDone:
+            return
+        cmdStr = devCmd.cmdStr
+        if self._runningCmdDict.get(cmdStr) is devCmd:
+            del self._runningCmdDict[cmdStr]
+        if self.cacheTime and not devCmd.didFail:
+            self._resultDict[cmdStr] = (self._clock.time(), devCmd.textMsg, devCmd.hubMsg)
+
+    def __repr__(self):
+        return "%s(verbs=%s, cacheTime=%s)" % (type(self).__name__, sorted(self.verbs), self.cacheTime)
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+"""!A process-wide bus that reports command state changes to subscribers in batches
+"""
+import collections
+import time
+
+import RO.AddCallback
+from RO.Comm.TwistedTimer import Timer
+
+__all__ = ["CmdEvent", "CmdEventBus", "cmdEventBus"]
+
+class CmdEvent(collections.namedtuple("CmdEvent", ["cmd", "state", "textMsg", "hubMsg", "time"])):
+    """!A command state change, as reported by CmdEventBus
+
+    Fields:
+    - cmd: the command (a BaseCmd)
+    - state: the new state of the command
+    - textMsg: the command's textMsg just after the state changed
+    - hubMsg: the command's hubMsg just after the state changed
+    - time: the time at which the state changed (unix seconds)
+    """
+    __slots__ = ()
+
+
+class _Subscriber(object):
+    """!A subscriber to CmdEventBus: a function and optional filters
+    """
+    def __init__(self, callFunc, verbs, devs, userIDs):
+        self.callFunc = callFunc
+        self.verbs = frozenset(verb.lower() for verb in verbs) if verbs is not None else None
+        self.devs = frozenset(devs) if devs is not None else None
+        self.userIDs = frozenset(userIDs) if userIDs is not None else None
+
+    def wants(self, cmd):
+        """!Return True if this subscriber wants events for this command
+        """
+        if self.verbs is not None and getattr(cmd, "cmdVerb", "").lower() not in self.verbs:
+            return False
+        if self.devs is not None and getattr(cmd, "dev", None) not in self.devs:
+            return False
+        if self.userIDs is not None and cmd.userID not in self.userIDs:
+            return False
+        return True
+
+
+class CmdEventBus(object):
+    """!Report command state changes to subscribers in batches
+
+    BaseCmd.setState publishes each state change to the process-wide instance cmdEventBus.
+    Subscribers receive the events that match their filters in one batch per reactor iteration,
+    in the order the state changes occurred. This is much cheaper than adding a callback
+    to every command of interest, and costs almost nothing when there are no subscribers.
+
+    Commands that are not wanted by any subscriber are still recorded (filtering happens on delivery),
+    so the cost of publishing does not depend on the number of subscribers.
+    """
+    def __init__(self):
+        self._subscriberList = []
+        self._eventList = []
+        self._flushTimer = Timer()
+        self.isActive = False # True if there are subscribers; read by BaseCmd.setState
+
+    def subscribe(self, callFunc, verbs=None, devs=None, userIDs=None):
+        """!Subscribe to command state changes
+
+        @param[in] callFunc  function to call with a batch of events;
+            it receives one argument: a list of CmdEvent, in the order they occurred
+        @param[in] verbs  a collection of command verbs (case is ignored), or None for all;
+            the verb is read from the command's cmdVerb attribute
+        @param[in] devs  a collection of devices, or None for all; the device is read from the command's dev attribute
+        @param[in] userIDs  a collection of user IDs, or None for all
+
+        If callFunc is already subscribed then its filters are replaced.
+        """
+        if not callable(callFunc):
+            raise RuntimeError("callFunc=%r is not callable" % (callFunc,))
+        self.unsubscribe(callFunc)
+        self._subscriberList.append(_Subscriber(callFunc, verbs=verbs, devs=devs, userIDs=userIDs))
+        self.isActive = True
+
+    def unsubscribe(self, callFunc):
+        """!Unsubscribe a function; a no-op if it is not subscribed
+
+        @return True if callFunc was subscribed, False otherwise
+        """
+        numSubscribers = len(self._subscriberList)
+        self._subscriberList = [sub for sub in self._subscriberList if sub.callFunc != callFunc]
+        self.isActive = bool(self._subscriberList)
+        if not self.isActive:
+            self._eventList = []
+            self._flushTimer.cancel()
+        return len(self._subscriberList) != numSubscribers
+
+    def publish(self, cmd):
+        """!Record a state change of a command; called by BaseCmd.setState
+
+        @param[in] cmd  command whose state has changed
+        """
+        if not self.isActive:
+            return
+        self._eventList.append(CmdEvent(cmd, cmd.state, cmd.textMsg, cmd.hubMsg, time.time()))
+        if not self._flushTimer.isActive:
+            self._flushTimer.start(0, self.flush)
+
+    def flush(self):
+        """!Deliver all recorded events to subscribers now
+        """
+        self._flushTimer.cancel()
+        eventList, self._eventList = self._eventList, []
+        if not eventList:
+            return
+        for sub in self._subscriberList[:]:
+            if sub.verbs is None and sub.devs is None and sub.userIDs is None:
+                subEventList = eventList
+            else:
+                subEventList = [event for event in eventList if sub.wants(event.cmd)]
+            if subEventList:
+                RO.AddCallback.safeCall2("%s.flush" % (self,), sub.callFunc, subEventList)
+
+    def __repr__(self):
+        return "%s(numSubscribers=%s)" % (type(self).__name__, len(self._subscriberList))
+
+
+cmdEventBus = CmdEventBus()
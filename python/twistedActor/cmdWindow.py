@@ -0,0 +1,137 @@
+from __future__ import absolute_import, division, print_function
+"""!Limit the number of device commands outstanding at once, queueing the excess
+"""
+import collections
+
+__all__ = ["CmdWindow"]
+
+class CmdWindow(object):
+    """!Send device commands to a device that can work on several commands at once, up to a limit
+
+    Commands are written to the device at once if fewer than maxOutstanding commands are outstanding
+    (written and not done); otherwise they wait in a local queue and are written in the order received,
+    as outstanding commands finish. The window does not look commands up by command ID;
+    use Device.findCmd for that (writeFunc is normally Device.writeCmd, which registers each command).
+
+    send sets each command running, so a command's time limit starts when it is sent to the window
+    and includes time spent in the local queue. A command that times out (or is otherwise finished)
+    while queued is never written; one that times out while outstanding frees its place in the window,
+    even though the device may still be working on it.
+
+    PipelinedTCPDevice uses this; other devices may use it by calling send instead of writing commands directly.
+
+    Attributes for monitoring performance:
+    - numSent: number of commands written to the device
+    - numDeferred: number of commands that had to wait in the local queue
+    - maxNumQueued: maximum number of commands waiting in the local queue
+    """
+    def __init__(self, writeFunc, maxOutstanding=1):
+        """!Construct a CmdWindow
+
+        @param[in] writeFunc  function that writes a command to the device; receives one argument: the device command.
+            If writing fails it should set the command's state to Failed.
+        @param[in] maxOutstanding  maximum number of commands that may be outstanding at once
+        """
+        if not callable(writeFunc):
+            raise RuntimeError("writeFunc=%r is not callable" % (writeFunc,))
+        if maxOutstanding < 1:
+            raise RuntimeError("maxOutstanding=%r must be >= 1" % (maxOutstanding,))
+        self.writeFunc = writeFunc
+        self.maxOutstanding = int(maxOutstanding)
+        self._outstandingCmdSet = set() # outstanding device commands
+        self._queuedCmdDict = collections.OrderedDict() # dict of device command: None, in the order queued
+        self._inFill = False # True while _fill is running
+        self._fillAgain = False # set if _fill is called while it is running
+        self.numSent = 0
+        self.numDeferred = 0
+        self.maxNumQueued = 0
+
+    @property
+    def numOutstanding(self):
+        """!Return the number of outstanding commands: commands written to the device that are not done
+        """
+        return len(self._outstandingCmdSet)
+
+    @property
+    def numQueued(self):
+        """!Return the number of commands waiting to be written to the device
+        """
+        return len(self._queuedCmdDict)
+
+    def send(self, devCmd):
+        """!Write a device command to the device now, if the window has room, else queue it
+
+        @param[in] devCmd  device command (a BaseCmd); if it is Ready it is set Running
+        """
+        if devCmd.isDone:
+            return
+        if devCmd.state == devCmd.Ready:
+            devCmd.setState(devCmd.Running)
+            if devCmd.isDone:
+                return
+        devCmd.addCallback(self._cmdCallback)
+        if self._queuedCmdDict or len(self._outstandingCmdSet) >= self.maxOutstanding:
+            self._queuedCmdDict[devCmd] = None
+            self.numDeferred += 1
+            self.maxNumQueued = max(self.maxNumQueued, len(self._queuedCmdDict))
+        else:
+            self._write(devCmd)
+
+    def clear(self, textMsg="cleared"):
+        """!Fail all outstanding and queued commands
+
+        Call this when the connection to the device is lost: the device will not reply
+        to outstanding commands, and queued commands cannot be written.
+
+        @param[in] textMsg  reason the commands failed
+        """
+        cmdList = list(self._outstandingCmdSet) + list(self._queuedCmdDict)
+        self._outstandingCmdSet = set()
+        self._queuedCmdDict.clear()
+        for devCmd in cmdList:
+            devCmd.removeCallback(self._cmdCallback, doRaise=False)
+        for devCmd in cmdList:
+            if not devCmd.isDone:
+                devCmd.setState(devCmd.Failed, textMsg=textMsg)
+
+    def _write(self, devCmd):
+        """!Write a command to the device and record it as outstanding
+        """
+        self._outstandingCmdSet.add(devCmd)
+        self.numSent += 1
+        self.writeFunc(devCmd)
+
+    def _fill(self):
+        """!Write queued commands until the window is full or the queue is empty
+
+        This is re-entrant: if called while running (e.g. because a command finished as soon as it was written)
+        then it runs again once the current pass is finished, rather than recursively.
+        """
+        if self._inFill:
+            self._fillAgain = True
+            return
+        self._inFill = True
+        try:
+            self._fillAgain = True
+            while self._fillAgain:
+                self._fillAgain = False
+                while self._queuedCmdDict and len(self._outstandingCmdSet) < self.maxOutstanding:
+                    devCmd = self._queuedCmdDict.popitem(last=False)[0]
+                    self._write(devCmd)
+        finally:
+            self._inFill = False
+
+    def _cmdCallback(self, devCmd):
+        """!Callback for commands sent to the window
+        """
+        if not devCmd.isDone:
+            return
+        if devCmd in self._outstandingCmdSet:
+            self._outstandingCmdSet.remove(devCmd)
+            self._fill()
+        else:
+            self._queuedCmdDict.pop(devCmd, None)
+
+    def __repr__(self):
+        return "%s(maxOutstanding=%s, numOutstanding=%s, numQueued=%s)" % \
+            (type(self).__name__, self.maxOutstanding, self.numOutstanding, self.numQueued)
@@ -1,17 +1,24 @@
 from __future__ import absolute_import, division, print_function
 """Command objects for the twisted actor
 """
+import collections
 import re
 import sys
 
+from twisted.internet.defer import Deferred
 import RO.AddCallback
 import RO.Alg
 from RO.StringUtil import quoteStr
-from RO.Comm.TwistedTimer import Timer
 
+from .clock import getClock
+from .cmdEventBus import cmdEventBus
 from .log import log
 
-__all__ = ["CommandError", "BaseCmd", "DevCmd", "DevCmdVar", "UserCmd", "expandUserCmd"]
+__all__ = ["CommandError", "BaseCmd", "DevCmd", "DevCmdVar", "UserCmd", "expandUserCmd",
+    "parseCmdHeader", "parseCmdHeaderList", "callAfterCmdCallbacks"]
+
+_DigitSet = frozenset("0123456789")
+_BodyStartChars = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
 
 class CommandError(Exception):
     """Raise for a "normal" command failure
@@ -22,6 +29,62 @@ class CommandError(Exception):
     pass
 
 
+class _CmdCallbackRunner(object):
+    """Run functions once no command is executing its callbacks; see callAfterCmdCallbacks
+    """
+    def __init__(self):
+        self.depth = 0 # number of nested BaseCmd.setState calls that are running callbacks
+        self.pendingCalls = collections.deque()
+        self.isDraining = False
+
+    def call(self, func, args, kwargs):
+        if self.depth or self.isDraining:
+            self.pendingCalls.append((func, args, kwargs))
+        else:
+            func(*args, **kwargs)
+
+    def drain(self):
+        """Call all pending functions, including any added while draining
+        """
+        if self.isDraining:
+            return
+        self.isDraining = True
+        try:
+            while self.pendingCalls:
+                func, args, kwargs = self.pendingCalls.popleft()
+                RO.AddCallback.safeCall2("callAfterCmdCallbacks", func, *args, **kwargs)
+        finally:
+            self.isDraining = False
+
+_cmdCallbackRunner = _CmdCallbackRunner()
+
+class _LazyStr(object):
+    """Format an object as a string only when str is called on this wrapper
+    """
+    __slots__ = ("obj",)
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return str(self.obj)
+
+def callAfterCmdCallbacks(func, *args, **kwargs):
+    """Call a function as soon as no command is executing its callbacks
+
+    If no command callbacks are running then func is called at once, synchronously, so the stack
+    is not unwound. Otherwise it is called just after the outermost BaseCmd.setState finishes,
+    in the order the calls were requested; when called from a command callback this unwinds the stack,
+    as Timer(0, func, ...) does, but without waiting for the next reactor iteration.
+    Thus use this in command callbacks; use Timer(0, func, ...) in other callbacks (e.g. connection
+    state callbacks) that must not run func in their caller's context.
+    Exceptions raised by a postponed function are printed (with a traceback) and otherwise ignored.
+
+    @param[in] func  function to call
+    @param[in] args, kwargs  arguments for func
+    """
+    _cmdCallbackRunner.call(func, args, kwargs)
+
+
 class BaseCmd(RO.AddCallback.BaseMixin):
     """Base class for commands of all types (user and device).
     """
@@ -49,6 +112,9 @@ class BaseCmd(RO.AddCallback.BaseMixin):
         done = ":",
     )
     _InvMsgCodeDict = dict((val, key) for key, val in _MsgCodeDict.iteritems())
+    # if True then setState logs each state change at level info (if the logger records info messages);
+    # set False to save time in simulations that run many commands
+    LogStateChanges = True
     def __init__(self,
         cmdStr,
         userID = 0,
@@ -73,12 +139,15 @@ class BaseCmd(RO.AddCallback.BaseMixin):
         self._hubMsg = ""
         self._cmdToTrack = None
         self._linkedCommands = []
+        self._pendingLinkedCmds = set() # linked commands that are not yet done
+        self._numFailedLinkedCmds = 0 # number of linked commands that failed
         self._parentCmd = None
+        self._eldestParentCmd = self # cached root of the linked-command tree; see setParentCmd
         self._writeToUsers = None # set by baseActor.ExpandCommand
         # set by baseActor.newCmd to flag this as a command created
         # from socket input
         self.userCommanded = False
-        self._timeoutTimer = Timer()
+        self._timeoutTimer = getClock().Timer()
         self.setTimeLimit(timeLim)
 
         RO.AddCallback.BaseMixin.__init__(self, callFunc)
@@ -89,10 +158,12 @@ class BaseCmd(RO.AddCallback.BaseMixin):
 
     @property
     def eldestParentCmd(self):
-        if self.parentCmd is None:
-            return self
-        else:
-            return self.parentCmd.eldestParentCmd
+        """The root of the tree of linked commands (self if this command has no parent)
+
+        The value is cached and updated by setParentCmd, so reading it is cheap
+        regardless of how deeply commands are linked.
+        """
+        return self._eldestParentCmd
 
     @property
     def timeLim(self):
@@ -182,6 +253,26 @@ class BaseCmd(RO.AddCallback.BaseMixin):
         else:
             RO.AddCallback.BaseMixin.addCallback(self, callFunc, callNow=callNow)
 
+    def getDeferred(self):
+        """Get a Deferred that fires when this command is done
+
+        The Deferred's callback is called with one argument: this command,
+        whether the command succeeded or failed (check didFail).
+        It is called after the command's callbacks have run (see callAfterCmdCallbacks),
+        so code waiting on the Deferred never runs in the middle of a state change.
+        This is convenient for use with twisted.internet.defer.inlineCallbacks, e.g.:
+            cmd = yield dev.startCmd("foo").getDeferred()
+            if cmd.didFail: ...
+
+        @return a new Deferred for each call
+        """
+        deferred = Deferred()
+        def doneCallback(cmd):
+            if cmd.isDone:
+                callAfterCmdCallbacks(deferred.callback, cmd)
+        self.addCallback(doneCallback)
+        return deferred
+
     def getMsg(self):
         """Get minimal message in simple format, prefering _textMsg
 
@@ -236,12 +327,40 @@ class BaseCmd(RO.AddCallback.BaseMixin):
             self._textMsg = str(textMsg)
         if hubMsg is not None:
             self._hubMsg = str(hubMsg)
-        log.info(str(self))
-        self._basicDoCallbacks(self)
-        if self.isDone:
-            self._timeoutTimer.cancel()
-            self._removeAllCallbacks()
-            self.untrackCmd()
+        if self.LogStateChanges and log.logsInfo:
+            log.info(str(self))
+        if cmdEventBus.isActive:
+            cmdEventBus.publish(self)
+        _cmdCallbackRunner.depth += 1
+        try:
+            self._runCmdCallbacks()
+            if self.isDone:
+                self._timeoutTimer.cancel()
+                self._removeAllCallbacks()
+                self.untrackCmd()
+        finally:
+            _cmdCallbackRunner.depth -= 1
+        if not _cmdCallbackRunner.depth:
+            _cmdCallbackRunner.drain()
+
+    def _runCmdCallbacks(self):
+        """Call each callback function with this command as its sole argument
+
+        If callbacks are already being called (setState was called from a callback)
+        or callbacks are disabled then this is a no-op.
+        The description passed to RO.AddCallback.safeCall2 is a _LazyStr, so this command
+        is only formatted as a string if a callback fails, rather than once per callback.
+        """
+        if not self._enableCallbacks:
+            return
+
+        descr = _LazyStr(self)
+        self._enableCallbacks = False
+        try:
+            for func in self._callbacks[:]:
+                RO.AddCallback.safeCall2(descr, func, self)
+        finally:
+            self._enableCallbacks = True
 
     def setTimeLimit(self, timeLim):
         """Set a new time limit
@@ -292,9 +411,24 @@ class BaseCmd(RO.AddCallback.BaseMixin):
         for cmd in self._linkedCommands:
             cmd.removeCallback(self.linkCmdCallback)
         self._linkedCommands = []
+        self._pendingLinkedCmds = set()
+        self._numFailedLinkedCmds = 0
 
     def setParentCmd(self, cmd):
+        """Set the parent command and update the cached eldest parent of this command and its descendants
+
+        @param[in] cmd  parent command (a BaseCmd), or None if none
+        """
         self._parentCmd = cmd
+        eldestParentCmd = self if cmd is None else cmd._eldestParentCmd
+        # walk the sub-tree iteratively, so very deep chains cannot exceed the recursion limit
+        cmdStack = [self]
+        while cmdStack:
+            subCmd = cmdStack.pop()
+            if subCmd._eldestParentCmd is eldestParentCmd:
+                continue
+            subCmd._eldestParentCmd = eldestParentCmd
+            cmdStack.extend(subCmd._linkedCommands)
 
     def linkCommands(self, cmdList):
         """Tie the state of this command to a list of commands
@@ -306,34 +440,52 @@ class BaseCmd(RO.AddCallback.BaseMixin):
         if self._cmdToTrack:
             raise RuntimeError("Already tracking a command")
         self._linkedCommands.extend(cmdList)
+        anyActive = False
         for cmd in cmdList:
             cmd.setParentCmd(self)
-            if not cmd.isDone:
+            if cmd.isDone:
+                if cmd.didFail:
+                    self._numFailedLinkedCmds += 1
+            elif cmd not in self._pendingLinkedCmds:
+                anyActive = anyActive or cmd.isActive
+                self._pendingLinkedCmds.add(cmd)
                 cmd.addCallback(self.linkCmdCallback)
+        if anyActive and self.state == self.Ready:
+            self.setState(self.Running)
         # call right away in case all sub-commands are already done
         self.linkCmdCallback()
 
-    def linkCmdCallback(self, dumCmd=None):
-        """!Callback to be added to each device cmd
+    def linkCmdCallback(self, linkedCmd=None):
+        """!Callback to be added to each linked command
 
-        @param[in] dumCmd  sub-command issuing the callback (ignored)
-        """
-        # if any linked commands have become active and this command is not yet active
-        # set it cto the running state!
-        if self.state == self.Ready and True in [linkedCommand.isActive for linkedCommand in self._linkedCommands]:
-            self.setState(self.Running)
+        Only the linked command that changed state is examined, so a command with N linked commands
+        does O(N) work in total to finish, rather than O(N) work per linked command callback.
 
-        if not all(linkedCommand.isDone for linkedCommand in self._linkedCommands):
-            # not all device commands have terminated so keep waiting
+        @param[in] linkedCmd  linked command issuing the callback,
+            or None to simply check whether all linked commands are done
+        """
+        if linkedCmd is not None:
+            if linkedCmd.isDone:
+                if linkedCmd not in self._pendingLinkedCmds:
+                    return
+                self._pendingLinkedCmds.discard(linkedCmd)
+                if linkedCmd.didFail:
+                    self._numFailedLinkedCmds += 1
+            elif linkedCmd.isActive and self.state == self.Ready:
+                # a linked command has become active and this command is not yet active
+                self.setState(self.Running)
+
+        if self._pendingLinkedCmds:
+            # not all linked commands have terminated so keep waiting
             return
 
-        failedCmdSummary = "; ".join("%s: %s" % (linkedCommand.cmdStr, linkedCommand.getMsg()) for linkedCommand in self._linkedCommands if linkedCommand.didFail)
-        if failedCmdSummary:
+        if self._numFailedLinkedCmds:
             # at least one device command failed, fail the user command and say why
             # note, do we want to match the type of failure? If a subcommand was cancelled
             # should the mainCmd state be cancelled too?
             state = self.Failed
-            textMsg = failedCmdSummary
+            textMsg = "; ".join("%s: %s" % (linkedCommand.cmdStr, linkedCommand.getMsg())
+                for linkedCommand in self._linkedCommands if linkedCommand.didFail)
         else:
             # all device commands terminated successfully
             # set user command to done
@@ -396,7 +548,9 @@ class DevCmd(BaseCmd):
     - dev: the value specified in the constructor
     - userCmd: the value specified in the constructor
     - locCmdID: command ID number (assigned when the device command is created);
-        this is the command ID for the command sent to the device
+        this is the command ID for the command sent to the device.
+        If dev has a nextLocCmdID method (as Device does) then the ID comes from it,
+        so each device has its own sequence of IDs; otherwise a process-wide sequence is used.
     - showReplies: the value specified in the constructor
     """
     _LocCmdIDGen = RO.Alg.IDGen(startVal=1, wrapVal=sys.maxint)
@@ -424,8 +578,12 @@ class DevCmd(BaseCmd):
         then
         If callFunc and userCmd are both specified, callFunc is called before userCmd's state is changed.
         """
-        self.locCmdID = self._LocCmdIDGen.next()
+        if hasattr(dev, "nextLocCmdID"):
+            self.locCmdID = dev.nextLocCmdID()
+        else:
+            self.locCmdID = self._LocCmdIDGen.next()
         self.dev = dev
+        self.userCmd = userCmd
         self.showReplies = bool(showReplies)
         BaseCmd.__init__(self,
             cmdStr = cmdStr,
@@ -527,12 +685,86 @@ class DevCmdVar(BaseCmd):
         return descrList
 
 
+def parseCmdHeader(cmdStr):
+    """Parse the header of a user command string in a single pass
+
+    The format is: [cmdID [int] ]verb[ args], where cmdID and int are non-negative integers,
+    and verb starts with a letter or underscore. An empty command (nothing but the header) is allowed.
+    This is equivalent to (but much faster than) matching UserCmd._HeaderBodyRE and then splitting the body.
+
+    @param[in] cmdStr  command string
+    @return a tuple containing:
+    - cmdID: command ID, or 0 if not present
+    - secondID: the optional second integer, or None if not present
+    - cmdBody: command after the header, or "" if none
+    - cmdVerb: first word of cmdBody, in lowercase, or "" if none
+    - cmdArgs: cmdBody after cmdVerb and the whitespace that follows it, or "" if none
+    @throw CommandError if cmdStr cannot be parsed
+    """
+    cmdID = 0
+    secondID = None
+    rest = cmdStr
+    if cmdStr[:1] in _DigitSet:
+        # cmdID, which must be followed by whitespace; str.split does the scanning
+        idStrRest = cmdStr.split(None, 1)
+        idStr = idStrRest[0]
+        if not idStr.isdigit() or len(idStr) == len(cmdStr):
+            raise CommandError("Could not parse command %r" % (cmdStr,))
+        cmdID = int(idStr)
+        if len(idStrRest) == 1:
+            return (cmdID, secondID, "", "", "")
+        rest = idStrRest[1]
+        if rest[0] in _DigitSet:
+            # optional second integer, which must also be followed by whitespace
+            idStrRest = rest.split(None, 1)
+            idStr = idStrRest[0]
+            if not idStr.isdigit() or len(idStr) == len(rest):
+                raise CommandError("Could not parse command %r" % (cmdStr,))
+            secondID = int(idStr)
+            if len(idStrRest) == 1:
+                return (cmdID, secondID, "", "", "")
+            rest = idStrRest[1]
+
+    if not rest or rest == "\n":
+        return (cmdID, secondID, "", "", "")
+    if rest[0] not in _BodyStartChars:
+        raise CommandError("Could not parse command %r" % (cmdStr,))
+    newlineInd = rest.find("\n")
+    if newlineInd >= 0:
+        # the body may not contain a newline, except at the very end (which is stripped)
+        if newlineInd != len(rest) - 1:
+            raise CommandError("Could not parse command %r" % (cmdStr,))
+        rest = rest[:-1]
+    verbArgs = rest.split(None, 1)
+    if len(verbArgs) > 1:
+        return (cmdID, secondID, rest, verbArgs[0].lower(), verbArgs[1])
+    return (cmdID, secondID, rest, verbArgs[0].lower(), "")
+
+def parseCmdHeaderList(cmdStrList):
+    """Parse the headers of a collection of user command strings, e.g. for replaying a log
+
+    @param[in] cmdStrList  a collection of command strings
+    @return a list with one entry per command string: the tuple returned by parseCmdHeader,
+        or None if the command string could not be parsed
+    """
+    resultList = []
+    for cmdStr in cmdStrList:
+        try:
+            resultList.append(parseCmdHeader(cmdStr))
+        except CommandError:
+            resultList.append(None)
+    return resultList
+
+
 class UserCmd(BaseCmd):
     """A command from a user (typically the hub)
 
     Attributes:
     - cmdBody   command after the header
+    - bodyVerb  first word of cmdBody, in lowercase
+    - bodyArgs  cmdBody after bodyVerb and the whitespace that follows it
     """
+    # reference implementation of the header format parsed by parseCmdHeader
     _HeaderBodyRE = re.compile(r"((?P<cmdID>\d+)(?:\s+\d+)?\s+)?((?P<cmdBody>[A-Za-z_].*))?$")
     def __init__(self,
         userID = 0,
@@ -559,20 +791,9 @@ class UserCmd(BaseCmd):
     def parseCmdStr(self, cmdStr):
         """Parse command
 
-        @param[in] cmdStr  command string (see module doc string for format)
+        @param[in] cmdStr  command string (see parseCmdHeader for format)
         """
-        cmdMatch = self._HeaderBodyRE.match(cmdStr)
-        if not cmdMatch:
-            raise CommandError("Could not parse command %r" % cmdStr)
-
-        cmdDict = cmdMatch.groupdict("")
-        cmdIDStr = cmdDict["cmdID"]
-        #self.cmdID = int(cmdIDStr) if cmdIDStr else 0
-        if cmdIDStr:
-            self.cmdID = int(cmdIDStr)
-        else:
-            self.cmdID = 0
-        self.cmdBody = cmdDict.get("cmdBody", "")
+        self.cmdID, secondID, self.cmdBody, self.bodyVerb, self.bodyArgs = parseCmdHeader(cmdStr)
 
 def expandUserCmd(userCmd):
     """!If userCmd is None, make a new one; if userCmd is done, raise RuntimeError
@@ -1,11 +1,16 @@
 from __future__ import absolute_import, division, print_function
 """!Contains objects for managing multiple commands at once.
 """
-from bisect import insort_left
+import collections
+import functools
+import heapq
+import itertools
+import math
+import time
 
-from RO.Comm.TwistedTimer import Timer
-
-from .command import UserCmd
+from .clock import getClock
+from .command import UserCmd, callAfterCmdCallbacks
+from .durationStats import DurationStats
 
 __all__ = ["CommandQueue"]
 
@@ -18,13 +23,19 @@ class QueuedCommand(object):
     Running = "running"
     Cancelling = "cancelling"
     Failing = "failing"
-    def __init__(self, cmd, priority, runFunc):
+    def __init__(self, cmd, priority, runFunc, verbInd=0, seqNum=0, resources=None, deadline=None, queueTime=None):
         """!The type of object queued in the CommandQueue.
 
             @param[in] cmd  a twistedActor BaseCmd with a cmdVerb attribute
             @param[in] priority  an integer, or CommandQueue.Immediate
             @param[in] runFunc  function that runs the command; called once, when the command is ready to run,
                 just after cmd's state is set to cmd.Running; receives one argument: cmd
+            @param[in] verbInd  index of the command verb in the CommandQueue's rule matrix
+            @param[in] seqNum  sequence number: the order in which the command was queued
+            @param[in] resources  a frozenset of the resources the command needs while it runs,
+                or None if the command needs exclusive access
+            @param[in] deadline  time (unix seconds) by which the command should finish, or None if no deadline
+            @param[in] queueTime  time (unix seconds) at which the command was queued; if None then now
         """
         if not hasattr(cmd, 'cmdVerb'):
             raise RuntimeError('QueuedCommand must have a cmdVerb')
@@ -39,6 +50,12 @@ class QueuedCommand(object):
         self.cmd = cmd
         self.priority = priority
         self.runFunc = runFunc
+        self.verbInd = verbInd
+        self.seqNum = seqNum
+        self.resources = resources
+        self.deadline = deadline
+        self.queueTime = queueTime if queueTime is not None else time.time()
+        self.startTime = None # time (unix seconds) at which the command was started
 
     def setState(self, newState, textMsg=None, hubMsg=None):
         """!Set state of command; see twistedActor.BaseCmd.setState for details
@@ -126,13 +143,58 @@ class CommandQueue(object):
     execute them one at a time in order of priority.  Equal priority commands are
     executed in the order received.  Special rules may be defined for handling special cases
     of command collisions.
+
+    If resourceDict is specified then commands that need different resources may run at the same time.
+    For example, status commands (which need no resources) can run while a long move is running.
+    Commands that need a common resource still run one at a time in order of priority:
+    a command waiting for a resource reserves that resource, so lower priority commands cannot overtake it.
+
+    A command queued with queueTimeLim (see addCmd) has a deadline: the time it was queued plus queueTimeLim.
+    The command's own time limit (BaseCmd timeLim) is not used, because it only starts once the command runs.
+    If useDeadlines is true then commands of equal priority run in order of deadline (earliest first;
+    commands with no deadline run last, in the order queued) and a queued command whose deadline passes
+    fails at once, without being run. Whether or not useDeadlines is true,
+    the queue counts how many commands with deadlines met or missed them, in these attributes:
+    - numDeadlineMet: number of commands that succeeded by their deadline
+    - numDeadlineMissed: number of commands that were started but failed or finished after their deadline
+    - numExpired: number of commands that failed without being run because their deadline passed
+
+    If agingDict is specified then the priority of queued commands with the listed verbs rises as they wait,
+    so that low priority commands are not starved by a steady stream of higher priority commands.
+    Immediate commands always run first. Call getWaitTimeStats to see how long commands waited, by priority.
+
+    If maxQueueSize or maxQueueSizeDict is specified then the queue is bounded: when a new command
+    would make the queue too long, shedPolicy determines which command fails:
+    - RejectNew: the new command
+    - DropOldest: the oldest queued command (with the same verb as the new command, if the limit is for that verb)
+    - DropLowest: the command with the lowest priority (the most recently queued of those); this may be the new command
+    Immediate commands are never shed. The number of commands shed is in attribute numShed,
+    and the number shed by command verb is in attribute shedCountDict.
+
+    The queue also keeps these metrics (call getMetrics for all of them at once, and resetMetrics to reset them):
+    - ruleCountDict: a dict of action (CancelNew, CancelQueued or KillRunning): the number of commands
+        cancelled or killed by that rule
+    - numPreempted: the number of queued or running commands cancelled by Immediate commands
+    - maxDepth: the maximum number of queued commands
+    - the depth of the queue seen by each new command (see getDepthHistogram)
+    - wait and run times by command verb (see getVerbStats)
+    Metrics are kept as counts and sums, so keeping them costs very little; nothing is computed until requested.
     """
     Immediate = 'immediate'
     CancelNew = 'cancelnew'
     CancelQueued = 'cancelqueued'
     KillRunning = 'killrunning'
     _AddActions = frozenset((CancelNew, CancelQueued, KillRunning))
-    def __init__(self, priorityDict, killFunc=None):
+    RejectNew = 'rejectnew'
+    DropOldest = 'dropoldest'
+    DropLowest = 'droplowest'
+    _ShedPolicies = frozenset((RejectNew, DropOldest, DropLowest))
+    _MinHeapSizeToCompact = 64 # minimum number of entries in the heap before it is compacted
+    MaxSyncPasses = 100 # maximum number of times runQueue reruns itself before yielding to the reactor
+    MaxWaitTimeSamples = 1000 # maximum number of wait times saved for each priority
+    def __init__(self, priorityDict, killFunc=None, resourceDict=None, maxRunning=None, runWhenDone=True,
+        useDeadlines=False, agingDict=None, maxQueueSize=None, maxQueueSizeDict=None, shedPolicy=RejectNew,
+        clock=None):
         """ This is an object which keeps track of commands and smartly handles
             command collisions based on rules chosen by you.
             @param[in] priorityDict a dictionary keyed by cmdVerb, with integer values or Immediate
@@ -140,23 +202,119 @@ class CommandQueue(object):
                 killed.  Accepts 2 parameters, the command to be canceled, and the command doing the killing.
                 This function must eventually ensure that the running command is canceled safely
                 allowing for the next queued command to go. Or None
+            @param[in] resourceDict  a dictionary keyed by cmdVerb, whose values are collections of the resources
+                (e.g. strings) the command needs while it runs; an empty collection means the command needs no resources.
+                Commands with verbs not in resourceDict need exclusive access: they run alone.
+                If None (the default) then all commands need exclusive access: commands run one at a time.
+            @param[in] maxRunning  maximum number of commands that may run at the same time; None for no limit
+            @param[in] runWhenDone  if True then when a running command finishes the next command is started
+                as soon as the finished command's callbacks have run (see callAfterCmdCallbacks);
+                if False then the next command is started on a zero second timer, as for new commands,
+                which costs at least one reactor iteration between commands
+            @param[in] useDeadlines  if True then order commands of equal priority by deadline
+                and fail queued commands whose deadline has passed; see the class doc string for details
+            @param[in] agingDict  a dictionary keyed by cmdVerb, whose values are (rate, maxPriority), where:
+                - rate is the rate (priority units/second) at which the priority of a queued command rises
+                - maxPriority is the maximum priority to which aging can raise the priority; None for no limit
+                Verbs not in agingDict do not age. May not be used with useDeadlines.
+            @param[in] maxQueueSize  maximum number of queued commands; None for no limit
+            @param[in] maxQueueSizeDict  a dictionary keyed by cmdVerb, whose values are the maximum number
+                of queued commands with that verb; None for no limits
+            @param[in] shedPolicy  which command to fail if a limit is reached: one of RejectNew, DropOldest
+                or DropLowest; see the class doc string for details
+            @param[in] clock  clock that supplies the time and timers (see twistedActor.clock);
+                if None then use the default clock returned by getClock() (normally the real clock)
         """
-        self.cmdQueue = []
+        # queued commands are kept in a heap of entries (-rank, deadline, sequence number, QueuedCommand),
+        # where rank is the priority or infinity for Immediate, so the next command to run is at the top
+        # and commands of equal priority run in the order queued
+        # (or order of deadline, if useDeadlines; otherwise deadline is 0 in the heap entries).
+        # Commands that finish while queued (e.g. are cancelled) are removed from _queuedCmdDict
+        # at once but left in the heap until popped or the heap is compacted.
+        self.clock = clock if clock is not None else getClock()
+        self._heap = []
+        self._queuedCmdDict = collections.OrderedDict() # dict of cmd: QueuedCommand, for commands on the queue that are not done, in the order queued
+        self._seqNumIter = itertools.count()
+        self._bucketDict = {} # dict of verb index: OrderedDict of cmd: QueuedCommand, a subset of _queuedCmdDict
         dumCmd = UserCmd()
         dumCmd.setState(dumCmd.Done)
         dumCmd.cmdVerb = 'dummy'
-        self.currExeCmd = QueuedCommand(dumCmd, 0, lambda cmdVar: None)
+        self.currExeCmd = QueuedCommand(dumCmd, 0, lambda cmdVar: None) # most recently started command
+        self._runningCmdList = [] # commands started by the queue, as QueuedCommand; some may be done
+        if resourceDict is None:
+            self.resourceDict = None
+        else:
+            self.resourceDict = dict((cmdVerb, frozenset(resources)) for cmdVerb, resources in resourceDict.iteritems())
+        self.maxRunning = maxRunning
+        self.runWhenDone = bool(runWhenDone)
+        self._inRunQueue = False # True while runQueue is running
+        self._runQueueAgain = False # set if runQueue is called while it is running
         self.priorityDict = priorityDict
         self.killFunc = killFunc
         self.ruleDict = {}
-        self.queueTimer = Timer()
+        # rules are compiled into a matrix of actions: _ruleMatrix[new verb index][queued verb index];
+        # index 0 is for all verbs that are not in priorityDict; other indices are never reassigned
+        self._verbIndexDict = {}
+        self._ruleMatrix = [[None]]
+        self._interactingVerbInds = [(0,)] # for each new verb index: indices of queued verbs to which a rule applies
+        self._compileRules()
+        self.useDeadlines = bool(useDeadlines)
+        self._deadlineHeap = [] # heap of (deadline, sequence number, QueuedCommand) if useDeadlines; may contain commands that are no longer queued
+        self._deadlineTimer = self.clock.Timer()
+        if agingDict is not None:
+            if useDeadlines:
+                raise RuntimeError("May not specify both agingDict and useDeadlines")
+            for cmdVerb, (rate, maxPriority) in agingDict.iteritems():
+                if self.priorityDict.get(cmdVerb, self.Immediate) == self.Immediate:
+                    raise RuntimeError("Cannot age command %r: it must be in priorityDict and not Immediate" % (cmdVerb,))
+                if rate < 0:
+                    raise RuntimeError("Cannot age command %r: rate=%r < 0" % (cmdVerb, rate))
+            agingDict = dict((cmdVerb, (float(rate), maxPriority)) for cmdVerb, (rate, maxPriority) in agingDict.iteritems())
+        self.agingDict = agingDict
+        self._batchDict = {} # dict of verb index: (batchFunc, maxBatchSize, compatFunc); see addBatchFunc
+        if shedPolicy not in self._ShedPolicies:
+            raise RuntimeError("shedPolicy=%r must be one of %s" % (shedPolicy, sorted(self._ShedPolicies)))
+        if maxQueueSize is not None and maxQueueSize < 1:
+            raise RuntimeError("maxQueueSize=%r must be None or >= 1" % (maxQueueSize,))
+        self.maxQueueSize = maxQueueSize
+        self._maxBucketSizeDict = {} # dict of verb index: maximum number of queued commands with that verb
+        for cmdVerb, maxSize in (maxQueueSizeDict or {}).iteritems():
+            if cmdVerb not in self.priorityDict:
+                raise RuntimeError("Cannot limit queue size for unrecognized command: %s" % (cmdVerb,))
+            if maxSize < 1:
+                raise RuntimeError("Queue size limit %r for command %s must be >= 1" % (maxSize, cmdVerb))
+            self._maxBucketSizeDict[self._getVerbIndex(cmdVerb)] = maxSize
+        self.shedPolicy = shedPolicy
+        self.resetMetrics()
+        self.queueTimer = self.clock.Timer()
         self._enabled = True
 
+    @property
+    def cmdQueue(self):
+        """!A list of the queued commands that are not done, as QueuedCommand, in order of increasing priority
+        (the next command to run is last)
+
+        This list is computed when requested; use len(self) to find out if the queue is empty.
+        """
+        if self.agingDict is not None:
+            currTime = self.clock.time()
+            return sorted(self._queuedCmdDict.itervalues(),
+                key=lambda queuedCmd: (self.getEffectivePriority(queuedCmd, currTime), -queuedCmd.seqNum))
+        return [entry[-1] for entry in sorted(self._heap, reverse=True) if self._isQueued(entry[-1])]
+
+    @property
+    def runningCmds(self):
+        """!A list of the commands started by the queue that are not done, as QueuedCommand, in the order started
+
+        Unless resourceDict was specified this list has at most one element: currExeCmd.
+        """
+        return [queuedCmd for queuedCmd in self._runningCmdList if not queuedCmd.isDone]
+
     def __getitem__(self, ind):
         return self.cmdQueue[ind]
 
     def __len__(self):
-        return len(self.cmdQueue)
+        return len(self._queuedCmdDict)
 
     def addRule(self, action, newCmds="all", queuedCmds="all"):
         """!Add special case rules for collisions.
@@ -183,6 +341,21 @@ class CommandQueue(object):
                 raise RuntimeError('Cannot add rule to unrecognized command: %s' % (cmdName,))
         if action not in self._AddActions:
             raise RuntimeError("Rule action=%r must be one of %s" % (action, sorted(self._AddActions)))
+        oldRuleDict = dict((nc, qcDict.copy()) for nc, qcDict in self.ruleDict.iteritems())
+        try:
+            self._addRule(action=action, newCmds=newCmds, queuedCmds=queuedCmds)
+            self._compileRules()
+        except Exception:
+            self.ruleDict = oldRuleDict
+            raise
+
+    def _addRule(self, action, newCmds, queuedCmds):
+        """!Add a rule to ruleDict; a helper for addRule
+
+        @param[in] action  one of CancelNew, CancelQueued, KillRunning
+        @param[in] newCmds  a list of incoming commands to which this rule applies, or ["all"]
+        @param[in] queuedCmds  a list of the commands (queued or running) to which this rule applies, or ["all"]
+        """
         for nc in newCmds:
             if not nc in self.ruleDict:
                 if nc == 'all':
@@ -227,6 +400,67 @@ class CommandQueue(object):
         If a different rule is present for both 1 and 2, raise a RuntimeError, we have over defined things.
         Else if a rule is defined for either 1 or 2 (or the same rule is present for 1 and 2), use it.
         """
+        newInd = self._getVerbIndex(newCmd)
+        queuedInd = self._getVerbIndex(queuedCmd)
+        return self._getRuleByIndex(newInd, newCmd, queuedInd, queuedCmd)
+
+    def _getVerbIndex(self, cmdVerb):
+        """!Get the index of a command verb in the rule matrix
+
+        Verbs that are not in priorityDict share index 0.
+        """
+        verbInd = self._verbIndexDict.get(cmdVerb)
+        if verbInd is None:
+            if cmdVerb not in self.priorityDict:
+                return 0
+            # priorityDict has been modified since the rules were compiled
+            self._compileRules()
+            verbInd = self._verbIndexDict[cmdVerb]
+        return verbInd
+
+    def _getRuleByIndex(self, newInd, newCmd, queuedInd, queuedCmd):
+        """!Get the rule for a new command vs. a queued command, given the verb indices and verbs
+
+        Identical verbs that are not in priorityDict get CancelQueued (see getRule);
+        they are the only case in which the matrix does not suffice.
+        """
+        if newInd == queuedInd == 0 and newCmd == queuedCmd:
+            return self.CancelQueued
+        return self._ruleMatrix[newInd][queuedInd]
+
+    def _compileRules(self):
+        """!Compile ruleDict into _ruleMatrix and _interactingVerbInds
+
+        Each entry of the matrix is the result of _resolveRule, so precedence of rules involving "all"
+        is resolved here, once, rather than each time a command is queued.
+        Raise RuntimeError if the rules conflict.
+        """
+        for cmdVerb in self.priorityDict:
+            if cmdVerb not in self._verbIndexDict:
+                self._verbIndexDict[cmdVerb] = len(self._verbIndexDict) + 1
+        verbList = [None]*(len(self._verbIndexDict) + 1)
+        for cmdVerb, verbInd in self._verbIndexDict.iteritems():
+            verbList[verbInd] = cmdVerb
+        # unrecognized verbs are represented by objects that match nothing, not even each other
+        verbList[0] = object()
+        otherQueuedVerb = object()
+
+        ruleMatrix = []
+        for newCmd in verbList:
+            ruleMatrix.append([self._resolveRule(newCmd, queuedCmd) for queuedCmd in [otherQueuedVerb] + verbList[1:]])
+        self._ruleMatrix = ruleMatrix
+        self._interactingVerbInds = [
+            tuple(queuedInd for queuedInd, action in enumerate(row) if action is not None) for row in ruleMatrix
+        ]
+        if 0 not in self._interactingVerbInds[0]:
+            # identical unrecognized verbs get CancelQueued
+            self._interactingVerbInds[0] = (0,) + self._interactingVerbInds[0]
+
+    def _resolveRule(self, newCmd, queuedCmd):
+        """!Get the rule for a specific new command vs. a specific queued command by examining ruleDict
+
+        See getRule for details; this is used to compile the rule matrix.
+        """
         if (newCmd in self.ruleDict) and (queuedCmd in self.ruleDict[newCmd]):
             # a command was specifically defined for these two
             # this trumps any rules that may apply to "all"
@@ -252,12 +486,42 @@ class CommandQueue(object):
         else:
             return None
 
-    def addCmd(self, cmd, runFunc):
+    def addBatchFunc(self, cmdVerb, batchFunc, maxBatchSize=None, compatFunc=None):
+        """!Run queued commands with the specified verb in batches
+
+        When a command with this verb is to be started, all compatible queued commands with the same verb
+        are taken off the queue with it and started together: each command's state is set to Running
+        and then batchFunc is called once (instead of each command's runFunc).
+        batchFunc must eventually set each command done, just as runFunc must.
+        The batch runs as a unit: the resources it needs are those of one command with this verb.
+        However, each command in the batch counts toward maxRunning, so a batch is no larger
+        than the number of commands that may start.
+
+        @param[in] cmdVerb  command verb; must be in priorityDict and not have priority Immediate
+        @param[in] batchFunc  function to run a batch of commands; it receives one argument:
+            a list of commands (each a BaseCmd), in the order queued
+        @param[in] maxBatchSize  maximum number of commands in a batch; None for no limit
+        @param[in] compatFunc  function that decides if a queued command may join a batch, or None if all can;
+            it receives two arguments: the first command in the batch and a candidate command (both BaseCmd),
+            and returns True if the candidate command may join the batch
+        """
+        if self.priorityDict.get(cmdVerb, self.Immediate) == self.Immediate:
+            raise RuntimeError("Cannot batch command %r: it must be in priorityDict and not Immediate" % (cmdVerb,))
+        if not callable(batchFunc):
+            raise RuntimeError("batchFunc=%r is not callable" % (batchFunc,))
+        if maxBatchSize is not None and maxBatchSize < 1:
+            raise RuntimeError("maxBatchSize=%r must be None or >= 1" % (maxBatchSize,))
+        self._batchDict[self._getVerbIndex(cmdVerb)] = (batchFunc, maxBatchSize, compatFunc)
+
+    def addCmd(self, cmd, runFunc, queueTimeLim=None):
         """ Add a command to the queue, taking rules and priority into account.
 
             @param[in] cmd  a twistedActor command object
             @param[in] runFunc  function that runs the command; called once, when the command is ready to run,
                 just after cmd's state is set to cmd.Running; receives one argument: cmd
+            @param[in] queueTimeLim  time (sec) from now by which the command should finish, which sets its deadline;
+                None for no deadline. Unlike cmd's time limit, this includes the time the command waits in the queue.
+                See the class doc string for how deadlines are used.
 
             Here's the logic:
             If cmd has an unrecognized priority (not defined in self.priorityDict), assign it a priority of 0
@@ -266,7 +530,8 @@ class CommandQueue(object):
                 - Add the command to the now empty queue
             Else:
                 Look for rules.  You may want to read the documentation for getRule, as there is some logic in the
-                way rules are selected.  First, run through all commands currently on the queue.  If any queued
+                way rules are selected.  First, run through the commands currently on the queue
+                whose verbs have rules with this command's verb (commands with other verbs are not examined).  If any queued
                 command has a rule CancelNew pertaining to this command, then cancel the incoming command and return
                 (it never reaches the queue). If the command wasn't canceled, run through the queue again to determine
                 if this command should cancel any commands on the queue.
@@ -284,75 +549,188 @@ class CommandQueue(object):
         else:
             priority = self.priorityDict[cmd.cmdVerb]
 
+        newInd = self._getVerbIndex(cmd.cmdVerb)
         toQueue = QueuedCommand(
             cmd = cmd,
             priority = priority,
             runFunc = runFunc,
+            verbInd = newInd,
+            seqNum = next(self._seqNumIter),
+            resources = self.resourceDict.get(cmd.cmdVerb) if self.resourceDict is not None else None,
+            deadline = self.clock.time() + queueTimeLim if queueTimeLim is not None else None,
+            queueTime = self.clock.time(),
         )
         if toQueue.priority == CommandQueue.Immediate:
             # cancel each command in the cmdQueue;
             # iterate over a copy because the queue is updated for each cancelled command,
             # and extract the cmd from the queuedCmd since we don't need the wrapped command
-            cmdList = [queuedCmd.cmd for queuedCmd in self.cmdQueue]
+            cmdList = list(self._queuedCmdDict)
             for sadCmd in cmdList:
                 if not sadCmd.isDone:
+                    self.numPreempted += 1
                     sadCmd.setState(
                         sadCmd.Cancelled,
                         textMsg = "Cancelled on queue by immediate priority command %r" % (cmd.cmdStr,),
                     )
-            if not self.currExeCmd.cmd.isDone:
-                self.currExeCmd.cmd.setState(
-                    self.currExeCmd.cmd.Cancelled,
-                    textMsg = "Killed by immediate priority command %r" % (cmd.cmdStr,),
-                )
+            for runningCmd in self.runningCmds:
+                if not runningCmd.isDone:
+                    self.numPreempted += 1
+                    runningCmd.setState(
+                        runningCmd.Cancelled,
+                        textMsg = "Killed by immediate priority command %r" % (cmd.cmdStr,),
+                    )
+        elif not self._interactingVerbInds[newInd]:
+            # no rule applies to this command verb, so there is no need to check the queue
+            pass
         else:
-            # check new command against queued commands
-            # iterate over a copy because the queue is updated for each cancelled command,
-            # and extract the cmd from the queuedCmd since we don't need the wrapped command
-            cmdList = [queuedCmd.cmd for queuedCmd in self.cmdQueue]
-            for queuedCmd in cmdList:
-                # first check if toQueue should be cancelled by any existing
-                # command on the queue
-                if queuedCmd.isDone:
-                    # ignore completed commands (not that any on the stack will have been run yet,
-                    # but they can be cancelled elsewhere)
-                    continue
+            # check new command against the queued commands whose verbs have rules with the new verb:
+            # look up the rules for all of them at once, using the row of the rule matrix for the new command;
+            # iterate over a copy because the queue is updated for each cancelled command
+            newCmdVerb = cmd.cmdVerb
+            ruleRow = self._ruleMatrix[newInd]
+            cmdList = self._getQueuedCmdsByVerb(self._interactingVerbInds[newInd])
+            actionList = [ruleRow[queuedCmd.verbInd] for queuedCmd in cmdList]
+            if newInd == 0:
+                # identical unrecognized verbs get CancelQueued
+                for i, queuedCmd in enumerate(cmdList):
+                    if queuedCmd.verbInd == 0 and queuedCmd.cmdVerb == newCmdVerb:
+                        actionList[i] = self.CancelQueued
 
-                action = self.getRule(toQueue.cmd.cmdVerb, queuedCmd.cmdVerb)
-                if action == self.CancelNew:
-                    toQueue.cmd.setState(
-                        toQueue.cmd.Cancelled,
-                        "Cancelled before queueing by queued command %r" % (queuedCmd.cmdStr),
-                    )
-                    return # queue not altered; no need to do anything else
-            for queuedCmd in cmdList:
-                # next check if toQueue should cancel any commands existing on the
-                # queue
-                if queuedCmd.isDone:
-                    # ignore completed commands
-                    continue
-                action = self.getRule(toQueue.cmd.cmdVerb, queuedCmd.cmdVerb)
-                if action in (self.CancelQueued, self.KillRunning):
+            # first check if toQueue should be cancelled by any existing command on the queue
+            # (all commands in cmdList are not done, since nothing has changed yet)
+            if self.CancelNew in actionList:
+                queuedCmd = cmdList[actionList.index(self.CancelNew)]
+                self.ruleCountDict[self.CancelNew] += 1
+                toQueue.cmd.setState(
+                    toQueue.cmd.Cancelled,
+                    "Cancelled before queueing by queued command %r" % (queuedCmd.cmdStr),
+                )
+                return # queue not altered; no need to do anything else
+
+            # next check if toQueue should cancel any commands existing on the queue
+            for queuedCmd, action in zip(cmdList, actionList):
+                if action in (self.CancelQueued, self.KillRunning) and not queuedCmd.isDone:
+                    self.ruleCountDict[action] += 1
                     queuedCmd.setState(
                         queuedCmd.Cancelled,
                         "Cancelled while queued by new command %r" % (toQueue.cmd.cmdStr),
                     )
 
-            # should new command kill currently executing command?
-            if not self.currExeCmd.cmd.isDone:
-                action = self.getRule(toQueue.cmd.cmdVerb, self.currExeCmd.cmd.cmdVerb)
-                if action == self.CancelNew:
-                    toQueue.cmd.setState(
-                        toQueue.cmd.Cancelled,
-                        "Cancelled before queueing by running command %r" % (self.currExeCmd.cmd.cmdStr),
-                    )
-                    return # queue not altered; no need to do anything else
-                if action == self.KillRunning:
-                    self.killFunc(self.currExeCmd.cmd, toQueue.cmd)
+            # should new command kill currently executing commands?
+            runningCmdList = self.runningCmds
+            actionList = [
+                self._getRuleByIndex(newInd, newCmdVerb, runningCmd.verbInd, runningCmd.cmdVerb)
+                for runningCmd in runningCmdList
+            ]
+            if self.CancelNew in actionList:
+                runningCmd = runningCmdList[actionList.index(self.CancelNew)]
+                self.ruleCountDict[self.CancelNew] += 1
+                toQueue.cmd.setState(
+                    toQueue.cmd.Cancelled,
+                    "Cancelled before queueing by running command %r" % (runningCmd.cmd.cmdStr),
+                )
+                return # queue not altered; no need to do anything else
+            for runningCmd, action in zip(runningCmdList, actionList):
+                if action == self.KillRunning and not runningCmd.isDone:
+                    self.ruleCountDict[self.KillRunning] += 1
+                    self.killFunc(runningCmd.cmd, toQueue.cmd)
 
-        insort_left(self.cmdQueue, toQueue) # inserts in sorted order
+        if toQueue.priority != self.Immediate and not self._makeRoom(toQueue):
+            return # the new command was rejected
+
+        depth = len(self._queuedCmdDict)
+        depthHistogram = self._depthHistogram
+        histInd = depth.bit_length()
+        if histInd >= len(depthHistogram):
+            depthHistogram.extend([0] * (1 + histInd - len(depthHistogram)))
+        depthHistogram[histInd] += 1
+        if depth >= self.maxDepth:
+            self.maxDepth = depth + 1
+
+        rank = float("inf") if toQueue.priority == self.Immediate else toQueue.priority
+        if self.useDeadlines:
+            deadlineKey = toQueue.deadline if toQueue.deadline is not None else float("inf")
+        else:
+            deadlineKey = 0
+        if self.agingDict is None:
+            # (if aging, the next command is chosen from the heads of the buckets instead)
+            heapq.heappush(self._heap, (-rank, deadlineKey, toQueue.seqNum, toQueue))
+        self._queuedCmdDict[cmd] = toQueue
+        bucket = self._bucketDict.get(newInd)
+        if bucket is None:
+            bucket = self._bucketDict[newInd] = collections.OrderedDict()
+        bucket[cmd] = toQueue
+        cmd.addCallback(self._queuedCmdCallback)
+        if self.useDeadlines and toQueue.deadline is not None:
+            heapq.heappush(self._deadlineHeap, (toQueue.deadline, toQueue.seqNum, toQueue))
+            if self._deadlineHeap[0][-1] is toQueue:
+                self._deadlineTimer.start(max(0, toQueue.deadline - self.clock.time()), self._expireCmds)
         self.scheduleRunQueue()
 
+    def _makeRoom(self, toQueue):
+        """!Shed queued commands as needed to make room for a new command, according to shedPolicy
+
+        @param[in] toQueue  the new command (a QueuedCommand), not yet on the queue
+        @return True if there is room for the new command, False if the new command was shed instead
+        """
+        maxBucketSize = self._maxBucketSizeDict.get(toQueue.verbInd)
+        if maxBucketSize is not None:
+            bucket = self._bucketDict.get(toQueue.verbInd, ())
+            while len(bucket) >= maxBucketSize:
+                if self.shedPolicy == self.DropOldest:
+                    shedCmd = next(bucket.itervalues())
+                else:
+                    # all commands with this verb have the same priority, so the new command has the lowest priority
+                    shedCmd = toQueue
+                reason = "more than %s queued %s commands" % (maxBucketSize, toQueue.cmdVerb)
+                if not self._shedCmd(shedCmd, toQueue, reason):
+                    return False
+                bucket = self._bucketDict.get(toQueue.verbInd, ())
+
+        if self.maxQueueSize is not None:
+            while len(self._queuedCmdDict) >= self.maxQueueSize:
+                if self.shedPolicy == self.DropOldest:
+                    shedCmd = next((queuedCmd for queuedCmd in self._queuedCmdDict.itervalues()
+                        if queuedCmd.priority != self.Immediate), toQueue)
+                elif self.shedPolicy == self.DropLowest:
+                    # the newest command in each bucket is a candidate (all in a bucket have the same priority);
+                    # of those with the lowest priority, shed the most recently queued (the new command, if it ties)
+                    shedCmd = toQueue
+                    for bucket in self._bucketDict.itervalues():
+                        if not bucket:
+                            continue
+                        newestCmd = bucket[next(reversed(bucket))]
+                        if newestCmd.priority == self.Immediate:
+                            continue
+                        if shedCmd.priority == self.Immediate or newestCmd.priority < shedCmd.priority \
+                            or (newestCmd.priority == shedCmd.priority and newestCmd.seqNum > shedCmd.seqNum):
+                            shedCmd = newestCmd
+                else:
+                    shedCmd = toQueue
+                reason = "more than %s queued commands" % (self.maxQueueSize,)
+                if not self._shedCmd(shedCmd, toQueue, reason):
+                    return False
+        return True
+
+    def _shedCmd(self, shedCmd, toQueue, reason):
+        """!Fail a queued or new command to make room on the queue; a helper for _makeRoom
+
+        @param[in] shedCmd  the command to fail (a QueuedCommand)
+        @param[in] toQueue  the new command (a QueuedCommand)
+        @param[in] reason  reason the queue is full
+        @return False if shedCmd is toQueue, else True
+        """
+        self.numShed += 1
+        self.shedCountDict[shedCmd.cmdVerb] += 1
+        if shedCmd is toQueue:
+            toQueue.setState(toQueue.Failed, textMsg="Rejected: queue is full (%s)" % (reason,))
+            return False
+        shedCmd.setState(
+            shedCmd.Failed,
+            textMsg="Dropped from queue to make room for %r: queue is full (%s)" % (toQueue.cmdStr, reason),
+        )
+        return True
+
     def killAll(self):
         """!Kill all commands without trying to execute any
 
@@ -360,43 +738,416 @@ class CommandQueue(object):
         """
         self._enabled = False
         try:
-            cmdList = [queuedCmd.cmd for queuedCmd in self.cmdQueue]
+            cmdList = list(self._queuedCmdDict)
             for cmd in cmdList:
                 if not cmd.isDone:
                     cmd.setState(cmd.Failed, textMsg="disconnected")
-            self.cmdQueue = []
-            if not self.currExeCmd.cmd.isDone:
-                self.currExeCmd.setState(self.currExeCmd.Failed, textMsg="disconnected")
+            self._heap = []
+            self._queuedCmdDict.clear()
+            self._bucketDict.clear()
+            self._deadlineHeap = []
+            self._deadlineTimer.cancel()
+            for runningCmd in self.runningCmds:
+                if not runningCmd.isDone:
+                    runningCmd.setState(runningCmd.Failed, textMsg="disconnected")
         finally:
             self._enabled = True
 
     def scheduleRunQueue(self, cmd=None):
-        """!Run the queue on a zero second timer
+        """!Run the queue on a zero second timer, or, if a running command has finished and runWhenDone is true,
+        as soon as the command's callbacks have run
 
         @param[in] cmd  command; if provided and not Done then the queue is not run (a BaseCmd);
             this allows use of scheduleRunQueue as a command callback
         """
         if not self._enabled:
             return
-        if cmd and not cmd.isDone:
-            return
+        if cmd:
+            if not cmd.isDone:
+                return
+            if self.runWhenDone:
+                callAfterCmdCallbacks(self.runQueue)
+                return
         self.queueTimer.start(0., self.runQueue)
 
     def runQueue(self):
         """ Manage Executing commands
+
+        Start as many queued commands as possible, in order of priority.
+        A command may start if the resources it needs are not in use, are not needed by a waiting command
+        of higher priority, and the number of running commands is less than maxRunning.
+        A command that needs exclusive access starts only when no command is running,
+        and no lower priority command may start while it is waiting.
+
+        This is re-entrant: if called while running (e.g. because a command finished as soon as it was started)
+        then it runs again once the current pass is finished, rather than recursively.
+        After MaxSyncPasses such passes the rest of the work is postponed to a zero second timer,
+        to give the reactor a chance to handle other events.
         """
         if not self._enabled:
             return
-        # prune the queue, throw out done commands
-        self.cmdQueue = [qc for qc in self.cmdQueue if not qc.cmd.isDone]
-        if len(self.cmdQueue) == 0:
-            # the command queue is empty, nothing to run
-            pass
-        elif self.currExeCmd.cmd.isDone:
-            # begin the next command on the queue
-            self.currExeCmd = self.cmdQueue.pop(-1)
-            self.currExeCmd.setRunning()
-            self.currExeCmd.cmd.addCallback(self.scheduleRunQueue)
+        if self._inRunQueue:
+            self._runQueueAgain = True
+            return
+        self._inRunQueue = True
+        try:
+            for i in range(self.MaxSyncPasses):
+                self._runQueueAgain = False
+                self._startCmds()
+                if not self._runQueueAgain:
+                    return
+            self.queueTimer.start(0., self.runQueue)
+        finally:
+            self._inRunQueue = False
+
+    def _startCmds(self):
+        """!Start as many queued commands as possible; the guts of runQueue
+        """
+        if not self._enabled:
+            return
+        runningCmdList = self.runningCmds
+        busyResources = set() # resources in use or reserved by waiting commands
+        for runningCmd in runningCmdList:
+            if runningCmd.resources is None:
+                return # a running command has exclusive access
+            busyResources.update(runningCmd.resources)
+        numRunning = len(runningCmdList)
+        if self.agingDict is not None:
+            self._startAgedCmds(busyResources, numRunning)
+            return
+        waitingEntryList = [] # heap entries for commands that must wait
+        try:
+            while self._heap:
+                if self.maxRunning and numRunning >= self.maxRunning:
+                    break
+                entry = heapq.heappop(self._heap)
+                queuedCmd = entry[-1]
+                if not self._isQueued(queuedCmd):
+                    continue # command finished while queued
+                if self.useDeadlines and queuedCmd.deadline is not None and queuedCmd.deadline <= self.clock.time():
+                    self._expireCmd(queuedCmd)
+                    continue
+                resources = queuedCmd.resources
+                if resources is None:
+                    if numRunning > 0:
+                        waitingEntryList.append(entry)
+                        break
+                elif not busyResources.isdisjoint(resources):
+                    waitingEntryList.append(entry)
+                    busyResources.update(resources)
+                    continue
+                numRunning += self._startCmd(queuedCmd, numRunning)
+                if resources is None:
+                    break
+                busyResources.update(resources)
+        finally:
+            for entry in waitingEntryList:
+                heapq.heappush(self._heap, entry)
+
+    def _startAgedCmds(self, busyResources, numRunning):
+        """!Start as many queued commands as possible, taking aging into account; a helper for _startCmds
+
+        All queued commands with a given verb have the same priority, aging parameters and resources,
+        so the next command to run is always the first queued command of some verb, and if that command
+        must wait for a resource then so must all queued commands with that verb.
+        (Verbs not in priorityDict share one bucket, which is treated the same way.)
+
+        @param[in,out] busyResources  set of resources in use
+        @param[in] numRunning  number of commands running
+        """
+        blockedVerbInds = set() # indices of verbs whose commands must wait
+        while not (self.maxRunning and numRunning >= self.maxRunning):
+            currTime = self.clock.time()
+            bestKey = None
+            for verbInd, bucket in self._bucketDict.iteritems():
+                if verbInd in blockedVerbInds:
+                    continue
+                queuedCmd = next(bucket.itervalues())
+                key = (-self.getEffectivePriority(queuedCmd, currTime), queuedCmd.seqNum)
+                if bestKey is None or key < bestKey:
+                    bestKey = key
+                    bestCmd = queuedCmd
+            if bestKey is None:
+                return
+            resources = bestCmd.resources
+            if resources is None:
+                if numRunning > 0:
+                    return
+            elif not busyResources.isdisjoint(resources):
+                blockedVerbInds.add(bestCmd.verbInd)
+                busyResources.update(resources)
+                continue
+            numRunning += self._startCmd(bestCmd, numRunning)
+            if resources is None:
+                return
+            busyResources.update(resources)
+
+    def getEffectivePriority(self, queuedCmd, currTime=None):
+        """!Get the priority of a queued command, including aging
+
+        @param[in] queuedCmd  the queued command (a QueuedCommand)
+        @param[in] currTime  current time (unix seconds); if None then now
+        @return the effective priority (a number; infinity for Immediate)
+        """
+        if queuedCmd.priority == self.Immediate:
+            return float("inf")
+        aging = self.agingDict.get(queuedCmd.cmdVerb) if self.agingDict else None
+        if aging is None:
+            return queuedCmd.priority
+        rate, maxPriority = aging
+        if currTime is None:
+            currTime = self.clock.time()
+        priority = queuedCmd.priority + rate * (currTime - queuedCmd.queueTime)
+        if maxPriority is not None:
+            priority = min(priority, max(maxPriority, queuedCmd.priority))
+        return priority
+
+    def getWaitTimeStats(self, percentiles=(50, 90, 99)):
+        """!Get statistics about how long recently started commands waited on the queue, by priority
+
+        @param[in] percentiles  a collection of percentiles (0-100) to compute
+        @return a dict of priority: dict of statistics with these keys:
+        - "num": the number of wait times (at most MaxWaitTimeSamples; the most recent are kept)
+        - each percentile: wait time (sec) at that percentile, using the nearest-rank method
+        """
+        statsDict = {}
+        for priority, waitTimes in self._waitTimeDict.iteritems():
+            sortedWaitTimes = sorted(waitTimes)
+            numWaitTimes = len(sortedWaitTimes)
+            stats = dict(num=numWaitTimes)
+            for pct in percentiles:
+                ind = min(numWaitTimes - 1, max(0, int(math.ceil(pct * numWaitTimes / 100.0)) - 1))
+                stats[pct] = sortedWaitTimes[ind]
+            statsDict[priority] = stats
+        return statsDict
+
+    def getVerbStats(self):
+        """!Get statistics about the wait and run times of started commands, by command verb
+
+        @return a dict of cmdVerb: dict of statistics with these keys:
+        - "numStarted": the number of commands started
+        - "meanWait", "maxWait": mean and maximum time (sec) the started commands waited on the queue
+        - "numRun": the number of started commands that have finished
+        - "meanRun", "maxRun": mean and maximum time (sec) the finished commands ran
+        """
+        statsDict = {}
+        for cmdVerb, (waitStats, runStats) in self._verbStatsDict.iteritems():
+            statsDict[cmdVerb] = dict(
+                numStarted = waitStats.num,
+                meanWait = waitStats.mean,
+                maxWait = waitStats.max,
+                numRun = runStats.num,
+                meanRun = runStats.mean,
+                maxRun = runStats.max,
+            )
+        return statsDict
+
+    def getDepthHistogram(self):
+        """!Get a histogram of queue depth, as sampled each time a command is queued
+
+        The depth is the number of commands already queued when the new command was queued.
+
+        @return a list of (minDepth, maxDepth, count), in order of increasing depth;
+            the bins are 0, 1, 2-3, 4-7, 8-15...
+        """
+        return [
+            (0 if i == 0 else 1 << (i - 1), 0 if i == 0 else (1 << i) - 1, count)
+            for i, count in enumerate(self._depthHistogram)
+        ]
+
+    def getMetrics(self):
+        """!Get all metrics as a dict
+
+        @return a dict with these keys:
+        - "depth": the current number of queued commands
+        - "maxDepth": the maximum number of queued commands
+        - "depthHistogram": see getDepthHistogram
+        - "verbStats": see getVerbStats
+        - "ruleCounts": a dict of action: the number of commands cancelled or killed by rules with that action
+        - "numPreempted": the number of commands cancelled by Immediate commands
+        - "numShed", "shedCounts": the number of commands shed, in total and by command verb
+        - "numDeadlineMet", "numDeadlineMissed", "numExpired": see the class doc string
+        """
+        return dict(
+            depth = len(self),
+            maxDepth = self.maxDepth,
+            depthHistogram = self.getDepthHistogram(),
+            verbStats = self.getVerbStats(),
+            ruleCounts = dict((action, self.ruleCountDict.get(action, 0)) for action in sorted(self._AddActions)),
+            numPreempted = self.numPreempted,
+            numShed = self.numShed,
+            shedCounts = dict(self.shedCountDict),
+            numDeadlineMet = self.numDeadlineMet,
+            numDeadlineMissed = self.numDeadlineMissed,
+            numExpired = self.numExpired,
+        )
+
+    def resetMetrics(self):
+        """!Reset all metrics, including wait time statistics and the counts of shed and expired commands
+        """
+        self.numDeadlineMet = 0
+        self.numDeadlineMissed = 0
+        self.numExpired = 0
+        self.numShed = 0
+        self.shedCountDict = collections.defaultdict(int) # dict of cmdVerb: number of commands shed
+        self.ruleCountDict = collections.defaultdict(int) # dict of action: number of commands cancelled or killed
+        self.numPreempted = 0
+        self.maxDepth = len(self._queuedCmdDict)
+        self._depthHistogram = [] # number of new commands that found 0, 1, 2-3, 4-7... commands queued
+        self._waitTimeDict = {} # dict of priority: deque of recent wait times (sec)
+        self._verbStatsDict = {} # dict of cmdVerb: (wait time stats, run time stats)
+
+    def _startCmd(self, queuedCmd, numRunning):
+        """!Take a command off the queue and start it, along with the rest of its batch (if its verb is batched)
+
+        Each command in a batch counts toward maxRunning, so a batch is limited to the number of free slots.
+
+        @param[in] queuedCmd  the command to start (a QueuedCommand); its heap entry (if any) must already be removed
+        @param[in] numRunning  the number of commands running; must be less than maxRunning (if specified)
+        @return the number of commands started
+        """
+        batchInfo = self._batchDict.get(queuedCmd.verbInd)
+        if batchInfo is None:
+            self._prepareToStart(queuedCmd)
+            queuedCmd.setRunning()
+            queuedCmd.cmd.addCallback(self.scheduleRunQueue)
+            return 1
+
+        batchFunc, maxBatchSize, compatFunc = batchInfo
+        if self.maxRunning:
+            maxBatchSize = min(maxBatchSize or self.maxRunning, self.maxRunning - numRunning)
+        batch = [queuedCmd]
+        for otherCmd in self._bucketDict[queuedCmd.verbInd].itervalues():
+            if maxBatchSize and len(batch) >= maxBatchSize:
+                break
+            if otherCmd is queuedCmd:
+                continue
+            if compatFunc is None or compatFunc(queuedCmd.cmd, otherCmd.cmd):
+                batch.append(otherCmd)
+        # run the batch in the order queued
+        batch.sort(key=lambda batchCmd: batchCmd.seqNum)
+        for batchCmd in batch:
+            self._prepareToStart(batchCmd)
+        for batchCmd in batch:
+            if batchCmd.cmd.state != batchCmd.cmd.Ready:
+                raise RuntimeError("Cannot set %r running, command not ready" % (batchCmd.cmd,))
+            batchCmd.cmd.setState(batchCmd.cmd.Running)
+        cmdList = [batchCmd.cmd for batchCmd in batch if not batchCmd.isDone]
+        if cmdList:
+            batchFunc(cmdList)
+        for batchCmd in batch:
+            batchCmd.cmd.addCallback(self.scheduleRunQueue)
+        return len(batch)
+
+    def _prepareToStart(self, queuedCmd):
+        """!Take a command off the queue and record it as running; a helper for _startCmd
+
+        @param[in] queuedCmd  the command (a QueuedCommand)
+        """
+        self._removeQueuedCmd(queuedCmd.cmd)
+        queuedCmd.cmd.removeCallback(self._queuedCmdCallback, doRaise=False)
+        self._runningCmdList = self.runningCmds
+        self._runningCmdList.append(queuedCmd)
+        self.currExeCmd = queuedCmd
+        queuedCmd.startTime = self.clock.time()
+        waitTime = queuedCmd.startTime - queuedCmd.queueTime
+        waitTimes = self._waitTimeDict.get(queuedCmd.priority)
+        if waitTimes is None:
+            waitTimes = self._waitTimeDict[queuedCmd.priority] = collections.deque(maxlen=self.MaxWaitTimeSamples)
+        waitTimes.append(waitTime)
+        verbStats = self._verbStatsDict.get(queuedCmd.cmdVerb)
+        if verbStats is None:
+            verbStats = self._verbStatsDict[queuedCmd.cmdVerb] = (DurationStats(), DurationStats())
+        verbStats[0].add(waitTime)
+        queuedCmd.cmd.addCallback(functools.partial(self._startedCmdCallback, queuedCmd))
+
+    def _startedCmdCallback(self, queuedCmd, cmd):
+        """!Callback for a command started by the queue: when it is done record its run time and whether it met its deadline
+        """
+        if not cmd.isDone:
+            return
+        currTime = self.clock.time()
+        verbStats = self._verbStatsDict.get(queuedCmd.cmdVerb)
+        if verbStats is not None: # else metrics were reset while the command ran
+            verbStats[1].add(currTime - queuedCmd.startTime)
+        if queuedCmd.deadline is not None:
+            if cmd.didFail or currTime > queuedCmd.deadline:
+                self.numDeadlineMissed += 1
+            else:
+                self.numDeadlineMet += 1
+
+    def _expireCmds(self):
+        """!Fail all queued commands whose deadline has passed, and start the timer for the next deadline
+        """
+        self._deadlineTimer.cancel()
+        currTime = self.clock.time()
+        while self._deadlineHeap:
+            deadline, seqNum, queuedCmd = self._deadlineHeap[0]
+            if not self._isQueued(queuedCmd):
+                heapq.heappop(self._deadlineHeap)
+            elif deadline <= currTime:
+                heapq.heappop(self._deadlineHeap)
+                self._expireCmd(queuedCmd)
+            else:
+                self._deadlineTimer.start(deadline - currTime, self._expireCmds)
+                break
+
+    def _expireCmd(self, queuedCmd):
+        """!Fail a queued command whose deadline has passed
+        """
+        self.numExpired += 1
+        queuedCmd.setState(
+            queuedCmd.Failed,
+            textMsg = "Deadline passed while queued",
+        )
+
+    def _getQueuedCmdsByVerb(self, verbIndList):
+        """!Return a list of the queued commands (as QueuedCommand) whose verbs have the specified indices,
+        in the order queued
+
+        @param[in] verbIndList  a collection of verb indices
+        """
+        bucketList = [self._bucketDict[verbInd] for verbInd in verbIndList if verbInd in self._bucketDict]
+        if len(bucketList) == 1:
+            return list(bucketList[0].itervalues())
+        cmdList = [queuedCmd for bucket in bucketList for queuedCmd in bucket.itervalues()]
+        cmdList.sort(key=lambda queuedCmd: queuedCmd.seqNum)
+        return cmdList
+
+    def _isQueued(self, queuedCmd):
+        """!Return True if queuedCmd is on the queue and not done
+        """
+        return self._queuedCmdDict.get(queuedCmd.cmd) is queuedCmd
+
+    def _queuedCmdCallback(self, cmd):
+        """!Callback for queued commands: when a queued command finishes (e.g. is cancelled) take it off the queue
+
+        The command's heap entry is left in place (it is discarded when popped),
+        but the heap is compacted if more than half of its entries are for commands that are done.
+        """
+        if not cmd.isDone:
+            return
+        self._removeQueuedCmd(cmd)
+        if len(self._heap) > max(2 * len(self._queuedCmdDict), self._MinHeapSizeToCompact):
+            self._heap = [entry for entry in self._heap if self._isQueued(entry[-1])]
+            heapq.heapify(self._heap)
+
+    def _removeQueuedCmd(self, cmd):
+        """!Remove a command from _queuedCmdDict and _bucketDict, if present (but not from the heap)
+
+        @param[in] cmd  the command (a BaseCmd)
+        """
+        queuedCmd = self._queuedCmdDict.pop(cmd, None)
+        if queuedCmd is None:
+            return
+        if not self._queuedCmdDict and self._deadlineHeap:
+            self._deadlineHeap = []
+            self._deadlineTimer.cancel()
+        bucket = self._bucketDict.get(queuedCmd.verbInd)
+        if bucket is not None and bucket.get(cmd) is queuedCmd:
+            del bucket[cmd]
+            if not bucket:
+                del self._bucketDict[queuedCmd.verbInd]
 
     def __repr__(self):
         cmdList = ", ".join([x.cmdStr for x in self.cmdQueue])
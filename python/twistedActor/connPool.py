@@ -0,0 +1,382 @@
+from __future__ import absolute_import, division, print_function
+"""!A pool of parallel connections to one device, that looks like a single connection
+"""
+from collections import OrderedDict
+import functools
+
+from RO.AddCallback import safeCall2
+
+from .clock import getClock
+from .log import log
+
+__all__ = ["ConnPool"]
+
+class ConnPool(object):
+    """!A pool of parallel connections to a device that accepts several sessions at once
+
+    The pool has the connection interface that Device uses (connect, disconnect, state, fullState,
+    isConnected, isDisconnected, isDone, didFail, mayConnect, addStateCallback, removeStateCallback),
+    so a device that uses a pool appears as a single device to Actor and DeviceCollection.
+    The state of the pool is:
+    - Connecting after connect is called, until a member connection is connected
+    - Connected while the pool is wanted and has members, at least one of which has connected
+    - Failed if every member fails to connect or is lost
+    - Disconnecting, then Disconnected, after disconnect is called
+
+    Members are managed automatically while the pool is connected:
+    - connect opens minSize members
+    - acquire opens another member, up to maxSize, if every member is busy
+    - a member that is lost or fails to connect is dropped and, if fewer than minSize members remain,
+      replaced after retryInterval seconds
+    - a member that has been idle for idleTime seconds is closed, if more than minSize members remain
+    - discard closes a member that can no longer be trusted, e.g. because a command timed out on it,
+      and replaces it at once, if fewer than minSize members remain
+
+    Each member carries one command at a time: acquire marks an idle member busy and release marks it idle.
+
+    Attributes for monitoring performance:
+    - numOpened: number of members opened
+    - numLost: number of members that were lost or failed to connect
+    - numDiscarded: number of members closed by discard
+    - numIdleClosed: number of members closed because they were idle
+    - maxNumBusy: maximum number of members busy at once
+    """
+    Connecting = "Connecting"
+    Connected = "Connected"
+    Disconnecting = "Disconnecting"
+    Disconnected = "Disconnected"
+    Failed = "Failed"
+
+    def __init__(self,
+        connFactory,
+        minSize = 1,
+        maxSize = 4,
+        idleTime = 60,
+        retryInterval = 5,
+        readCallback = None,
+        memberCallback = None,
+        stateCallback = None,
+        host = None,
+        port = None,
+    ):
+        """!Construct a ConnPool
+
+        @param[in] connFactory  function that returns a new, unconnected connection to the device
+            (an RO.Comm.TCPConnection or similar); it receives no arguments
+        @param[in] minSize  number of members to keep open while connected
+        @param[in] maxSize  maximum number of members
+        @param[in] idleTime  time (sec) after which an idle member is closed, if there are more than minSize members
+        @param[in] retryInterval  time (sec) to wait before replacing a member that was lost or failed to connect
+        @param[in] readCallback  function to call when a member reads data, or None;
+            it receives two arguments: the member and the data read
+        @param[in] memberCallback  function to call when a member connects or is lost, or None;
+            it receives one argument: the member (check member.isConnected)
+        @param[in] stateCallback  function to call when the state of the pool changes, or None;
+            additional functions may be added using addStateCallback
+        @param[in] host  host of the device, for reporting
+        @param[in] port  port of the device, for reporting
+        """
+        if not callable(connFactory):
+            raise RuntimeError("connFactory=%r is not callable" % (connFactory,))
+        if not 1 <= minSize <= maxSize:
+            raise RuntimeError("Must have 1 <= minSize=%r <= maxSize=%r" % (minSize, maxSize))
+        self.connFactory = connFactory
+        self.minSize = int(minSize)
+        self.maxSize = int(maxSize)
+        self.idleTime = float(idleTime)
+        self.retryInterval = float(retryInterval)
+        self.readCallback = readCallback
+        self.memberCallback = memberCallback
+        self.host = host
+        self.port = port
+        self._stateCallbacks = []
+        if stateCallback:
+            self.addStateCallback(stateCallback)
+        self._state = self.Disconnected
+        self._reason = ""
+        self._wanted = False
+        self._timeLim = None
+        self._finalState = self.Disconnected # state to enter when the members being closed are disconnected
+        self._memberDict = OrderedDict() # dict of member: time it became idle, or None if busy; oldest first
+        self._closingSet = set() # members being closed by disconnect
+        self._readCallbackDict = dict() # dict of member: read callback the pool added to it
+        self._clock = getClock()
+        self._retryTimer = self._clock.Timer()
+        self._idleTimer = self._clock.Timer()
+        self.numOpened = 0
+        self.numLost = 0
+        self.numDiscarded = 0
+        self.numIdleClosed = 0
+        self.maxNumBusy = 0
+
+    @property
+    def fullState(self):
+        """!Return the current state as a tuple: (state, reason)
+        """
+        return (self._state, self._reason)
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def isConnected(self):
+        return self._state == self.Connected
+
+    @property
+    def isDisconnected(self):
+        return self._state in (self.Disconnected, self.Failed)
+
+    @property
+    def isDone(self):
+        return self._state in (self.Connected, self.Disconnected, self.Failed)
+
+    @property
+    def didFail(self):
+        return self._state == self.Failed
+
+    @property
+    def mayConnect(self):
+        return self._state not in (self.Connected, self.Connecting)
+
+    @property
+    def memberList(self):
+        """!Return a list of the members, oldest first
+        """
+        return list(self._memberDict)
+
+    @property
+    def numBusy(self):
+        """!Return the number of busy members
+        """
+        return sum(1 for idleSince in self._memberDict.itervalues() if idleSince is None)
+
+    def addStateCallback(self, callFunc, callNow=False):
+        """!Add a function to call when the state of the pool changes; it receives one argument: this pool
+        """
+        if not callable(callFunc):
+            raise RuntimeError("callFunc=%r is not callable" % (callFunc,))
+        self._stateCallbacks.append(callFunc)
+        if callNow:
+            callFunc(self)
+
+    def removeStateCallback(self, callFunc):
+        """!Remove a state callback function; return True if found, else False
+        """
+        try:
+            self._stateCallbacks.remove(callFunc)
+            return True
+        except ValueError:
+            return False
+
+    def connect(self, timeLim=None):
+        """!Open minSize members
+
+        @param[in] timeLim  time limit (sec) for each member to connect; None for no limit
+
+        @throw RuntimeError if already connecting or connected
+        """
+        if not self.mayConnect:
+            raise RuntimeError("Cannot connect: already connecting or connected")
+        self._wanted = True
+        self._timeLim = timeLim
+        for member in self._closingSet: # forget members still being closed by an earlier disconnect
+            self._forgetMember(member)
+        self._closingSet = set()
+        self._setState(self.Connecting, "")
+        self._openMembers(self.minSize)
+
+    def disconnect(self, isOK=True, reason=None):
+        """!Close all members
+
+        @param[in] isOK  if True the final state is Disconnected, else Failed
+        @param[in] reason  the reason, or None to leave unchanged
+        """
+        self._wanted = False
+        self._retryTimer.cancel()
+        self._idleTimer.cancel()
+        memberList = list(self._memberDict)
+        self._memberDict.clear()
+        self._finalState = self.Disconnected if isOK else self.Failed
+        if not memberList and self.isDisconnected:
+            return
+        self._closingSet.update(member for member in memberList if not member.isDisconnected)
+        if self._closingSet:
+            self._setState(self.Disconnecting, reason)
+        else:
+            self._setState(self._finalState, reason)
+        for member in memberList:
+            if member in self._closingSet:
+                member.disconnect()
+            else:
+                self._forgetMember(member)
+            self._doMemberCallback(member)
+
+    def acquire(self):
+        """!Return an idle connected member, marked busy, or None if there are none
+
+        If no member is idle then open another member, if there are fewer than maxSize
+        and none is still connecting; memberCallback is called when it connects.
+        """
+        for member, idleSince in self._memberDict.iteritems():
+            if idleSince is not None and member.isConnected:
+                self._memberDict[member] = None
+                self.maxNumBusy = max(self.maxNumBusy, self.numBusy)
+                return member
+        if self.isConnected and len(self._memberDict) < self.maxSize \
+            and all(member.isConnected for member in self._memberDict):
+            self._openMembers(1)
+        return None
+
+    def release(self, member):
+        """!Mark a busy member idle
+
+        @param[in] member  member returned by acquire; ignored if it is no longer in the pool
+        """
+        if member in self._memberDict and self._memberDict[member] is None:
+            self._memberDict[member] = self._clock.time()
+            self._startIdleTimer()
+
+    def discard(self, member, reason="discarded"):
+        """!Close a member and remove it from the pool; if fewer than minSize members remain then open another
+
+        @param[in] member  member to discard; ignored if it is no longer in the pool
+        @param[in] reason  reason for discarding it, for the log
+        """
+        if member not in self._memberDict:
+            return
+        del self._memberDict[member]
+        self.numDiscarded += 1
+        log.info("%s discarding member %s: %s" % (self, member, reason))
+        self._forgetMember(member)
+        member.disconnect()
+        if self._wanted:
+            self._openMembers(self.minSize - len(self._memberDict))
+        self._updateState(reason)
+
+    def _openMembers(self, num):
+        """!Create num new members and connect them; do nothing if num <= 0
+
+        All are added to the pool before any is connected, so that one failing at once
+        does not leave the pool momentarily empty (which would fail the pool).
+        """
+        newMemberList = []
+        for i in range(num):
+            member = self.connFactory()
+            readCallback = functools.partial(self._memberReadCallback, member)
+            self._readCallbackDict[member] = readCallback
+            member.addReadCallback(readCallback)
+            member.addStateCallback(self._memberStateCallback)
+            self._memberDict[member] = self._clock.time()
+            newMemberList.append(member)
+        self.numOpened += len(newMemberList)
+        for member in newMemberList:
+            if member in self._memberDict:
+                member.connect(timeLim=self._timeLim)
+
+    def _forgetMember(self, member):
+        """!Remove the pool's callbacks from a member that has left the pool
+
+        The callbacks are removed on a zero-second timer, because the member may be calling them
+        right now, and removing one from the list being iterated over would skip the next one;
+        the callbacks ignore members that are not in the pool.
+        """
+        readCallback = self._readCallbackDict.pop(member, None)
+        if readCallback is not None:
+            self._clock.Timer(0, member.removeReadCallback, readCallback)
+        self._clock.Timer(0, member.removeStateCallback, self._memberStateCallback)
+
+    def _memberReadCallback(self, member, sock, data):
+        """!Read callback for members
+        """
+        if self.readCallback and member in self._memberDict:
+            self.readCallback(member, data)
+
+    def _memberStateCallback(self, member):
+        """!State callback for members
+        """
+        if member in self._closingSet:
+            if member.isDisconnected:
+                self._closingSet.discard(member)
+                self._forgetMember(member)
+                if not self._closingSet and not self._wanted:
+                    self._setState(self._finalState)
+            return
+        if member not in self._memberDict:
+            return # discarded or closed because idle
+        if member.isConnected:
+            self._updateState()
+            self._doMemberCallback(member)
+            self._startIdleTimer()
+        elif member.isDisconnected:
+            del self._memberDict[member]
+            self._forgetMember(member)
+            self.numLost += 1
+            reason = member.fullState[1]
+            log.warn("%s lost member %s: %s" % (self, member, reason))
+            self._doMemberCallback(member)
+            if self._wanted and len(self._memberDict) < self.minSize and not self._retryTimer.isActive:
+                self._retryTimer.start(self.retryInterval, self._openToMinSize)
+            self._updateState(reason)
+
+    def _openToMinSize(self):
+        """!Open members until there are minSize
+        """
+        if self._wanted:
+            self._openMembers(self.minSize - len(self._memberDict))
+
+    def _closeIdle(self):
+        """!Close members that have been idle for idleTime, while there are more than minSize members
+        """
+        now = self._clock.time()
+        # close the newest members first; acquire prefers the oldest, so the newest are the ones least needed
+        for member, idleSince in reversed(self._memberDict.items()):
+            if len(self._memberDict) <= self.minSize:
+                break
+            if idleSince is not None and member.isConnected and now - idleSince >= self.idleTime:
+                del self._memberDict[member]
+                self._forgetMember(member)
+                self.numIdleClosed += 1
+                member.disconnect()
+        self._startIdleTimer()
+
+    def _startIdleTimer(self):
+        """!Start the timer that closes idle members, if needed and not already running
+        """
+        if self._idleTimer.isActive or len(self._memberDict) <= self.minSize:
+            return
+        idleSinceList = [idleSince for idleSince in self._memberDict.itervalues() if idleSince is not None]
+        if idleSinceList:
+            self._idleTimer.start(max(0, min(idleSinceList) + self.idleTime - self._clock.time()), self._closeIdle)
+
+    def _updateState(self, reason=None):
+        """!Set the state of the pool from the state of its members, while the pool is wanted
+
+        The pool is Connected if any member is connected; it fails if no members remain
+        (which includes all members failing to connect); otherwise it keeps its current state.
+        """
+        if not self._wanted:
+            return
+        if any(member.isConnected for member in self._memberDict):
+            self._setState(self.Connected, "")
+        elif not self._memberDict:
+            self.disconnect(isOK=False, reason=reason or "all connections lost")
+
+    def _doMemberCallback(self, member):
+        if self.memberCallback:
+            safeCall2("%s.memberCallback" % (self,), self.memberCallback, member)
+
+    def _setState(self, state, reason=None):
+        """!Set the state and reason, and call the state callbacks if either changed
+        """
+        oldStateReason = (self._state, self._reason)
+        self._state = state
+        if reason is not None:
+            self._reason = str(reason)
+        if (self._state, self._reason) != oldStateReason:
+            for callFunc in self._stateCallbacks[:]:
+                safeCall2("%s._setState" % (self,), callFunc, self)
+
+    def __repr__(self):
+        return "%s(host=%s, port=%s, numMembers=%s, numBusy=%s)" % \
+            (type(self).__name__, self.host, self.port, len(self._memberDict), self.numBusy)
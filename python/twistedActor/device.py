@@ -11,7 +11,9 @@ of one of these classes. Much of the work of writing an Actor involves writing t
 Device classes.
 """
 from collections import OrderedDict
+import sys
 
+import RO.Alg
 import RO.Comm.Generic
 RO.Comm.Generic.setFramework("twisted")
 from RO.AddCallback import BaseMixin
@@ -20,10 +22,14 @@ from RO.Comm.TCPConnection import TCPConnection
 from RO.StringUtil import quoteStr, strFromException
 import opscore.actor
 
-from .command import DevCmd, DevCmdVar, UserCmd, expandUserCmd
+from .cmdCoalescer import CmdCoalescer
+from .cmdWindow import CmdWindow
+from .connPool import ConnPool
+from .command import DevCmd, DevCmdVar, UserCmd, callAfterCmdCallbacks, expandUserCmd
 from .log import log
+from .replyRouter import ReplyRouter
 
-__all__ = ["Device", "TCPDevice", "ActorDevice", "DeviceCollection"]
+__all__ = ["Device", "TCPDevice", "PipelinedTCPDevice", "PooledTCPDevice", "ActorDevice", "DeviceCollection"]
 
 class Device(BaseMixin):
     """!Device interface.
@@ -43,6 +49,12 @@ class Device(BaseMixin):
     - is connection wanted?
     - the user command that triggered this request, or None if none
 
+    Each device has its own sequence of command ID numbers (see nextLocCmdID)
+    and a table of running device commands by ID (see findCmd), for matching replies to commands.
+
+    A device may be supervised by a DeviceSupervisor, which reconnects it if it is lost
+    and fails new commands at once while it is down.
+
     When this device is added to an Actor then it gains the actor's writeToUsers method.
     """
     DefaultTimeLim = 5 # default time limit, seconds; subclasses may override
@@ -60,6 +72,8 @@ class Device(BaseMixin):
         cmdInfo = None,
         callFunc = None,
         cmdClass = DevCmd,
+        idempotentVerbs = (),
+        cacheTime = 0,
     ):
         """!Construct a Device
 
@@ -72,6 +86,10 @@ class Device(BaseMixin):
         @param[in] callFunc  function to call when state of device changes, or None if none;
                     additional functions may be added using addCallback
         @param[in] cmdClass  class for commands for this device
+        @param[in] idempotentVerbs  a collection of verbs for read-only commands (e.g. status queries);
+                    identical commands with these verbs are coalesced by startCmd; see CmdCoalescer
+        @param[in] cacheTime  time (sec) for which startCmd caches the result of an idempotent command;
+                    0 for no caching; only commands without a user command are served from the cache
 
         conn is an RO.Conn.TCPDevice or object with these attributes (see RO.Comm.TCPConnection for descriptions):
         - connect()
@@ -92,8 +110,15 @@ class Device(BaseMixin):
         self.connReq = (False, None)
         self.conn = conn
         self.cmdClass = cmdClass
+        self.cmdCoalescer = CmdCoalescer(verbs=idempotentVerbs, cacheTime=cacheTime)
+        self.replyRouter = ReplyRouter() # used by the default handleReply
+        self._locCmdIDGen = RO.Alg.IDGen(startVal=1, wrapVal=sys.maxint)
+        self._locCmdIDDict = dict() # dict of locCmdID: device command that is not yet done
         self._state = self.Disconnected
         self._ignoreConnCallback = False # set during connection and disconnection
+        self._wantConn = False # True if connect has been called more recently than disconnect
+        self.supervisor = None # set by DeviceSupervisor
+        self.pollScheduler = None # set by PollScheduler.addPoll
         self.conn.addStateCallback(self._connCallback)
         if callFunc:
             self.addCallback(callFunc, callNow=False)
@@ -110,6 +135,7 @@ class Device(BaseMixin):
         @return userCmd: the specified userCmd or if that was None, then a new empty one
         """
         log.info("%s.connect(userCmd=%s, timeLim=%s)" % (self, userCmd, timeLim))
+        self._wantConn = True
         return ConnectDevice(dev=self, userCmd=userCmd, timeLim=timeLim).userCmd
 
     def disconnect(self, userCmd=None, timeLim=DefaultTimeLim):
@@ -120,6 +146,7 @@ class Device(BaseMixin):
         @return userCmd: the specified userCmd or if that was None, then a new empty one
         """
         log.info("%s.disconnect(userCmd=%s, timeLim=%s)" % (self, userCmd, timeLim))
+        self._wantConn = False
         return DisconnectDevice(dev=self, userCmd=userCmd, timeLim=timeLim).userCmd
 
     def cleanup(self):
@@ -129,6 +156,51 @@ class Device(BaseMixin):
         """
         pass
 
+    def nextLocCmdID(self):
+        """!Return the next command ID number for a command sent to this device
+
+        Called by DevCmd when a command is constructed for this device.
+        """
+        return self._locCmdIDGen.next()
+
+    def registerCmd(self, devCmd):
+        """!Add a device command to the table used by findCmd
+
+        The command is removed from the table when it is done.
+        startCmd calls this for each command it sends; subclasses that override startCmd should call it as well.
+        If the device is polled by a PollScheduler then this also tells the scheduler the device is active.
+
+        @param[in] devCmd  device command; it must have attribute locCmdID
+        """
+        if devCmd.isDone:
+            return
+        self._locCmdIDDict[devCmd.locCmdID] = devCmd
+        devCmd.addCallback(self._registeredCmdCallback)
+        if self.pollScheduler is not None:
+            self.pollScheduler.noteActivity(self)
+
+    def findCmd(self, locCmdID):
+        """!Find a running device command by its command ID
+
+        Intended for handleReply, to match replies to commands in constant time.
+
+        @param[in] locCmdID  command ID number (an int)
+        @return the device command, or None if no command with this ID is registered and not done
+        """
+        return self._locCmdIDDict.get(locCmdID)
+
+    @property
+    def numRunningCmds(self):
+        """!Return the number of registered device commands that are not done (see registerCmd)
+        """
+        return len(self._locCmdIDDict)
+
+    def _registeredCmdCallback(self, devCmd):
+        """!Remove a device command from the table used by findCmd when it is done
+        """
+        if devCmd.isDone and self._locCmdIDDict.get(devCmd.locCmdID) is devCmd:
+            del self._locCmdIDDict[devCmd.locCmdID]
+
     def setState(self, state, reason=None):
         """!Set connection state
         """
@@ -157,18 +229,21 @@ class Device(BaseMixin):
         @param[in] replyStr  the reply, minus any terminating \n
 
         This is the heart of the device interface and an important part of what makes
-        each device unique. As such, it must be specified by the subclass.
+        each device unique. As such, it must be specified by the subclass, either by overriding
+        this method or by adding handlers to self.replyRouter (see ReplyRouter), which this version uses.
 
         Tasks include:
         - Parse the reply
-        - Manage pending commands
+        - Manage pending commands (findCmd is a quick way to find a command by its ID)
         - Update the device model representing the state of the device
         - Output state data to users (if state has changed)
         - Call the command callback
 
-        @warning: must be defined by the subclass
+        @warning: must be defined by the subclass, unless handlers have been added to self.replyRouter
         """
-        raise NotImplementedError()
+        if not self.replyRouter.hasHandlers:
+            raise NotImplementedError()
+        self.replyRouter.dispatch(replyStr)
 
     def init(self, userCmd=None, timeLim=DefaultTimeLim, getStatus=True):
         """!Initialize the device and cancel all pending commands
@@ -198,6 +273,12 @@ class Device(BaseMixin):
         """
         return self._state == self.Connected
 
+    @property
+    def isConnecting(self):
+        """!Return True if device is connecting (which includes running init)
+        """
+        return self._state == self.Connecting
+
     @property
     def isDisconnected(self):
         """!Return True if device is disconnected or disconnection failed
@@ -210,6 +291,12 @@ class Device(BaseMixin):
         """
         return self._state in (self.Disconnected, self.Failed, self.Disconnecting)
 
+    @property
+    def wantConn(self):
+        """!Return True if connect has been called more recently than disconnect
+        """
+        return self._wantConn
+
     def startCmd(self, cmdStr, callFunc=None, userCmd=None, timeLim=DefaultTimeLim, showReplies=False):
         """!Start a new command.
 
@@ -225,9 +312,9 @@ class Device(BaseMixin):
         @note: if callFunc and userCmd are both specified callFunc is called before userCmd is updated.
 
         @warning: subclasses must supplement or override this method to set the devCmd done when finished.
-        Subclasses that use a command queue will usually replace this method.
+        Subclasses that use a command queue will usually replace this method;
+        such subclasses should call self.cmdCoalescer.attach to support idempotentVerbs.
         """
-        log.info("%s.startCmd(cmdStr=%r, callFunc=%s, userCmd=%s, timeLim=%s)" % (self, cmdStr, callFunc, userCmd, timeLim))
         devCmd = self.cmdClass(
             cmdStr = cmdStr,
             userCmd = userCmd,
@@ -236,17 +323,42 @@ class Device(BaseMixin):
             dev = self,
             showReplies = showReplies,
         )
+        if self.supervisor is not None and self.supervisor.isOpen:
+            self.supervisor.failFast(devCmd)
+            return devCmd
+
+        log.info("%s.startCmd(cmdStr=%r, callFunc=%s, userCmd=%s, timeLim=%s)" % (self, cmdStr, callFunc, userCmd, timeLim))
         if not self.conn.isConnected:
             devCmd.setState(devCmd.Failed, textMsg="%s %s failed: not connected" % (self.name, cmdStr))
+        elif self.cmdCoalescer.attach(devCmd):
+            log.info("%s %r coalesced or cached" % (self, cmdStr))
         else:
-            fullCmdStr = devCmd.fullCmdStr
-            try:
-                self.conn.writeLine(fullCmdStr)
-            except Exception as e:
-                devCmd.setState(devCmd.Failed, textMsg="%s %s failed: %s" % (self.name, cmdStr, strFromException(e)))
+            self.sendCmd(devCmd)
 
         return devCmd
 
+    def sendCmd(self, devCmd):
+        """!Send a new device command to the device; called by startCmd
+
+        This version calls writeCmd; subclasses may override it, e.g. to queue commands.
+
+        @param[in] devCmd  device command
+        """
+        self.writeCmd(devCmd)
+
+    def writeCmd(self, devCmd):
+        """!Register a device command (see registerCmd) and write it to the device
+
+        If writing fails then the command fails.
+
+        @param[in] devCmd  device command
+        """
+        self.registerCmd(devCmd)
+        try:
+            self.conn.writeLine(devCmd.fullCmdStr)
+        except Exception as e:
+            devCmd.setState(devCmd.Failed, textMsg="%s %s failed: %s" % (self.name, devCmd.cmdStr, strFromException(e)))
+
     def _connCallback(self, conn=None):
         """!Call when the connection state changes
 
@@ -257,6 +369,7 @@ class Device(BaseMixin):
             return False
         if self.conn.isConnected:
             return
+        self.cmdCoalescer.clear()
         if self.isDisconnected:
             if self.state != self.Disconnected:
                 self.setState(self.Disconnected, "connection state = %s" % (self.conn.state,))
@@ -290,6 +403,7 @@ class ConnectDevice(object):
         self.userCmd = expandUserCmd(userCmd)
         self._connTimer = Timer()
         self._addedConnCallback = False
+        self._isFinished = False
 
         if self.dev.isConnected and self.dev.conn.isConnected:
             # already done; don't send init
@@ -318,11 +432,13 @@ class ConnectDevice(object):
             reason = userCmd.getMsg() or "init command failed for unknown reasons"
         else:
             reason = None
-        Timer(0, self.finish, reason)
+        callAfterCmdCallbacks(self.finish, reason)
 
     def connCallback(self, conn):
         """!Callback for device connection state
         """
+        if self._isFinished:
+            return
         if self.dev.conn.isConnected:
             self._connTimer.cancel()
             initUserCmd = UserCmd(cmdStr="connect %s" % (self.dev.name,), callFunc=self.initCallback)
@@ -336,10 +452,13 @@ class ConnectDevice(object):
 
         @param[in] reason: reason for failure (if non-empty then failure is assumed)
         """
+        if self._isFinished:
+            return
+        self._isFinished = True
         self._connTimer.cancel()
         self.dev._ignoreConnCallback = False
         if self._addedConnCallback:
-            self.dev.conn.removeStateCallback(self.connCallback)
+            _removeConnStateCallback(self.dev.conn, self.connCallback)
         if reason or not self.dev.conn.isConnected:
             reason = reason or "unknown reason"
             self.dev.setState(self.dev.Failed, reason)
@@ -373,6 +492,7 @@ class DisconnectDevice(object):
         self._timeLim = timeLim
         self._connTimer = Timer()
         self._addedConnCallback = False
+        self._isFinished = False
 
         if self.dev.conn.isDisconnected:
             if self.dev.state != self.dev.Disconnected:
@@ -397,10 +517,13 @@ class DisconnectDevice(object):
 
     def startDisconnect(self):
         """!Start disconnecting the connection
+
+        If the connection is already fully disconnected, finish once the init command's callbacks
+        have run (the constructor only calls this if the connection is not fully disconnected).
         """
         if self.dev.conn.isDone and not self.dev.conn.isConnected:
             # fully disconnected; no more to be done
-            Timer(0, self.finish)
+            callAfterCmdCallbacks(self.finish)
         else:
             if self._timeLim:
                 # start timer for disconnection
@@ -423,6 +546,9 @@ class DisconnectDevice(object):
 
     def connCallback(self, conn):
         """!Callback for device connection state
+
+        Called by the connection while it iterates over its state callbacks,
+        so finish on a zero-second timer rather than inside that loop.
         """
         if self.dev.conn.isDone:
             Timer(0, self.finish)
@@ -432,10 +558,13 @@ class DisconnectDevice(object):
 
         @param[in] reason: reason for failure (if non-empty then failure is assumed)
         """
+        if self._isFinished:
+            return
+        self._isFinished = True
         self._connTimer.cancel()
         self.dev._ignoreConnCallback = False
         if self._addedConnCallback:
-            self.dev.conn.removeStateCallback(self.connCallback)
+            _removeConnStateCallback(self.dev.conn, self.connCallback)
         if reason or not self.dev.conn.isDone or not self.dev.conn.isDisconnected:
             reason = reason or "unknown reasons"
             self.dev.setState(self.dev.Failed, reason)
@@ -452,8 +581,42 @@ class DisconnectDevice(object):
         return "%s(dev.name=%s)" % (type(self).__name__, self.dev.name)
 
 
+def _removeConnStateCallback(conn, callFunc):
+    """!Remove a connection state callback function on a zero-second timer
+
+    The connection may be calling its state callbacks right now, and removing one of them
+    from the list being iterated over would cause the next callback to be skipped.
+    Callers must ignore calls to callFunc after requesting removal.
+    """
+    Timer(0, conn.removeStateCallback, callFunc)
+
+
+def _setTcpNoDelay(conn):
+    """!Disable Nagle's algorithm (set TCP_NODELAY) for a connected RO.Comm.TCPConnection
+
+    RO.Comm.TCPConnection offers no supported way to set socket options, so this reaches
+    the twisted transport through RO internals (conn._sock._protocol.transport).
+    If a change to RO breaks that then this reports the failure rather than raising,
+    and the caller should warn that TCP_NODELAY is not set.
+
+    @return None if successful, else a string describing why it failed
+    """
+    try:
+        transport = conn._sock._protocol.transport
+        transport.setTcpNoDelay(True)
+    except Exception as e:
+        return "could not reach the socket through RO.Comm.TCPConnection internals: %s" % (strFromException(e),)
+    return None
+
+
 class TCPDevice(Device):
     """!TCP-connected device.
+
+    Commands written in the same reactor iteration (e.g. by DeviceSet.startCmdDict)
+    are sent in a single socket write, because the twisted transport buffers writes
+    until the reactor next checks the socket. However, by default the operating system may delay
+    sending a command (Nagle's algorithm) while an earlier one is unacknowledged;
+    specify noDelay=True to send each command as soon as possible.
     """
     def __init__(self,
         name,
@@ -463,6 +626,9 @@ class TCPDevice(Device):
         callFunc = None,
         cmdClass = DevCmd,
         lineTerminator = "\r\n",
+        idempotentVerbs = (),
+        cacheTime = 0,
+        noDelay = False,
     ):
         """!Construct a TCPDevice
 
@@ -479,7 +645,15 @@ class TCPDevice(Device):
                     when the connection state changes; register a callback with "conn" for that task.
         @param[in] cmdClass  class for commands for this device
         @param[in] lineTerminator  specifies the end of line characters when sending data to the device
+        @param[in] idempotentVerbs  a collection of verbs for read-only commands (e.g. status queries);
+                    identical commands with these verbs are coalesced by startCmd; see CmdCoalescer
+        @param[in] cacheTime  time (sec) for which startCmd caches the result of an idempotent command;
+                    0 for no caching; only commands without a user command are served from the cache
+        @param[in] noDelay  if True then disable Nagle's algorithm (set TCP_NODELAY) when connected,
+                    to reduce latency for devices that receive many small commands;
+                    this relies on RO internals, so if it fails a warning is logged and the option is ignored
         """
+        self.noDelay = bool(noDelay)
         Device.__init__(self,
             name = name,
             cmdInfo = cmdInfo,
@@ -492,7 +666,20 @@ class TCPDevice(Device):
             ),
             callFunc = callFunc,
             cmdClass = cmdClass,
+            idempotentVerbs = idempotentVerbs,
+            cacheTime = cacheTime,
         )
+        if self.noDelay:
+            self.conn.addStateCallback(self._setNoDelay)
+
+    def _setNoDelay(self, conn):
+        """!Connection state callback that disables Nagle's algorithm when connected
+        """
+        if not conn.isConnected:
+            return
+        errMsg = _setTcpNoDelay(conn)
+        if errMsg:
+            log.warn("%s noDelay ignored: could not set TCP_NODELAY; %s" % (self, errMsg))
 
     def _readCallback(self, sock, replyStr):
         """!Called whenever the device has returned a reply.
@@ -510,6 +697,350 @@ class TCPDevice(Device):
         return "%s(%s, host=%s, port=%s)" % (type(self).__name__, self.name, self.conn.host, self.conn.port)
 
 
+class PipelinedTCPDevice(TCPDevice):
+    """!A TCP-connected device that can work on several commands at once
+
+    Up to maxOutstanding commands may be outstanding (sent and not done) at once;
+    startCmd queues additional commands locally and sends them as outstanding commands finish (see CmdWindow).
+    A command's time limit includes time spent in the local queue.
+
+    The device must tag each reply with the command ID of the command it is for: the default parseReplyID
+    expects replies of the form "<locCmdID> <reply>", matching the default DevCmd.fullCmdStr.
+    handleReply routes each reply to handleCmdReply, which must be defined by the subclass.
+    """
+    def __init__(self,
+        name,
+        host,
+        port = 23,
+        maxOutstanding = 4,
+        cmdInfo = None,
+        callFunc = None,
+        cmdClass = DevCmd,
+        lineTerminator = "\r\n",
+        idempotentVerbs = (),
+        cacheTime = 0,
+        noDelay = False,
+    ):
+        """!Construct a PipelinedTCPDevice
+
+        @param[in] name      a short name to identify the device
+        @param[in] host      IP address
+        @param[in] port      port
+        @param[in] maxOutstanding  maximum number of commands the device may work on at once
+        @param[in] cmdInfo   a list of (user command verb, device command verb, help string)
+                    for user commands that are be sent directly to this device.
+                    Specify None for the device command verb if it is the same as the user command verb
+                    (strongly recommended as it is much easier for the user to figure out what is going on)
+        @param[in] callFunc  function to call when state of device changes, or None if none;
+                    additional functions may be added using addCallback.
+        @param[in] cmdClass  class for commands for this device
+        @param[in] lineTerminator  specifies the end of line characters when sending data to the device
+        @param[in] idempotentVerbs  a collection of verbs for read-only commands (e.g. status queries);
+                    identical commands with these verbs are coalesced by startCmd; see CmdCoalescer
+        @param[in] cacheTime  time (sec) for which startCmd caches the result of an idempotent command;
+                    0 for no caching; only commands without a user command are served from the cache
+        @param[in] noDelay  if True then disable Nagle's algorithm (set TCP_NODELAY) when connected
+        """
+        # create the window first, because TCPDevice.__init__ may call _connCallback
+        self.cmdWindow = CmdWindow(writeFunc=self.writeCmd, maxOutstanding=maxOutstanding)
+        TCPDevice.__init__(self,
+            name = name,
+            host = host,
+            port = port,
+            cmdInfo = cmdInfo,
+            callFunc = callFunc,
+            cmdClass = cmdClass,
+            lineTerminator = lineTerminator,
+            idempotentVerbs = idempotentVerbs,
+            cacheTime = cacheTime,
+            noDelay = noDelay,
+        )
+
+    def sendCmd(self, devCmd):
+        """!Send a new device command to the device, or queue it if maxOutstanding commands are outstanding
+        """
+        self.cmdWindow.send(devCmd)
+
+    def handleReply(self, replyStr):
+        """!Route a line of output from the device to handleCmdReply
+
+        @param[in] replyStr  the reply, minus any terminating \n
+        """
+        locCmdID, cmdReplyStr = self.parseReplyID(replyStr)
+        devCmd = self.findCmd(locCmdID) if locCmdID is not None else None
+        self.handleCmdReply(devCmd, cmdReplyStr)
+
+    def parseReplyID(self, replyStr):
+        """!Split a reply into command ID and the rest of the reply
+
+        This version expects "<locCmdID> <reply>"; override if the device tags replies differently.
+
+        @param[in] replyStr  the reply, minus any terminating \n
+        @return (locCmdID, rest of reply); locCmdID is None if the reply has no command ID
+        """
+        idStr, sep, cmdReplyStr = replyStr.strip().partition(" ")
+        try:
+            return int(idStr), cmdReplyStr
+        except ValueError:
+            return None, replyStr
+
+    def handleCmdReply(self, devCmd, replyStr):
+        """!Handle a reply from the device
+
+        @param[in] devCmd  the device command the reply is for, or None if unknown
+            (no command ID, or the command is done, e.g. because it timed out)
+        @param[in] replyStr  the reply, without the command ID
+
+        @warning: must be defined by the subclass; it must set devCmd done when the device says it is done
+        """
+        raise NotImplementedError()
+
+    def _connCallback(self, conn=None):
+        """!Call when the connection state changes
+
+        If the connection is lost then fail the outstanding commands and the commands waiting to be sent
+        """
+        if not self.conn.isConnected:
+            self.cmdWindow.clear(textMsg="%s not connected" % (self.name,))
+        return TCPDevice._connCallback(self, conn)
+
+
+class PooledTCPDevice(Device):
+    """!A TCP-connected device that accepts several connections at once and works on them in parallel
+
+    The device's connection (conn) is a ConnPool of TCP connections to host:port,
+    so the device appears as a single device to Actor and DeviceCollection.
+    Each connection carries one command at a time: startCmd sends each command on an idle connection,
+    opening another connection (up to maxConns) if all are busy, and queues it locally if none is available.
+    A command's time limit includes time spent in the local queue. Connections that are lost
+    are replaced and extra connections that stay idle are closed; see ConnPool for details.
+
+    Replies are routed by connection: handleCmdReply receives each reply along with the command
+    running on the connection that read it, so the device need not tag replies with command IDs.
+    A connection whose command finishes other than while handling one of its replies (e.g. the command
+    times out) is closed and replaced, so that a late reply cannot be mistaken for a reply to a later command.
+    If a connection is lost then its command fails.
+
+    Attributes for monitoring performance:
+    - numDeferred: number of commands that had to wait in the local queue
+    - conn: the pool; see ConnPool for its attributes
+    """
+    def __init__(self,
+        name,
+        host,
+        port = 23,
+        minConns = 1,
+        maxConns = 4,
+        idleTime = 60,
+        retryInterval = 5,
+        cmdInfo = None,
+        callFunc = None,
+        cmdClass = DevCmd,
+        lineTerminator = "\r\n",
+        idempotentVerbs = (),
+        cacheTime = 0,
+        noDelay = False,
+    ):
+        """!Construct a PooledTCPDevice
+
+        @param[in] name      a short name to identify the device
+        @param[in] host      IP address
+        @param[in] port      port
+        @param[in] minConns  number of connections to keep open while connected
+        @param[in] maxConns  maximum number of connections, and so of commands the device works on at once
+        @param[in] idleTime  time (sec) after which an idle connection is closed, if more than minConns are open
+        @param[in] retryInterval  time (sec) to wait before replacing a connection that was lost or failed to connect
+        @param[in] cmdInfo   a list of (user command verb, device command verb, help string)
+                    for user commands that are be sent directly to this device.
+                    Specify None for the device command verb if it is the same as the user command verb
+                    (strongly recommended as it is much easier for the user to figure out what is going on)
+        @param[in] callFunc  function to call when state of device changes, or None if none;
+                    additional functions may be added using addCallback.
+        @param[in] cmdClass  class for commands for this device
+        @param[in] lineTerminator  specifies the end of line characters when sending data to the device
+        @param[in] idempotentVerbs  a collection of verbs for read-only commands (e.g. status queries);
+                    identical commands with these verbs are coalesced by startCmd; see CmdCoalescer
+        @param[in] cacheTime  time (sec) for which startCmd caches the result of an idempotent command;
+                    0 for no caching; only commands without a user command are served from the cache
+        @param[in] noDelay  if True then disable Nagle's algorithm (set TCP_NODELAY) on each connection
+        """
+        self.host = host
+        self.port = port
+        self.lineTerminator = lineTerminator
+        self.noDelay = bool(noDelay)
+        self._memberCmdDict = dict() # dict of connection: device command running on it
+        self._cmdMemberDict = dict() # dict of device command: connection it is running on
+        self._waitingCmdDict = OrderedDict() # dict of device command: None, in the order queued
+        self._replyMember = None # connection whose reply is being handled
+        self._inSend = False # True while _sendWaiting is running
+        self._sendAgain = False # set if _sendWaiting is called while it is running
+        self.numDeferred = 0
+        Device.__init__(self,
+            name = name,
+            cmdInfo = cmdInfo,
+            conn = ConnPool(
+                connFactory = self._makeConn,
+                minSize = minConns,
+                maxSize = maxConns,
+                idleTime = idleTime,
+                retryInterval = retryInterval,
+                readCallback = self._readCallback,
+                memberCallback = self._memberCallback,
+                host = host,
+                port = port,
+            ),
+            callFunc = callFunc,
+            cmdClass = cmdClass,
+            idempotentVerbs = idempotentVerbs,
+            cacheTime = cacheTime,
+        )
+
+    @property
+    def numWaiting(self):
+        """!Return the number of commands waiting for an idle connection
+        """
+        return len(self._waitingCmdDict)
+
+    def sendCmd(self, devCmd):
+        """!Send a new device command on an idle connection, or queue it if none is available
+        """
+        if devCmd.state == devCmd.Ready:
+            devCmd.setState(devCmd.Running)
+        if devCmd.isDone:
+            return
+        devCmd.addCallback(self._pooledCmdCallback)
+        self._waitingCmdDict[devCmd] = None
+        self._sendWaiting()
+        if devCmd in self._waitingCmdDict:
+            self.numDeferred += 1
+
+    def handleCmdReply(self, devCmd, replyStr):
+        """!Handle a reply from the device
+
+        @param[in] devCmd  the device command running on the connection that read the reply,
+            or None if none (e.g. unsolicited output)
+        @param[in] replyStr  the reply, minus any terminating \n
+
+        @warning: must be defined by the subclass; it must set devCmd done when the device says it is done
+        """
+        raise NotImplementedError()
+
+    def _makeConn(self):
+        """!Return a new connection to the device, for the pool
+        """
+        conn = TCPConnection(
+            host = self.host,
+            port = self.port,
+            readLines = True,
+            lineTerminator = self.lineTerminator,
+        )
+        if self.noDelay:
+            conn.addStateCallback(self._setNoDelay)
+        return conn
+
+    def _setNoDelay(self, conn):
+        """!Connection state callback that disables Nagle's algorithm when connected
+        """
+        if not conn.isConnected:
+            return
+        errMsg = _setTcpNoDelay(conn)
+        if errMsg:
+            log.warn("%s noDelay ignored: could not set TCP_NODELAY; %s" % (self, errMsg))
+
+    def _sendWaiting(self):
+        """!Send queued commands on idle connections until the queue is empty or no connection is available
+
+        This is re-entrant: if called while running (e.g. because a command failed as soon as it was written)
+        then it runs again once the current pass is finished, rather than recursively.
+        """
+        if self._inSend:
+            self._sendAgain = True
+            return
+        self._inSend = True
+        try:
+            self._sendAgain = True
+            while self._sendAgain:
+                self._sendAgain = False
+                while self._waitingCmdDict:
+                    member = self.conn.acquire()
+                    if member is None:
+                        break
+                    devCmd = self._waitingCmdDict.popitem(last=False)[0]
+                    self._writeToMember(member, devCmd)
+        finally:
+            self._inSend = False
+
+    def _writeToMember(self, member, devCmd):
+        """!Register a device command (see registerCmd) and write it on a connection from the pool
+
+        If writing fails then the command fails.
+        """
+        self._memberCmdDict[member] = devCmd
+        self._cmdMemberDict[devCmd] = member
+        self.registerCmd(devCmd)
+        try:
+            member.writeLine(devCmd.fullCmdStr)
+        except Exception as e:
+            devCmd.setState(devCmd.Failed, textMsg="%s %s failed: %s" % (self.name, devCmd.cmdStr, strFromException(e)))
+
+    def _pooledCmdCallback(self, devCmd):
+        """!Callback for commands sent by sendCmd; free the command's connection when it is done
+        """
+        if not devCmd.isDone:
+            return
+        if devCmd in self._waitingCmdDict:
+            del self._waitingCmdDict[devCmd]
+            return
+        member = self._cmdMemberDict.pop(devCmd, None)
+        if member is None:
+            return
+        if self._memberCmdDict.get(member) is devCmd:
+            del self._memberCmdDict[member]
+        if member is self._replyMember:
+            self.conn.release(member)
+        else:
+            self.conn.discard(member, reason="%s finished without a reply: %s" % (devCmd.cmdStr, devCmd.textMsg))
+        self._sendWaiting()
+
+    def _readCallback(self, member, replyStr):
+        """!Called by the pool whenever a connection reads a reply
+        """
+        self._replyMember = member
+        try:
+            self.handleCmdReply(self._memberCmdDict.get(member), replyStr)
+        finally:
+            self._replyMember = None
+
+    def _memberCallback(self, member):
+        """!Called by the pool when a connection connects or is lost
+        """
+        if member.isConnected:
+            self._sendWaiting()
+            return
+        devCmd = self._memberCmdDict.get(member)
+        if devCmd is not None and not devCmd.isDone:
+            devCmd.setState(devCmd.Failed, textMsg="%s %s failed: connection lost" % (self.name, devCmd.cmdStr))
+
+    def _connCallback(self, conn=None):
+        """!Call when the state of the pool changes
+
+        If the pool is not connected then fail the commands waiting to be sent
+        """
+        if not self.conn.isConnected and self._waitingCmdDict:
+            waitingCmdList = list(self._waitingCmdDict)
+            self._waitingCmdDict.clear()
+            for devCmd in waitingCmdList:
+                if not devCmd.isDone:
+                    devCmd.setState(devCmd.Failed, textMsg="%s not connected" % (self.name,))
+        return Device._connCallback(self, conn)
+
+    def __str__(self):
+        return "%s(%s)" % (type(self).__name__, self.name)
+
+    def __repr__(self):
+        return "%s(%s, host=%s, port=%s)" % (type(self).__name__, self.name, self.host, self.port)
+
+
 class ActorDevice(TCPDevice):
     """!A device that obeys the APO standard actor interface
     """
@@ -0,0 +1,297 @@
+from __future__ import absolute_import, division, print_function
+"""!Reconnect a device automatically, with a circuit breaker that fails commands fast while it is down
+"""
+import functools
+import random
+
+from RO.AddCallback import BaseMixin
+
+from .clock import getClock
+from .log import log
+
+__all__ = ["DeviceSupervisor"]
+
+class DeviceSupervisor(BaseMixin):
+    """!Reconnect a device that has been lost, and fail its commands fast until it is back
+
+    Supervision is opt-in: construct a DeviceSupervisor for each device that should be supervised;
+    it sets the device's supervisor attribute. The supervisor acts as a circuit breaker, whose state is:
+    - Closed: normal operation; the device is connected, or is not wanted (it has not been connected
+        or was disconnected by a user)
+    - Open: the device was lost (or a connection attempt failed) while it was wanted;
+        a reconnection is scheduled after a delay that grows exponentially with each failed attempt,
+        from minDelay to maxDelay, randomized by +/- jitter (a fraction) so that devices
+        lost at the same time do not all reconnect at the same time
+    - HalfOpen: reconnecting: connecting the device (which runs init) and then running the setup commands,
+        one at a time; if any of these fails then the circuit opens again
+
+    While the circuit is not closed, Device.startCmd fails new commands at once (without logging them
+    or touching the connection), other than the setup commands and commands started while the device
+    is connecting (e.g. by init), whether the supervisor or a user started the connection.
+    Note that ActorDevice overrides startCmd and so does not fail commands fast.
+
+    The reason (attribute reason) is the reason the device was lost or the last reconnection attempt failed;
+    the message of each command failed fast includes it.
+
+    Callback functions (see addCallback) are called when the state changes; they receive one argument: this supervisor.
+
+    Attributes for monitoring performance (see also getMetrics):
+    - numStateChanges: number of changes of circuit state
+    - numDevStateChanges: number of changes of device state
+    - numOutages: number of times the device was lost
+    - numAttempts: number of reconnection attempts
+    - numRecoveries: number of successful reconnections
+    - numFastFails: number of commands failed at once because the circuit was not closed
+    - totalOutageTime: total duration (sec) of outages that have ended
+    - maxOutageTime: maximum duration (sec) of outages that have ended
+    """
+    Closed = "Closed"
+    Open = "Open"
+    HalfOpen = "HalfOpen"
+
+    def __init__(self,
+        dev,
+        setupCmdList = (),
+        minDelay = 1,
+        maxDelay = 60,
+        backoffFactor = 2,
+        jitter = 0.2,
+        timeLim = None,
+        callFunc = None,
+    ):
+        """!Construct a DeviceSupervisor and start supervising a device
+
+        @param[in] dev  the device (a Device)
+        @param[in] setupCmdList  device command strings to run, in order, after each reconnection and init
+        @param[in] minDelay  delay (sec) before the first reconnection attempt
+        @param[in] maxDelay  maximum delay (sec) between reconnection attempts
+        @param[in] backoffFactor  factor by which the delay grows after each failed attempt
+        @param[in] jitter  randomize each delay by +/- this fraction of the delay
+        @param[in] timeLim  time limit (sec) for connecting and for each setup command;
+            None for the device's default time limit
+        @param[in] callFunc  function to call when the state changes, or None;
+            additional functions may be added using addCallback
+
+        @throw RuntimeError if the device already has a supervisor or the arguments are invalid
+        """
+        if getattr(dev, "supervisor", None) is not None:
+            raise RuntimeError("Device %s already has a supervisor" % (dev.name,))
+        if not 0 < minDelay <= maxDelay:
+            raise RuntimeError("Must have 0 < minDelay=%r <= maxDelay=%r" % (minDelay, maxDelay))
+        if backoffFactor < 1:
+            raise RuntimeError("backoffFactor=%r must be >= 1" % (backoffFactor,))
+        if not 0 <= jitter < 1:
+            raise RuntimeError("Must have 0 <= jitter=%r < 1" % (jitter,))
+        BaseMixin.__init__(self)
+        self.dev = dev
+        self.setupCmdList = tuple(setupCmdList)
+        self.minDelay = float(minDelay)
+        self.maxDelay = float(maxDelay)
+        self.backoffFactor = float(backoffFactor)
+        self.jitter = float(jitter)
+        self.timeLim = timeLim if timeLim is not None else dev.DefaultTimeLim
+        self.reason = ""
+        self._state = self.Closed
+        self._clock = getClock()
+        self._retryTimer = self._clock.Timer()
+        self._numFailedAttempts = 0 # number of failed attempts in the current outage
+        self._outageStartTime = None # time the current outage started, or None if none
+        self._inSetup = False # True while the supervisor is starting a setup command
+        self.resetMetrics()
+        dev.supervisor = self
+        dev.addCallback(self._devCallback, callNow=False)
+        if callFunc:
+            self.addCallback(callFunc, callNow=False)
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def isOpen(self):
+        """!Return True if commands should fail fast: the circuit is not closed and the device is wanted
+
+        Commands started by the supervisor itself (setup commands) are allowed, as are commands started
+        while the device is connecting, so that init can run.
+        """
+        return self._state != self.Closed and self.dev.wantConn and not self._inSetup \
+            and not self.dev.isConnecting
+
+    @property
+    def outageTime(self):
+        """!Return the duration (sec) of the current outage, or 0 if none
+        """
+        return self._clock.time() - self._outageStartTime if self._outageStartTime is not None else 0.0
+
+    def failFast(self, devCmd):
+        """!Fail a new device command because the circuit is open; called by Device.startCmd
+
+        @param[in] devCmd  the new device command
+        """
+        self.numFastFails += 1
+        devCmd.setState(devCmd.Failed, textMsg="%s %s failed: not connected (%s); reconnecting" %
+            (self.dev.name, devCmd.cmdStr, self.reason))
+
+    def getMetrics(self):
+        """!Get all metrics as a dict
+
+        @return a dict with these keys:
+        - "state": circuit state
+        - "numStateChanges", "numDevStateChanges", "numOutages", "numAttempts", "numRecoveries",
+          "numFastFails", "totalOutageTime", "maxOutageTime": see the class doc string
+        - "outageTime": duration (sec) of the current outage, or 0 if none
+        """
+        return dict(
+            state = self._state,
+            numStateChanges = self.numStateChanges,
+            numDevStateChanges = self.numDevStateChanges,
+            numOutages = self.numOutages,
+            numAttempts = self.numAttempts,
+            numRecoveries = self.numRecoveries,
+            numFastFails = self.numFastFails,
+            totalOutageTime = self.totalOutageTime,
+            maxOutageTime = self.maxOutageTime,
+            outageTime = self.outageTime,
+        )
+
+    def resetMetrics(self):
+        """!Reset all metrics
+        """
+        self.numStateChanges = 0
+        self.numDevStateChanges = 0
+        self.numOutages = 0
+        self.numAttempts = 0
+        self.numRecoveries = 0
+        self.numFastFails = 0
+        self.totalOutageTime = 0.0
+        self.maxOutageTime = 0.0
+
+    def getDelay(self):
+        """!Return the delay (sec) before the next reconnection attempt, including jitter
+        """
+        delay = min(self.maxDelay, self.minDelay * self.backoffFactor**self._numFailedAttempts)
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
+
+    def _devCallback(self, dev):
+        """!Device state callback: open the circuit if the device was lost or failed to connect while wanted
+
+        A failed connection attempt (including a failed init) leaves the device in state Failed,
+        for which isDisconnecting is True, whether the attempt was started by a user or by this supervisor.
+        """
+        self.numDevStateChanges += 1
+        if self._state == self.Open and dev.isConnected:
+            # reconnected by other means, e.g. by a user; run the setup commands
+            self._retryTimer.cancel()
+            self.numAttempts += 1
+            self._setState(self.HalfOpen)
+            self._runSetupCmd(0)
+            return
+        if self._state != self.Closed:
+            return # the supervisor is reconnecting the device, and will handle the outcome
+        if dev.isDisconnecting and dev.wantConn:
+            self.numOutages += 1
+            self._outageStartTime = self._clock.time()
+            self._numFailedAttempts = 0
+            self._open(getattr(dev, "reason", None) or "connection lost")
+
+    def _open(self, reason):
+        """!Open the circuit and schedule a reconnection attempt
+        """
+        self.reason = reason
+        delay = self.getDelay()
+        log.warn("%s: %s; reconnecting in %0.1f sec" % (self, reason, delay))
+        self._setState(self.Open)
+        self._retryTimer.start(delay, self._reconnect)
+
+    def _reconnect(self):
+        """!Start a reconnection attempt
+        """
+        if not self.dev.wantConn:
+            # a user disconnected the device; stop trying
+            self._close(recovered=False)
+            return
+        self.numAttempts += 1
+        self._setState(self.HalfOpen)
+        if self.dev.isConnected:
+            self.dev.conn.disconnect() # e.g. the connection is up but setup failed; start afresh
+        userCmd = self.dev.connect(timeLim=self.timeLim)
+        userCmd.addCallback(self._connectCallback, callNow=True)
+
+    def _connectCallback(self, userCmd):
+        """!Callback for the command that connects (and initializes) the device
+        """
+        if not userCmd.isDone:
+            return
+        if userCmd.didFail:
+            # report the device's reason (why the connection or init failed), rather than the user command's
+            # message, which wraps it; commands are not failed fast while connecting, so neither includes
+            # the message of a command failed fast, and reasons do not nest from one attempt to the next
+            self._attemptFailed(getattr(self.dev, "reason", None) or userCmd.getMsg() or "reconnection failed")
+        else:
+            self._runSetupCmd(0)
+
+    def _runSetupCmd(self, ind):
+        """!Run setup command ind, or close the circuit if all have been run
+        """
+        if self._state != self.HalfOpen:
+            return
+        if ind >= len(self.setupCmdList):
+            self._close(recovered=True)
+            return
+        self._inSetup = True
+        try:
+            self.dev.startCmd(self.setupCmdList[ind], callFunc=functools.partial(self._setupCmdCallback, ind),
+                timeLim=self.timeLim)
+        finally:
+            self._inSetup = False
+
+    def _setupCmdCallback(self, ind, devCmd):
+        """!Callback for setup command ind
+        """
+        if not devCmd.isDone:
+            return
+        if devCmd.didFail:
+            self._attemptFailed("setup command %r failed: %s" % (devCmd.cmdStr, devCmd.getMsg()))
+        else:
+            self._runSetupCmd(ind + 1)
+
+    def _attemptFailed(self, reason):
+        """!Handle a failed reconnection attempt: open the circuit again, with a longer delay
+        """
+        if self._state != self.HalfOpen:
+            return
+        self._numFailedAttempts += 1
+        if not self.dev.wantConn:
+            self._close(recovered=False)
+            return
+        self._open(reason)
+
+    def _close(self, recovered):
+        """!Close the circuit, ending the current outage (if any)
+
+        @param[in] recovered  True if the device was reconnected, False if supervision was abandoned
+        """
+        self._retryTimer.cancel()
+        if self._outageStartTime is not None:
+            outageTime = self.outageTime
+            self.totalOutageTime += outageTime
+            self.maxOutageTime = max(self.maxOutageTime, outageTime)
+            self._outageStartTime = None
+        if recovered:
+            self.numRecoveries += 1
+            log.info("%s: reconnected" % (self,))
+        self._numFailedAttempts = 0
+        self.reason = ""
+        self._setState(self.Closed)
+
+    def _setState(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        self.numStateChanges += 1
+        self._doCallbacks()
+
+    def __repr__(self):
+        return "%s(%s, state=%s)" % (type(self).__name__, self.dev.name, self._state)
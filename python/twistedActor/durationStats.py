@@ -0,0 +1,25 @@
+from __future__ import absolute_import, division, print_function
+"""!Accumulate simple statistics of a series of durations
+"""
+__all__ = ["DurationStats"]
+
+class DurationStats(object):
+    """!Count, total and maximum of a series of durations
+
+    Used by CommandQueue and PollScheduler for their metrics.
+    """
+    __slots__ = ("num", "total", "max")
+    def __init__(self):
+        self.num = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.num += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self):
+        return self.total / self.num if self.num else 0.0
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
-__all__ = ["LinkCommands"]
+from .clock import getClock
+
+__all__ = ["LinkCommands", "RaceCommands"]
 
 class LinkCommands(object):
     """!Link commands such that completion of the main command depends on one or more sub-commands
@@ -59,3 +61,119 @@ class LinkCommands(object):
             state = self.mainCmd.Done
             textMsg = ""
         self.mainCmd.setState(state, textMsg = textMsg)
+
+
+class RaceCommands(object):
+    """!Link commands such that the main command succeeds as soon as any one sub-command succeeds
+
+    This is intended for redundant devices: send the same request to several of them
+    and use the first good answer. When one sub-command succeeds the main command is set done
+    and the remaining sub-commands are cancelled (or simply ignored, if cancelOthers is False).
+    The main command fails only if every sub-command fails.
+
+    To hedge (start extra copies only if the first copies are slow), supply functions in hedgeFuncList;
+    they are called after hedgeDelay seconds if the main command is not yet done,
+    or immediately if every sub-command started so far has failed.
+
+    @note: To use, simply construct this object; you need not keep a reference to the resulting instance.
+    """
+    def __init__(self, mainCmd, subCmdList, cancelOthers=True, hedgeFuncList=(), hedgeDelay=0):
+        """!Link a main command to a collection of redundant sub-commands
+
+        @param[in] mainCmd  the main command, a BaseCmd
+        @param[in] subCmdList  a collection of sub-commands, each a BaseCmd; may be empty if hedgeFuncList is not
+        @param[in] cancelOthers  if True then cancel unfinished sub-commands when the main command finishes;
+            if False then leave them running, but stop paying attention to them
+        @param[in] hedgeFuncList  a collection of functions that start additional sub-commands;
+            each takes no arguments and returns the new sub-command (a BaseCmd)
+        @param[in] hedgeDelay  time to wait (sec) before calling the functions in hedgeFuncList;
+            if 0 or None then they are called right away
+
+        @throw RuntimeError if mainCmd is already linked or if subCmdList and hedgeFuncList are both empty
+        """
+        if hasattr(mainCmd, 'isLinked'):
+            raise RuntimeError("Cannont link main command %s, it is already linked elsewhere!"%str(mainCmd))
+        if not subCmdList and not hedgeFuncList:
+            raise RuntimeError("Must specify at least one sub-command or hedge function")
+        self.mainCmd = mainCmd
+        self.mainCmd.isLinked = True
+        self.cancelOthers = bool(cancelOthers)
+        self.subCmdList = []
+        self._hedgeFuncList = list(hedgeFuncList)
+        self._hedgeTimer = getClock().Timer()
+
+        self._addSubCmds(subCmdList)
+        if self._hedgeFuncList:
+            if hedgeDelay and self.subCmdList:
+                self._hedgeTimer.start(hedgeDelay, self._startHedge)
+            else:
+                self._startHedge()
+
+        # call right away in case a sub-command is already done
+        self.subCmdCallback()
+
+    def subCmdCallback(self, subCmd=None):
+        """!Callback to be added to each sub-command
+
+        @param[in] subCmd  sub-command issuing the callback, or None to check all sub-commands
+        """
+        if self.mainCmd.isDone:
+            # finished elsewhere (e.g. timed out); let go of the sub-commands
+            self._finish()
+            return
+
+        subCmdList = self.subCmdList if subCmd is None else [subCmd]
+        for cmd in subCmdList:
+            if cmd.isDone and not cmd.didFail:
+                self._finish(winningCmd=cmd)
+                self.mainCmd.setState(self.mainCmd.Done, textMsg=cmd.textMsg, hubMsg=cmd.hubMsg)
+                return
+
+        if not all(cmd.isDone for cmd in self.subCmdList):
+            # keep waiting for a sub-command to succeed
+            return
+
+        if self._hedgeFuncList:
+            # everything started so far has failed; don't wait to start the hedge commands
+            self._startHedge()
+            return
+
+        self._finish()
+        failedCmdSummary = "; ".join("%s: %s" % (cmd.cmdStr, cmd.getMsg()) for cmd in self.subCmdList)
+        self.mainCmd.setState(self.mainCmd.Failed, textMsg="All sub-command(s) failed: %s" % (failedCmdSummary,))
+
+    def _addSubCmds(self, subCmdList):
+        """!Add sub-commands to the race
+        """
+        for subCmd in subCmdList:
+            self.subCmdList.append(subCmd)
+            # give each sub command a copy of the 'mainCommand'
+            # mostly for writing responses to it
+            subCmd.mainCmd = self.mainCmd
+            if not subCmd.isDone:
+                subCmd.addCallback(self.subCmdCallback)
+
+    def _startHedge(self):
+        """!Start the hedge sub-commands
+        """
+        self._hedgeTimer.cancel()
+        if self.mainCmd.isDone:
+            return
+        hedgeFuncList, self._hedgeFuncList = self._hedgeFuncList, []
+        self._addSubCmds([hedgeFunc() for hedgeFunc in hedgeFuncList])
+        self.subCmdCallback()
+
+    def _finish(self, winningCmd=None):
+        """!Stop hedging and cancel or detach all unfinished sub-commands
+
+        @param[in] winningCmd  the sub-command that succeeded, or None if none
+        """
+        self._hedgeTimer.cancel()
+        self._hedgeFuncList = []
+        for cmd in self.subCmdList:
+            if cmd.isDone:
+                continue
+            cmd.removeCallback(self.subCmdCallback, doRaise=False)
+            if self.cancelOthers:
+                textMsg = "Superseded by %r" % (winningCmd.cmdStr,) if winningCmd else "Main command finished"
+                cmd.setState(cmd.Cancelled, textMsg=textMsg)
@@ -74,7 +74,9 @@ class BaseLogger(object):
     - define class constants DEBUG, INFO, WARNING, ERROR, CRITICAL
     - override the "log" and "stopLogging" methods
     - define "__init__" to construct the logger and starts logging
+    Subclasses that ignore info messages should set class constant LogsInfo False.
     """
+    LogsInfo = True # are info messages recorded?
     def log(self, logMsg, logLevel):
         """!Log a message at the specified log level
 
@@ -101,6 +103,7 @@ class DefaultLogger(BaseLogger):
 
     Debug and info messages are ignored (to avoid clutter)
     """
+    LogsInfo = False
     DEBUG = "Debug"
     INFO = "Info"
     WARNING = "Warning"
@@ -287,6 +290,14 @@ class LogManager(object):
     def log(self, logMsg, logLevel):
         self.logger.log(logMsg, logLevel)
 
+    @property
+    def logsInfo(self):
+        """!Return True if the current logger records info messages
+
+        Use this to avoid formatting info messages that would be ignored.
+        """
+        return self.logger.LogsInfo
+
     def replaceLogger(self, logger):
         """!Stop the current logger and switch to a new logger
 
@@ -0,0 +1,355 @@
+from __future__ import absolute_import, division, print_function
+"""!Poll the status of devices on one shared schedule that adapts to device activity
+"""
+import functools
+
+from .clock import getClock
+from .durationStats import DurationStats
+from .log import log
+
+__all__ = ["PollScheduler"]
+
+# successive multiples of this, modulo 1, are spread evenly over [0, 1) however many there are
+_PhaseStep = 0.6180339887498949
+
+class Poll(object):
+    """!A status command that a PollScheduler runs periodically on one device
+
+    Attributes for monitoring performance:
+    - numSent: number of times the command was sent
+    - numSkipped: number of times the command was due but was not sent,
+        because the device was not connected or the previous poll was still running
+    - numFailed: number of times the command failed
+    - costStats: statistics of the time (sec) each poll took to run (see costStats.mean, .max and .num)
+    - jitterStats: statistics of the difference (sec) between the time each poll was due and the time it was sent
+    """
+    def __init__(self, dev, cmdStr, interval, timeLim, callFunc, name, baseTime):
+        self.dev = dev
+        self.cmdStr = cmdStr
+        self.interval = float(interval)
+        self.timeLim = timeLim
+        self.callFunc = callFunc
+        self.name = name
+        self.baseTime = baseTime # time the last poll was due; the next is due one interval later
+        self.devCmd = None # the most recent poll command
+        self.sendTime = None # time the most recent poll command was sent
+        self.resetMetrics()
+
+    @property
+    def isRunning(self):
+        """!Return True if a poll command is running
+        """
+        return self.devCmd is not None and not self.devCmd.isDone
+
+    def resetMetrics(self):
+        """!Reset all metrics
+        """
+        self.numSent = 0
+        self.numSkipped = 0
+        self.numFailed = 0
+        self.costStats = DurationStats()
+        self.jitterStats = DurationStats()
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, self.name)
+
+
+class _DevInfo(object):
+    """!Information about one device polled by a PollScheduler
+    """
+    def __init__(self, dev, isBusyFunc, lastActivityTime):
+        self.dev = dev
+        self.isBusyFunc = isBusyFunc
+        self.pollList = []
+        self.lastActivityTime = lastActivityTime
+        self.regime = None # polling regime when the timer was last scheduled
+
+
+class PollScheduler(object):
+    """!Poll the status of many devices on one shared schedule that adapts to device activity
+
+    Register each status command with addPoll, giving its nominal interval. The scheduler runs each command
+    using dev.startCmd, using one timer for all devices, and:
+    - staggers the polls, so that polls with similar intervals do not all fall due at the same time
+    - coalesces the polls of each device: when a poll is due, the device's other polls that are due
+        within coalesceTime are sent at the same time, so each device is interrupted once rather than several times
+    - adapts the rate of polling to the activity of each device: while a device is busy (running a command
+        other than a poll) its polls run busyFactor times their nominal interval; once it has been
+        quiet for idleTime its polls run idleFactor times their nominal interval.
+        The scheduler notices new activity at once for devices that call noteActivity (Device.registerCmd does);
+        otherwise it notices at the next poll of the device.
+    - skips a poll if the device is not connected or the previous poll of that command is still running
+    - measures the cost (run time) and jitter (lateness) of each poll; see getMetrics
+
+    Actor creates one the first time its pollScheduler property is used, and reports its metrics with the pollStats command.
+    """
+    Busy = "busy"
+    Normal = "normal"
+    Idle = "idle"
+
+    def __init__(self, busyFactor=0.25, idleFactor=4, idleTime=60, coalesceTime=0.5):
+        """!Construct a PollScheduler
+
+        @param[in] busyFactor  factor by which to multiply poll intervals while a device is busy
+        @param[in] idleFactor  factor by which to multiply poll intervals once a device has been quiet for idleTime
+        @param[in] idleTime  time (sec) after a device's last activity before it is considered idle
+        @param[in] coalesceTime  a device's polls that are due within this time (sec) are sent together
+        """
+        if not 0 < busyFactor <= 1 <= idleFactor:
+            raise RuntimeError("Must have 0 < busyFactor=%r <= 1 <= idleFactor=%r" % (busyFactor, idleFactor))
+        self.busyFactor = float(busyFactor)
+        self.idleFactor = float(idleFactor)
+        self.idleTime = float(idleTime)
+        self.coalesceTime = float(coalesceTime)
+        self._clock = getClock()
+        self._timer = self._clock.Timer()
+        self._nextTime = None # time at which the timer fires, or None if it is not running
+        self._devInfoDict = dict() # dict of device: _DevInfo
+        self._numAdded = 0 # number of polls ever added, for staggering
+        self._inRunPoll = False # True while starting a poll command
+        self.resetMetrics()
+
+    def addPoll(self, dev, cmdStr, interval, timeLim=None, callFunc=None, name=None, isBusyFunc=None):
+        """!Add a status command to poll a device
+
+        @param[in] dev  the device (a Device)
+        @param[in] cmdStr  the command string
+        @param[in] interval  nominal interval (sec) between polls
+        @param[in] timeLim  time limit (sec) for each poll; None for the device's default
+        @param[in] callFunc  function to call when each poll command finishes, or None;
+            it receives one argument: the device command
+        @param[in] name  name for getMetrics; if None then "<dev.name> <cmdStr>"
+        @param[in] isBusyFunc  function that reports whether the device is busy, or None for the default,
+            which reports whether the device has registered commands running other than polls
+            (see Device.numRunningCmds); it receives one argument: the device.
+            Ignored if the device already has polls.
+        @return the poll (a Poll), for removePoll
+
+        @throw RuntimeError if interval <= 0 or the device is polled by a different PollScheduler
+        """
+        if interval <= 0:
+            raise RuntimeError("interval=%r must be > 0" % (interval,))
+        if getattr(dev, "pollScheduler", None) not in (None, self):
+            raise RuntimeError("Device %s is polled by a different PollScheduler" % (dev.name,))
+        now = self._clock.time()
+        devInfo = self._devInfoDict.get(dev)
+        if devInfo is None:
+            devInfo = _DevInfo(dev=dev, isBusyFunc=isBusyFunc, lastActivityTime=now)
+            self._devInfoDict[dev] = devInfo
+            dev.pollScheduler = self
+        # stagger: the first poll is due a fraction of the interval from now, a different fraction for each poll
+        offset = interval * ((self._numAdded * _PhaseStep) % 1.0)
+        self._numAdded += 1
+        poll = Poll(
+            dev = dev,
+            cmdStr = cmdStr,
+            interval = interval,
+            timeLim = timeLim if timeLim is not None else dev.DefaultTimeLim,
+            callFunc = callFunc,
+            name = name if name is not None else "%s %s" % (dev.name, cmdStr),
+            baseTime = now + offset - interval,
+        )
+        devInfo.pollList.append(poll)
+        self._schedule(now)
+        return poll
+
+    def removePoll(self, poll):
+        """!Stop running a poll; a poll command that is running is not affected
+
+        @throw RuntimeError if the poll is not in this scheduler
+        """
+        devInfo = self._devInfoDict.get(poll.dev)
+        if devInfo is None or poll not in devInfo.pollList:
+            raise RuntimeError("%s is not in this scheduler" % (poll,))
+        devInfo.pollList.remove(poll)
+        if not devInfo.pollList:
+            self.removeDev(poll.dev)
+        else:
+            self._schedule(self._clock.time())
+
+    def removeDev(self, dev):
+        """!Stop polling a device; ignored if the device is not polled
+        """
+        if self._devInfoDict.pop(dev, None) is not None:
+            dev.pollScheduler = None
+            self._schedule(self._clock.time())
+
+    @property
+    def pollList(self):
+        """!Return a list of all polls, by device name
+        """
+        return [poll for devInfo in sorted(self._devInfoDict.itervalues(), key=lambda devInfo: devInfo.dev.name)
+            for poll in devInfo.pollList]
+
+    def noteActivity(self, dev):
+        """!Note that a device has started a command, so its polls may need to run sooner
+
+        Device.registerCmd calls this for each command it registers, so it must be cheap: the timer is only
+        restarted if the device's polling regime has changed and, as a result, one of its polls falls due
+        before the timer fires. Polls that are due are run on the next reactor iteration,
+        so that the command that caused the activity is sent first.
+
+        @param[in] dev  the device; ignored if not polled by this scheduler
+        """
+        devInfo = self._devInfoDict.get(dev)
+        if devInfo is None or self._inRunPoll:
+            return
+        now = self._clock.time()
+        devInfo.lastActivityTime = now
+        regime = self.getRegime(dev, now)
+        if regime == devInfo.regime:
+            return
+        devInfo.regime = regime
+        dueTime = min(poll.baseTime + self.getInterval(poll, regime) for poll in devInfo.pollList)
+        if self._nextTime is None or dueTime < self._nextTime:
+            self._nextTime = max(now, dueTime)
+            self._timer.start(self._nextTime - now, self._tick)
+
+    def getRegime(self, dev, now=None):
+        """!Return the polling regime of a device: Busy, Normal or Idle
+
+        @param[in] dev  the device
+        @param[in] now  the current time, or None to read the clock
+        """
+        if now is None:
+            now = self._clock.time()
+        devInfo = self._devInfoDict[dev]
+        if devInfo.isBusyFunc is not None:
+            isBusy = devInfo.isBusyFunc(dev)
+        else:
+            numRunningPolls = sum(1 for poll in devInfo.pollList if poll.isRunning)
+            isBusy = getattr(dev, "numRunningCmds", 0) > numRunningPolls
+        if isBusy:
+            devInfo.lastActivityTime = now
+            return self.Busy
+        if now - devInfo.lastActivityTime >= self.idleTime:
+            return self.Idle
+        return self.Normal
+
+    def getInterval(self, poll, regime):
+        """!Return the interval (sec) of a poll in the specified regime
+        """
+        if regime == self.Busy:
+            return poll.interval * self.busyFactor
+        elif regime == self.Idle:
+            return poll.interval * self.idleFactor
+        return poll.interval
+
+    def getMetrics(self):
+        """!Get all metrics as a dict
+
+        @return a dict with these keys:
+        - "numTicks": number of times the scheduler's timer fired
+        - "maxPollsPerTick": maximum number of polls sent at once
+        - "polls": a dict of poll name: dict with these keys:
+            - "device": device name
+            - "regime": polling regime of the device (see getRegime)
+            - "interval": current interval (sec)
+            - "numSent", "numSkipped", "numFailed": see Poll
+            - "meanCost", "maxCost": mean and maximum time (sec) a poll took to run
+            - "meanJitter", "maxJitter": mean and maximum absolute difference (sec)
+                between the time a poll was due and the time it was sent
+        """
+        now = self._clock.time()
+        pollMetricsDict = dict()
+        for devInfo in self._devInfoDict.itervalues():
+            regime = self.getRegime(devInfo.dev, now)
+            for poll in devInfo.pollList:
+                pollMetricsDict[poll.name] = dict(
+                    device = devInfo.dev.name,
+                    regime = regime,
+                    interval = self.getInterval(poll, regime),
+                    numSent = poll.numSent,
+                    numSkipped = poll.numSkipped,
+                    numFailed = poll.numFailed,
+                    meanCost = poll.costStats.mean,
+                    maxCost = poll.costStats.max,
+                    meanJitter = poll.jitterStats.mean,
+                    maxJitter = poll.jitterStats.max,
+                )
+        return dict(
+            numTicks = self.numTicks,
+            maxPollsPerTick = self.maxPollsPerTick,
+            polls = pollMetricsDict,
+        )
+
+    def resetMetrics(self):
+        """!Reset all metrics, including those of each poll
+        """
+        self.numTicks = 0
+        self.maxPollsPerTick = 0
+        for devInfo in self._devInfoDict.itervalues():
+            for poll in devInfo.pollList:
+                poll.resetMetrics()
+
+    def _tick(self):
+        """!Run the polls that are due, then schedule the next tick
+        """
+        now = self._clock.time()
+        self.numTicks += 1
+        numPolls = 0
+        for devInfo in self._devInfoDict.values():
+            regime = self.getRegime(devInfo.dev, now)
+            dueList = [(poll.baseTime + self.getInterval(poll, regime), poll) for poll in devInfo.pollList]
+            if not any(dueTime <= now for dueTime, poll in dueList):
+                continue
+            for dueTime, poll in dueList:
+                if dueTime <= now + self.coalesceTime:
+                    if self._runPoll(poll, dueTime=dueTime, interval=self.getInterval(poll, regime), now=now):
+                        numPolls += 1
+        self.maxPollsPerTick = max(self.maxPollsPerTick, numPolls)
+        self._schedule(now)
+
+    def _runPoll(self, poll, dueTime, interval, now):
+        """!Send a poll command, unless the device is not connected or the previous poll is running
+
+        @return True if the poll command was sent
+        """
+        poll.jitterStats.add(abs(now - dueTime))
+        # keep to the schedule, unless so late that the next poll would be due already
+        poll.baseTime = dueTime if dueTime + interval > now else now
+        if not poll.dev.isConnected or poll.isRunning:
+            poll.numSkipped += 1
+            return False
+        poll.numSent += 1
+        poll.sendTime = now
+        self._inRunPoll = True
+        try:
+            poll.devCmd = poll.dev.startCmd(poll.cmdStr, timeLim=poll.timeLim)
+        finally:
+            self._inRunPoll = False
+        poll.devCmd.addCallback(functools.partial(self._pollCmdCallback, poll), callNow=True)
+        return True
+
+    def _pollCmdCallback(self, poll, devCmd):
+        """!Callback for poll commands
+        """
+        if not devCmd.isDone:
+            return
+        poll.costStats.add(self._clock.time() - poll.sendTime)
+        if devCmd.didFail:
+            poll.numFailed += 1
+            log.warn("%s: poll %r failed: %s" % (self, poll.name, devCmd.getMsg()))
+        if poll.callFunc:
+            poll.callFunc(devCmd)
+
+    def _schedule(self, now):
+        """!Start the timer for the next poll that is due
+        """
+        nextTime = None
+        for devInfo in self._devInfoDict.itervalues():
+            regime = self.getRegime(devInfo.dev, now)
+            devInfo.regime = regime
+            for poll in devInfo.pollList:
+                dueTime = poll.baseTime + self.getInterval(poll, regime)
+                if nextTime is None or dueTime < nextTime:
+                    nextTime = dueTime
+        if nextTime is None:
+            self._timer.cancel()
+            self._nextTime = None
+        else:
+            self._nextTime = max(now, nextTime)
+            self._timer.start(self._nextTime - now, self._tick)
+
+    def __repr__(self):
+        return "%s(numDevs=%s)" % (type(self).__name__, len(self._devInfoDict))
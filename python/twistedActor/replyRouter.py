@@ -0,0 +1,184 @@
+from __future__ import absolute_import, division, print_function
+"""!Route replies from a device to handler functions using tables, rather than a chain of tests
+"""
+import collections
+import re
+
+__all__ = ["ReplyRouter"]
+
+class ReplyRouter(object):
+    """!Route each reply line from a device to a handler function
+
+    Handlers may be registered by:
+    - prefix: the handler receives lines that start with the prefix; if several prefixes match
+        then only the handler for the longest matching prefix is called.
+        Prefixes are kept in one dict per prefix length, so finding the handler
+        costs one dict lookup per distinct prefix length, regardless of the number of prefixes.
+    - keyword: for lines of the form "key1=value1; key2=value2...", the handler for each keyword
+        receives that keyword's value. Keywords are found with one dict lookup per keyword in the line;
+        case is ignored.
+    - regular expression: the handler receives the match object. Regular expressions are tried in
+        the order registered, so they cost the most; give a literal prefix where possible, so that
+        the expression is only tried on lines that start with that prefix.
+    A line is offered to prefix handlers, then keyword handlers, then regular expression handlers,
+    stopping as soon as any handler is found. Lines that match nothing go to the fallback function.
+
+    Handler arguments:
+    - prefix handler: the reply line
+    - keyword handler: keyword (as registered), value string (stripped, and not unquoted), reply line
+    - regular expression handler: the match object (the reply line is match.string)
+    - fallback function: the reply line
+
+    Attributes for monitoring performance:
+    - hitCountDict: a dict of handler name: number of lines (or keywords) handled
+    - numUnmatched: the number of lines that matched no handler
+    """
+    def __init__(self, fallbackFunc=None):
+        """!Construct a ReplyRouter
+
+        @param[in] fallbackFunc  function to call for lines that match no handler, or None to ignore such lines;
+            it receives one argument: the reply line
+        """
+        self.fallbackFunc = fallbackFunc
+        self._prefixDictList = [] # list of (prefix length, dict of prefix: (name, func, isRegex)), longest first
+        self._keywordDict = {} # dict of lowercase keyword: (name, keyword, func)
+        self._regexList = [] # list of (name, compiled regex, func) for regular expressions with no prefix
+        self.hitCountDict = collections.defaultdict(int)
+        self.numUnmatched = 0
+
+    @property
+    def hasHandlers(self):
+        """!Return True if any handlers or a fallback function have been specified
+        """
+        return bool(self._prefixDictList or self._keywordDict or self._regexList or self.fallbackFunc)
+
+    def addPrefix(self, prefix, func, name=None):
+        """!Add a handler for lines that start with a prefix
+
+        @param[in] prefix  the prefix (a non-empty string); case matters
+        @param[in] func  the handler; it receives one argument: the reply line
+        @param[in] name  name for hitCountDict; if None then "prefix:<prefix>"
+
+        @throw RuntimeError if prefix is empty or already has a handler
+        """
+        if name is None:
+            name = "prefix:%s" % (prefix,)
+        self._addPrefix(prefix, func, name)
+
+    def addKeyword(self, keyword, func, name=None):
+        """!Add a handler for a keyword
+
+        @param[in] keyword  the keyword name; case is ignored
+        @param[in] func  the handler; it receives three arguments: keyword (as registered), value string, reply line
+        @param[in] name  name for hitCountDict; if None then "keyword:<keyword>"
+
+        @throw RuntimeError if keyword already has a handler
+        """
+        if not callable(func):
+            raise RuntimeError("func=%r is not callable" % (func,))
+        lowKeyword = keyword.strip().lower()
+        if not lowKeyword:
+            raise RuntimeError("keyword must not be blank")
+        if lowKeyword in self._keywordDict:
+            raise RuntimeError("keyword %r already has a handler" % (keyword,))
+        if name is None:
+            name = "keyword:%s" % (keyword,)
+        self._keywordDict[lowKeyword] = (name, keyword, func)
+
+    def addRegex(self, regex, func, prefix="", name=None):
+        """!Add a handler for lines that match a regular expression
+
+        @param[in] regex  the regular expression: a compiled regular expression or a string;
+            it is matched (with match, not search) against the whole line
+        @param[in] func  the handler; it receives one argument: the match object
+        @param[in] prefix  a literal prefix of every line the expression can match, or "" if none;
+            if specified then the expression is only tried on lines that start with the prefix
+            (and it takes the place of a prefix handler for that prefix; if it does not match
+            then shorter prefixes are tried)
+        @param[in] name  name for hitCountDict; if None then "regex:<pattern>"
+
+        @throw RuntimeError if prefix is specified and already has a handler
+        """
+        if not callable(func):
+            raise RuntimeError("func=%r is not callable" % (func,))
+        if not hasattr(regex, "match"):
+            regex = re.compile(regex)
+        if name is None:
+            name = "regex:%s" % (regex.pattern,)
+        if prefix:
+            def prefixFunc(replyStr):
+                match = regex.match(replyStr)
+                if match:
+                    func(match)
+                    return True
+                return False
+            self._addPrefix(prefix, prefixFunc, name, isRegex=True)
+        else:
+            self._regexList.append((name, regex, func))
+
+    def dispatch(self, replyStr):
+        """!Call the handler(s) for a reply line, or the fallback function if no handler matches
+
+        @param[in] replyStr  the reply line
+        @return True if a handler (not the fallback function) was called
+        """
+        for prefixLen, prefixDict in self._prefixDictList:
+            handlerInfo = prefixDict.get(replyStr[:prefixLen])
+            if handlerInfo is not None:
+                name, func, isRegex = handlerInfo
+                if isRegex:
+                    if not func(replyStr):
+                        continue # prefix matched but the regular expression did not; try shorter prefixes
+                else:
+                    func(replyStr)
+                self.hitCountDict[name] += 1
+                return True
+
+        if self._keywordDict and "=" in replyStr:
+            didMatch = False
+            for keywordStr in replyStr.split(";"):
+                keyword, sep, valueStr = keywordStr.partition("=")
+                handlerInfo = self._keywordDict.get(keyword.strip().lower())
+                if handlerInfo is not None:
+                    name, regKeyword, func = handlerInfo
+                    func(regKeyword, valueStr.strip(), replyStr)
+                    self.hitCountDict[name] += 1
+                    didMatch = True
+            if didMatch:
+                return True
+
+        for name, regex, func in self._regexList:
+            match = regex.match(replyStr)
+            if match:
+                func(match)
+                self.hitCountDict[name] += 1
+                return True
+
+        self.numUnmatched += 1
+        if self.fallbackFunc is not None:
+            self.fallbackFunc(replyStr)
+        return False
+
+    def _addPrefix(self, prefix, func, name, isRegex=False):
+        """!Add a handler for a prefix; see addPrefix
+        """
+        if not callable(func):
+            raise RuntimeError("func=%r is not callable" % (func,))
+        if not prefix:
+            raise RuntimeError("prefix must not be empty")
+        prefixLen = len(prefix)
+        for dictLen, prefixDict in self._prefixDictList:
+            if dictLen == prefixLen:
+                break
+        else:
+            prefixDict = {}
+            self._prefixDictList.append((prefixLen, prefixDict))
+            self._prefixDictList.sort(key=lambda item: item[0], reverse=True)
+        if prefix in prefixDict:
+            raise RuntimeError("prefix %r already has a handler" % (prefix,))
+        prefixDict[prefix] = (name, func, isRegex)
+
+    def __repr__(self):
+        numPrefixes = sum(len(prefixDict) for prefixLen, prefixDict in self._prefixDictList)
+        return "%s(numPrefixes=%s, numKeywords=%s, numRegexes=%s)" % \
+            (type(self).__name__, numPrefixes, len(self._keywordDict), len(self._regexList))
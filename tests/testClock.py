@@ -0,0 +1,93 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test FakeClock and its use for command time limits
+"""
+import unittest
+
+from twistedActor import FakeClock, UserCmd, getClock, setClock
+
+class TestFakeClock(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(startTime=100)
+        self.callList = []
+
+    def record(self, name):
+        self.callList.append((name, self.clock.time()))
+
+    def testOrder(self):
+        self.clock.Timer(2, self.record, "c")
+        self.clock.Timer(1, self.record, "a")
+        self.clock.Timer(1, self.record, "b")
+        self.clock.Timer(-1, self.record, "now")
+        self.assertEqual(self.clock.numPending, 4)
+        self.assertEqual(self.clock.nextTime, 100)
+        self.assertEqual(self.callList, [])
+        self.assertEqual(self.clock.run(), 4)
+        self.assertEqual(self.callList, [("now", 100), ("a", 101), ("b", 101), ("c", 102)])
+        self.assertEqual(self.clock.numPending, 0)
+        self.assertEqual(self.clock.nextTime, None)
+
+    def testAdvance(self):
+        self.clock.Timer(1, self.record, "a")
+        self.clock.Timer(3, self.record, "b")
+        self.assertEqual(self.clock.advance(2), 1)
+        self.assertEqual(self.clock.time(), 102)
+        self.assertEqual(self.callList, [("a", 101)])
+        self.assertEqual(self.clock.run(maxTime=102.5), 0)
+        self.assertEqual(self.clock.time(), 102.5)
+        self.assertEqual(self.clock.advance(1), 1)
+        self.assertEqual(self.callList, [("a", 101), ("b", 103)])
+
+    def testTimer(self):
+        timer = self.clock.Timer()
+        self.assertFalse(timer.isActive)
+        timer.start(1, self.record, "a")
+        self.assertTrue(timer.isActive)
+        timer.start(2, self.record, "b")
+        self.assertEqual(self.clock.numPending, 1)
+        self.assertTrue(timer.cancel())
+        self.assertFalse(timer.cancel())
+        self.assertEqual(self.clock.numPending, 0)
+        timer.start(3, self.record, "c")
+        self.clock.run()
+        self.assertFalse(timer.isActive)
+        self.assertEqual(self.callList, [("c", 103)])
+
+    def testChained(self):
+        """A timer that starts another timer"""
+        def chain(n):
+            self.record(n)
+            if n > 0:
+                self.clock.Timer(0.5, chain, n - 1)
+        self.clock.Timer(0, chain, 3)
+        self.assertEqual(self.clock.run(), 4)
+        self.assertEqual(self.callList, [(3, 100), (2, 100.5), (1, 101), (0, 101.5)])
+
+    def testManyCancelled(self):
+        timerList = [self.clock.Timer(i, self.record, i) for i in range(1000)]
+        for timer in timerList[:-1]:
+            timer.cancel()
+        self.clock.Timer(1, self.record, "new")
+        self.assertEqual(self.clock.numPending, 2)
+        self.assertLess(len(self.clock._heap), 100)
+        self.clock.run()
+        self.assertEqual(self.callList, [("new", 101), (999, 1099)])
+
+    def testCmdTimeLimit(self):
+        prevClock = setClock(self.clock)
+        try:
+            self.assertIs(getClock(), self.clock)
+            cmd = UserCmd(cmdStr="1 status", timeLim=5)
+            cmd.setState(cmd.Running)
+            self.clock.advance(4.9)
+            self.assertFalse(cmd.isDone)
+            self.clock.advance(0.2)
+            self.assertTrue(cmd.didFail)
+            self.assertIn("Timed out", cmd.textMsg)
+        finally:
+            setClock(prevClock)
+        self.assertIsNot(getClock(), self.clock)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test CmdCoalescer
+"""
+import unittest
+
+from twistedActor import CmdCoalescer, DevCmd, FakeClock, UserCmd, setClock
+
+class TestCmdCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.prevClock = setClock(self.clock)
+        self.coalescer = CmdCoalescer(verbs=["status", "Query"], cacheTime=100)
+
+    def tearDown(self):
+        setClock(self.prevClock)
+
+    def testNotIdempotent(self):
+        for cmdStr in ("move 5", "", "statusx"):
+            self.assertFalse(self.coalescer.attach(DevCmd(cmdStr)))
+            self.assertFalse(self.coalescer.attach(DevCmd(cmdStr)))
+        self.assertEqual(self.coalescer.numSent, 0)
+
+    def testCoalesce(self):
+        firstCmd = DevCmd("status")
+        self.assertFalse(self.coalescer.attach(firstCmd))
+        userCmd = UserCmd(cmdStr="1 status")
+        secondCmd = DevCmd("status", userCmd=userCmd)
+        self.assertTrue(self.coalescer.attach(secondCmd))
+        otherCmd = DevCmd("query 1")
+        self.assertFalse(self.coalescer.attach(otherCmd))
+        self.assertEqual((self.coalescer.numSent, self.coalescer.numCoalesced), (2, 1))
+
+        firstCmd.setState(firstCmd.Running)
+        self.assertEqual(secondCmd.state, secondCmd.Running)
+        firstCmd.setState(firstCmd.Done, hubMsg="status=ok")
+        self.assertEqual(secondCmd.state, secondCmd.Done)
+        self.assertEqual(secondCmd.hubMsg, "status=ok")
+        self.assertEqual(userCmd.state, userCmd.Done)
+
+    def testCache(self):
+        firstCmd = DevCmd("status")
+        self.assertFalse(self.coalescer.attach(firstCmd))
+        firstCmd.setState(firstCmd.Done, textMsg="ok")
+        cachedCmd = DevCmd("status")
+        self.assertTrue(self.coalescer.attach(cachedCmd))
+        self.assertEqual(cachedCmd.state, cachedCmd.Done)
+        self.assertEqual(cachedCmd.textMsg, "ok")
+        self.assertEqual(self.coalescer.numCacheHits, 1)
+
+    def testNoCacheForUserCmd(self):
+        """A command started for a user is sent, so the user sees the device's replies
+        """
+        firstCmd = DevCmd("status")
+        self.coalescer.attach(firstCmd)
+        firstCmd.setState(firstCmd.Done, textMsg="ok")
+        userCmd = UserCmd(cmdStr="1 status")
+        userDevCmd = DevCmd("status", userCmd=userCmd)
+        self.assertFalse(self.coalescer.attach(userDevCmd))
+        self.assertEqual(userDevCmd.state, userDevCmd.Ready)
+        self.assertEqual((self.coalescer.numSent, self.coalescer.numCacheHits), (2, 0))
+
+        # the user command's result is cached for commands that have no user command
+        userDevCmd.setState(userDevCmd.Done, textMsg="ok again")
+        cachedCmd = DevCmd("status")
+        self.assertTrue(self.coalescer.attach(cachedCmd))
+        self.assertEqual(cachedCmd.textMsg, "ok again")
+
+    def testNoCacheOnFailure(self):
+        firstCmd = DevCmd("status")
+        self.coalescer.attach(firstCmd)
+        firstCmd.setState(firstCmd.Failed, textMsg="broken")
+        self.assertFalse(self.coalescer.attach(DevCmd("status")))
+        self.assertEqual(self.coalescer.numCacheHits, 0)
+
+    def testCacheExpires(self):
+        coalescer = CmdCoalescer(verbs=["status"], cacheTime=10)
+        firstCmd = DevCmd("status")
+        coalescer.attach(firstCmd)
+        firstCmd.setState(firstCmd.Done)
+        self.clock.advance(10)
+        self.assertTrue(coalescer.attach(DevCmd("status")))
+        self.clock.advance(0.001)
+        self.assertFalse(coalescer.attach(DevCmd("status")))
+        self.assertEqual((coalescer.numSent, coalescer.numCacheHits), (2, 1))
+
+    def testClear(self):
+        firstCmd = DevCmd("status")
+        self.coalescer.attach(firstCmd)
+        self.coalescer.clear()
+        self.assertFalse(self.coalescer.attach(DevCmd("status")))
+
+
+if __name__ == "__main__":
+    unittest.main()
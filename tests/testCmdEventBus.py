@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test CmdEventBus
+"""
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import Deferred
+
+from RO.Comm.TwistedTimer import Timer
+
+from twistedActor import CmdEventBus, UserCmd, cmdEventBus
+
+class TestCmdEventBus(TestCase):
+    def setUp(self):
+        self.batchList = []
+        self.moveBatchList = []
+
+    def tearDown(self):
+        cmdEventBus.unsubscribe(self.allCallback)
+        cmdEventBus.unsubscribe(self.moveCallback)
+
+    def allCallback(self, eventList):
+        self.batchList.append(eventList)
+
+    def moveCallback(self, eventList):
+        self.moveBatchList.append(eventList)
+
+    def makeCmd(self, cmdVerb, userID=0):
+        cmd = UserCmd(userID=userID, cmdStr=cmdVerb)
+        cmd.cmdVerb = cmdVerb
+        return cmd
+
+    def testBatches(self):
+        cmdEventBus.subscribe(self.allCallback)
+        cmdEventBus.subscribe(self.moveCallback, verbs=["Move"], userIDs=[1])
+        cmdList = [self.makeCmd("move", userID=1), self.makeCmd("move", userID=2), self.makeCmd("status", userID=1)]
+        for cmd in cmdList:
+            cmd.setState(cmd.Running)
+        for cmd in cmdList:
+            cmd.setState(cmd.Done, textMsg="finished")
+        # nothing is delivered until the next reactor iteration
+        self.assertEqual(self.batchList, [])
+
+        d = Deferred()
+        def checkResults():
+            self.assertEqual(len(self.batchList), 1)
+            eventList = self.batchList[0]
+            self.assertEqual([(event.cmd, event.state) for event in eventList],
+                [(cmd, "running") for cmd in cmdList] + [(cmd, "done") for cmd in cmdList])
+            self.assertEqual(eventList[-1].textMsg, "finished")
+            self.assertEqual(eventList[0].textMsg, "")
+
+            self.assertEqual(len(self.moveBatchList), 1)
+            self.assertEqual([(event.cmd, event.state) for event in self.moveBatchList[0]],
+                [(cmdList[0], "running"), (cmdList[0], "done")])
+            d.callback("done")
+        Timer(0.01, checkResults)
+        return d
+
+    def testInactive(self):
+        bus = CmdEventBus()
+        self.assertFalse(bus.isActive)
+        bus.publish(self.makeCmd("move"))
+        bus.flush()
+        bus.subscribe(self.allCallback)
+        self.assertTrue(bus.isActive)
+        bus.publish(self.makeCmd("move"))
+        self.assertTrue(bus.unsubscribe(self.allCallback))
+        self.assertFalse(bus.unsubscribe(self.allCallback))
+        self.assertFalse(bus.isActive)
+        bus.flush()
+        self.assertEqual(self.batchList, [])
@@ -0,0 +1,80 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test parseCmdHeader against the reference regular expression UserCmd._HeaderBodyRE
+"""
+import random
+import unittest
+
+from twistedActor import CommandError, UserCmd, parseCmdHeader, parseCmdHeaderList
+
+def refParseCmdHeader(cmdStr):
+    """Reference implementation of parseCmdHeader, using UserCmd._HeaderBodyRE
+
+    Return None if cmdStr cannot be parsed
+    """
+    cmdMatch = UserCmd._HeaderBodyRE.match(cmdStr)
+    if not cmdMatch:
+        return None
+    cmdDict = cmdMatch.groupdict("")
+    cmdID = int(cmdDict["cmdID"]) if cmdDict["cmdID"] else 0
+    cmdBody = cmdDict.get("cmdBody", "")
+    cmdVerb = ""
+    cmdArgs = ""
+    if cmdBody:
+        res = cmdBody.split(None, 1)
+        if len(res) > 1:
+            cmdVerb, cmdArgs = res
+        else:
+            cmdVerb = res[0]
+        cmdVerb = cmdVerb.lower()
+    return (cmdID, cmdBody, cmdVerb, cmdArgs)
+
+class TestCmdHeader(unittest.TestCase):
+    def checkCmdStr(self, cmdStr):
+        refResult = refParseCmdHeader(cmdStr)
+        try:
+            result = parseCmdHeader(cmdStr)
+        except CommandError:
+            self.assertEqual(refResult, None, "cmdStr=%r" % (cmdStr,))
+        else:
+            self.assertEqual(refResult, (result[0],) + result[2:], "cmdStr=%r" % (cmdStr,))
+
+    def testExamples(self):
+        for cmdStr in (
+            "", "\n", " ", "12", "12 ", "12 34", "12 34 ", "12 34 56 move", "12 move", "12 34 Move 5 6  ",
+            "12\t34\tmove\t5", "move", "MOVE  5", "_x", "5x", " move", "12 34x move", "move\n", "move\nfoo",
+            "12 34 move 5\n", "12 34\n", "12  move\r", "-1 move", "12 -move", "12 34 move\n\n",
+        ):
+            self.checkCmdStr(cmdStr)
+
+    def testRandom(self):
+        """Property-based test: compare with the reference implementation on random strings
+        """
+        rand = random.Random(123)
+        charList = list("0129 \t\n\r\f\vaZ_-.=\"")
+        for i in range(20000):
+            cmdStr = "".join(rand.choice(charList) for j in range(rand.randint(0, 12)))
+            self.checkCmdStr(cmdStr)
+
+    def testSecondID(self):
+        self.assertEqual(parseCmdHeader("12 34 move 5"), (12, 34, "move 5", "move", "5"))
+        self.assertEqual(parseCmdHeader("12 move 5"), (12, None, "move 5", "move", "5"))
+
+    def testUserCmd(self):
+        userCmd = UserCmd(cmdStr="5 3 Move 1 2")
+        self.assertEqual(userCmd.cmdID, 5)
+        self.assertEqual(userCmd.cmdBody, "Move 1 2")
+        self.assertEqual(userCmd.bodyVerb, "move")
+        self.assertEqual(userCmd.bodyArgs, "1 2")
+        self.assertRaises(CommandError, UserCmd, cmdStr="5 3")
+
+    def testList(self):
+        self.assertEqual(parseCmdHeaderList(["1 a", " bad", "b c"]), [
+            (1, None, "a", "a", ""),
+            None,
+            (0, None, "b c", "b", "c"),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test CmdWindow, using a fake controller with artificial latency
+"""
+import collections
+import unittest
+
+from twistedActor import CmdWindow, DevCmd, FakeClock, setClock
+
+class FakeController(object):
+    """A fake device controller that works on up to parallelism commands at once, each taking latency seconds
+
+    Commands beyond parallelism wait in the controller's input buffer.
+    """
+    def __init__(self, clock, latency, parallelism):
+        self.clock = clock
+        self.latency = latency
+        self.parallelism = parallelism
+        self.backlog = collections.deque()
+        self.numBusy = 0
+        self.numWritten = 0
+        self.maxNumUnfinished = 0 # maximum number of commands written and not finished
+        self.writtenList = []
+        self.failWrites = False
+
+    def writeCmd(self, devCmd):
+        if self.failWrites:
+            devCmd.setState(devCmd.Failed, textMsg="write failed")
+            return
+        self.numWritten += 1
+        self.writtenList.append(devCmd.cmdStr)
+        self.backlog.append(devCmd)
+        self.maxNumUnfinished = max(self.maxNumUnfinished, self.numBusy + len(self.backlog))
+        self._startNext()
+
+    def _startNext(self):
+        while self.backlog and self.numBusy < self.parallelism:
+            devCmd = self.backlog.popleft()
+            self.numBusy += 1
+            self.clock.Timer(self.latency, self._finish, devCmd)
+
+    def _finish(self, devCmd):
+        self.numBusy -= 1
+        if not devCmd.isDone:
+            devCmd.setState(devCmd.Done)
+        self._startNext()
+
+
+class TestCmdWindow(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.prevClock = setClock(self.clock)
+
+    def tearDown(self):
+        setClock(self.prevClock)
+
+    def runCmds(self, numCmds, maxOutstanding, latency=0.05, parallelism=8, timeLim=None):
+        """Send commands through a CmdWindow to a FakeController and run them
+
+        Return (CmdWindow, FakeController, list of commands)
+        """
+        controller = FakeController(self.clock, latency=latency, parallelism=parallelism)
+        cmdWindow = CmdWindow(writeFunc=controller.writeCmd, maxOutstanding=maxOutstanding)
+        cmdList = [DevCmd("cmd %d" % (i,), timeLim=timeLim) for i in range(numCmds)]
+        for devCmd in cmdList:
+            cmdWindow.send(devCmd)
+        self.clock.run()
+        return cmdWindow, controller, cmdList
+
+    def testWindow(self):
+        cmdWindow, controller, cmdList = self.runCmds(20, maxOutstanding=3)
+        self.assertTrue(all(devCmd.didFail is False and devCmd.isDone for devCmd in cmdList))
+        self.assertEqual(controller.maxNumUnfinished, 3)
+        self.assertEqual(controller.writtenList, [devCmd.cmdStr for devCmd in cmdList])
+        self.assertEqual((cmdWindow.numSent, cmdWindow.numDeferred, cmdWindow.maxNumQueued), (20, 17, 17))
+        self.assertEqual((cmdWindow.numOutstanding, cmdWindow.numQueued), (0, 0))
+
+    def testQueued(self):
+        controller = FakeController(self.clock, latency=1, parallelism=1)
+        cmdWindow = CmdWindow(writeFunc=controller.writeCmd, maxOutstanding=2)
+        cmdList = [DevCmd("cmd %d" % (i,)) for i in range(3)]
+        for devCmd in cmdList:
+            cmdWindow.send(devCmd)
+        self.assertEqual((cmdWindow.numOutstanding, cmdWindow.numQueued), (2, 1))
+        self.assertEqual(controller.writtenList, ["cmd 0", "cmd 1"])
+        self.assertEqual(cmdList[2].state, DevCmd.Running)
+
+    def testThroughput(self):
+        numCmds = 200
+        rateDict = dict()
+        for maxOutstanding in (1, 4, 8):
+            startTime = self.clock.time()
+            self.runCmds(numCmds, maxOutstanding=maxOutstanding, latency=0.05, parallelism=8)
+            rateDict[maxOutstanding] = numCmds / (self.clock.time() - startTime)
+        self.assertAlmostEqual(rateDict[1], 20)
+        self.assertAlmostEqual(rateDict[8], 160)
+
+    def testTimeout(self):
+        # the controller takes 1 sec per command, one at a time; cmd 0 succeeds,
+        # cmd 1 times out while outstanding (freeing the window for cmd 3), cmd 2 times out while queued
+        controller = FakeController(self.clock, latency=1, parallelism=1)
+        cmdWindow = CmdWindow(writeFunc=controller.writeCmd, maxOutstanding=1)
+        cmdList = [DevCmd("cmd %d" % (i,), timeLim=timeLim) for i, timeLim in enumerate((None, 1.5, 0.5, None))]
+        for devCmd in cmdList:
+            cmdWindow.send(devCmd)
+        self.clock.run()
+        self.assertEqual([devCmd.didFail for devCmd in cmdList], [False, True, True, False])
+        self.assertEqual(controller.writtenList, ["cmd 0", "cmd 1", "cmd 3"])
+        self.assertEqual(cmdList[2].textMsg, "Timed out")
+        # the controller finishes working on cmd 1 (at 2 sec) before starting cmd 3
+        self.assertEqual(self.clock.time(), 3)
+        self.assertEqual((cmdWindow.numOutstanding, cmdWindow.numQueued), (0, 0))
+
+    def testWriteFails(self):
+        controller = FakeController(self.clock, latency=1, parallelism=1)
+        controller.failWrites = True
+        cmdWindow = CmdWindow(writeFunc=controller.writeCmd, maxOutstanding=1)
+        cmdList = [DevCmd("cmd %d" % (i,)) for i in range(3)]
+        for devCmd in cmdList:
+            cmdWindow.send(devCmd)
+        self.assertTrue(all(devCmd.didFail for devCmd in cmdList))
+        self.assertEqual((cmdWindow.numOutstanding, cmdWindow.numQueued), (0, 0))
+
+    def testClear(self):
+        controller = FakeController(self.clock, latency=1, parallelism=1)
+        cmdWindow = CmdWindow(writeFunc=controller.writeCmd, maxOutstanding=1)
+        cmdList = [DevCmd("cmd %d" % (i,)) for i in range(3)]
+        for devCmd in cmdList:
+            cmdWindow.send(devCmd)
+        # cmd 0 is outstanding and the others are queued; all fail
+        cmdWindow.clear(textMsg="not connected")
+        self.assertTrue(all(devCmd.didFail for devCmd in cmdList))
+        self.assertEqual([devCmd.textMsg for devCmd in cmdList], ["not connected"]*3)
+        self.assertEqual((cmdWindow.numOutstanding, cmdWindow.numQueued), (0, 0))
+        self.clock.run()
+        self.assertEqual(controller.writtenList, ["cmd 0"])
+
+    def testBadArgs(self):
+        self.assertRaises(RuntimeError, CmdWindow, writeFunc=None)
+        self.assertRaises(RuntimeError, CmdWindow, writeFunc=lambda devCmd: None, maxOutstanding=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test BaseCmd.getDeferred, callAfterCmdCallbacks and DevCmd command IDs
+"""
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from RO.Comm.TwistedTimer import Timer
+
+from twistedActor import BaseCmd, DevCmd, callAfterCmdCallbacks
+
+class IDSource(object):
+    """Minimal stand-in for a Device, for testing DevCmd.locCmdID
+    """
+    def __init__(self):
+        self.nextID = 0
+
+    def nextLocCmdID(self):
+        self.nextID += 1
+        return self.nextID
+
+class TestCommand(TestCase):
+    @inlineCallbacks
+    def testGetDeferred(self):
+        cmd = BaseCmd("foo")
+        Timer(0.01, cmd.setState, cmd.Running)
+        Timer(0.02, cmd.setState, cmd.Failed, "broken")
+        doneCmd = yield cmd.getDeferred()
+        self.assertTrue(doneCmd is cmd)
+        self.assertTrue(cmd.didFail)
+
+        # a command that is already done fires at once
+        doneCmd = yield cmd.getDeferred()
+        self.assertTrue(doneCmd is cmd)
+
+    def testCallAfterCmdCallbacks(self):
+        callList = []
+        callAfterCmdCallbacks(callList.append, "now")
+        self.assertEqual(callList, ["now"])
+
+        cmd1 = BaseCmd("cmd1")
+        cmd2 = BaseCmd("cmd2")
+        def cmd1Callback(cmd):
+            callAfterCmdCallbacks(callList.append, "postponed")
+            cmd2.setState(cmd2.Done)
+            callList.append("cmd1 callback done")
+        def cmd2Callback(cmd):
+            callAfterCmdCallbacks(callList.append, "postponed nested")
+            callList.append("cmd2 callback done")
+        cmd1.addCallback(cmd1Callback)
+        cmd2.addCallback(cmd2Callback)
+        cmd1.setState(cmd1.Done)
+        self.assertEqual(callList,
+            ["now", "cmd2 callback done", "cmd1 callback done", "postponed", "postponed nested"])
+
+    def testNoDeepRecursion(self):
+        """Functions postponed while draining are run by the same loop, not recursively
+        """
+        cmdList = [BaseCmd("cmd%d" % (i,)) for i in range(5000)]
+        def finishNext(ind):
+            if ind < len(cmdList):
+                cmdList[ind].setState(BaseCmd.Done)
+        for ind, cmd in enumerate(cmdList):
+            cmd.addCallback(lambda cmd, ind=ind: callAfterCmdCallbacks(finishNext, ind + 1))
+        cmdList[0].setState(BaseCmd.Done)
+        self.assertTrue(all(cmd.isDone for cmd in cmdList))
+
+    def testLocCmdID(self):
+        dev1 = IDSource()
+        dev2 = IDSource()
+        self.assertEqual([DevCmd("a", dev=dev1).locCmdID for i in range(3)], [1, 2, 3])
+        self.assertEqual(DevCmd("a", dev=dev2).locCmdID, 1)
+        # commands without a device use a process-wide sequence of IDs
+        idList = [DevCmd("a").locCmdID for i in range(3)]
+        self.assertEqual(idList, range(idList[0], idList[0] + 3))
@@ -1,12 +1,14 @@
 #!/usr/bin/env python2
 from __future__ import division, absolute_import
 
+import random
+
 from twisted.trial import unittest
 from twisted.internet.defer import Deferred, gatherResults
 
 from RO.Comm.TwistedTimer import Timer
 
-from twistedActor import CommandQueue, UserCmd, testUtils
+from twistedActor import BaseCmd, CommandQueue, FakeClock, UserCmd, setClock, testUtils
 
 testUtils.init(__file__)
 
@@ -393,6 +395,700 @@ class CmdQueueTest(unittest.TestCase):
         self.addCmdsToQueue(cmdsIn)
         return self.deferred
 
+    def testCompiledRules(self):
+        # the compiled rule matrix must give the same rules as examining ruleDict
+        self.cmdQueue.addRule(CommandQueue.CancelQueued, newCmds=['medb'], queuedCmds='all')
+        self.cmdQueue.addRule(CommandQueue.CancelNew, newCmds=['medb'], queuedCmds=['meda'])
+        self.cmdQueue.addRule(CommandQueue.CancelQueued, newCmds='all', queuedCmds=['lowa'])
+        self.cmdQueue.addRule(CommandQueue.CancelNew, newCmds=['hia', 'hib'], queuedCmds=['hia'])
+        verbList = list(cmdPriorityDict) + ['randomCmd', 'otherCmd']
+        for newVerb in verbList:
+            for queuedVerb in verbList:
+                self.assertEqual(
+                    self.cmdQueue.getRule(newVerb, queuedVerb),
+                    self.cmdQueue._resolveRule(newVerb, queuedVerb),
+                )
+        self.assertEqual(self.cmdQueue.getRule('randomCmd', 'randomCmd'), CommandQueue.CancelQueued)
+        self.assertEqual(self.cmdQueue.getRule('randomCmd', 'otherCmd'), None)
+
+        # a rule that conflicts with the rule for medb vs. all queued commands is rejected
+        # and leaves the rules unchanged
+        self.assertRaises(RuntimeError, self.cmdQueue.addRule, CommandQueue.KillRunning, newCmds='all', queuedCmds=['medb'])
+        self.assertEqual(self.cmdQueue.getRule('lowb', 'medb'), None)
+        self.assertEqual(self.cmdQueue.getRule('medb', 'medb'), CommandQueue.CancelQueued)
+
+    def testCancelQueuedSeveralVerbs(self):
+        # queue everything before the queue runs; commands are cancelled in the order queued
+        cmdsIn = ['lowa', 'hia', 'meda', 'lowb', 'lowa', 'meda', 'medb']
+        self.cmdQueue.addRule(
+            action = CommandQueue.CancelQueued,
+            newCmds = ['medb'],
+            queuedCmds = ['meda', 'lowa'],
+        )
+        for cmdStr in cmdsIn:
+            self.addToQueue(cmdStr)
+        self.assertEqual(self.failOrder, ['lowa', 'meda', 'lowa', 'meda'])
+        self.assertEqual(len(self.cmdQueue), 3)
+        def checkResults(cb):
+            self.assertEqual(['hia', 'medb', 'lowb'], self.doneOrder)
+        self.deferred.addCallback(checkResults)
+        return self.deferred
+
+    def testFifoWithinPriority(self):
+        # queue everything before the queue runs, so only the sort order matters
+        cmdsIn = ['lowa', 'hia', 'lowb', 'meda', 'hib', 'lowa', 'medb', 'hia']
+        cmdsOut = ['hia', 'hib', 'hia', 'meda', 'medb', 'lowa', 'lowb', 'lowa']
+        for cmdStr in cmdsIn:
+            self.addToQueue(cmdStr)
+        self.assertEqual(len(self.cmdQueue), len(cmdsIn))
+        self.assertEqual([qc.cmdVerb for qc in reversed(self.cmdQueue.cmdQueue)], cmdsOut)
+        def checkResults(cb):
+            self.assertEqual(cmdsOut, self.doneOrder)
+        self.deferred.addCallback(checkResults)
+        return self.deferred
+
+
+class CmdQueueConcurrencyTest(unittest.TestCase):
+    """Test CommandQueue with resourceDict, including a mixed workload, in virtual time
+    """
+    priorityDict = {
+        'move': 2,
+        'focus': 2,
+        'init': 2,
+        'status': 1,
+    }
+    resourceDict = {
+        'move': ['axes'],
+        'focus': ['focus'],
+        'status': [],
+    } # init is not listed, so it needs exclusive access
+    durationDict = {
+        'move': 0.05,
+        'focus': 0.05,
+        'init': 0.02,
+        'status': 0.01,
+    }
+
+    def runWorkload(self, cmdVerbList, resourceDict, maxRunning=None):
+        """Queue commands with the specified verbs and run them in virtual time, using FakeClock
+
+        Return (elapsed time, list of (cmdVerb, start time, end time)),
+        with the intervals in the order the commands finished
+        """
+        clock = FakeClock()
+        cmdQueue = CommandQueue(priorityDict=self.priorityDict, resourceDict=resourceDict, maxRunning=maxRunning,
+            clock=clock)
+        intervalList = []
+        self.maxNumRunning = 0
+
+        def runFunc(cmd):
+            startTime = clock.time()
+            self.maxNumRunning = max(self.maxNumRunning, len(cmdQueue.runningCmds))
+            def finish():
+                intervalList.append((cmd.cmdVerb, startTime, clock.time()))
+                cmd.setState(cmd.Done)
+            clock.Timer(self.durationDict[cmd.cmdVerb], finish)
+
+        for i, cmdVerb in enumerate(cmdVerbList):
+            cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+            cmd.cmdVerb = cmdVerb
+            cmdQueue.addCmd(cmd, runFunc)
+        clock.run()
+        self.assertEqual(len(intervalList), len(cmdVerbList))
+        return clock.time(), intervalList
+
+    def conflicts(self, cmdVerb1, cmdVerb2):
+        resources1 = self.resourceDict.get(cmdVerb1)
+        resources2 = self.resourceDict.get(cmdVerb2)
+        if resources1 is None or resources2 is None:
+            return True
+        return bool(set(resources1) & set(resources2))
+
+    def checkNoConflicts(self, intervalList):
+        for i, (cmdVerb1, start1, end1) in enumerate(intervalList):
+            for cmdVerb2, start2, end2 in intervalList[i+1:]:
+                if self.conflicts(cmdVerb1, cmdVerb2):
+                    self.assertTrue(end1 <= start2 or end2 <= start1,
+                        "%s and %s overlap" % (cmdVerb1, cmdVerb2))
+
+    def testSerialByDefault(self):
+        cmdVerbList = ['move', 'status', 'focus', 'status']
+        elapsedTime, intervalList = self.runWorkload(cmdVerbList, resourceDict=None)
+        self.assertEqual(self.maxNumRunning, 1)
+        self.assertEqual([ivl[0] for ivl in intervalList], ['move', 'focus', 'status', 'status'])
+
+    def testExclusive(self):
+        # init needs exclusive access: it waits for running commands,
+        # and commands of lower priority or queued after it wait for it
+        cmdVerbList = ['move', 'status', 'init', 'status', 'focus']
+        elapsedTime, intervalList = self.runWorkload(cmdVerbList, resourceDict=self.resourceDict)
+        self.checkNoConflicts(intervalList)
+        verbList = [ivl[0] for ivl in intervalList]
+        self.assertEqual(verbList[0:2], ['move', 'init'])
+
+    def testMaxRunning(self):
+        cmdVerbList = ['status']*10
+        self.runWorkload(cmdVerbList, resourceDict=self.resourceDict, maxRunning=3)
+        self.assertEqual(self.maxNumRunning, 3)
+
+    def testMixedWorkload(self):
+        # a mix of long moves and focus changes (which use different resources) and many status requests
+        cmdVerbList = ['move', 'focus', 'status', 'status', 'move', 'status', 'focus', 'status']*3
+        serialTime = self.runWorkload(cmdVerbList, resourceDict=None)[0]
+        concurrentTime, intervalList = self.runWorkload(cmdVerbList, resourceDict=self.resourceDict)
+        self.checkNoConflicts(intervalList)
+        # serially the commands take the sum of their durations; concurrently, moves run alongside
+        # focus changes and status requests run alongside both, so only the 6 moves add up
+        self.assertAlmostEqual(serialTime, 6*0.05 + 6*0.05 + 12*0.01)
+        self.assertAlmostEqual(concurrentTime, 6*0.05)
+        for cmdVerb, start, end in intervalList:
+            if cmdVerb == 'move':
+                self.assertTrue(any(otherVerb == 'focus' and otherStart < end and start < otherEnd
+                    for otherVerb, otherStart, otherEnd in intervalList), "no focus overlaps a move")
+
+
+class CmdQueueDeadlineTest(unittest.TestCase):
+    """Test deadline-aware scheduling in CommandQueue, and compare deadline misses with and without it,
+    in virtual time
+    """
+    def runWorkload(self, cmdInfoList, useDeadlines):
+        """Queue commands and run them in virtual time, using FakeClock
+
+        @param[in] cmdInfoList  list of (cmdVerb, duration, queueTimeLim)
+        Return (CommandQueue, list of commands in the order they finished)
+        """
+        clock = FakeClock()
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, useDeadlines=useDeadlines, clock=clock)
+        doneList = []
+        def cmdCallback(cmd):
+            if cmd.isDone:
+                doneList.append(cmd)
+        def runFunc(cmd):
+            clock.Timer(cmd.duration, self.setDone, cmd)
+        for i, (cmdVerb, duration, queueTimeLim) in enumerate(cmdInfoList):
+            cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+            cmd.cmdVerb = cmdVerb
+            cmd.duration = duration
+            cmd.queueTimeLim = queueTimeLim
+            cmd.addCallback(cmdCallback)
+            cmdQueue.addCmd(cmd, runFunc, queueTimeLim=queueTimeLim)
+        clock.run()
+        self.assertEqual(len(doneList), len(cmdInfoList))
+        return cmdQueue, doneList
+
+    def setDone(self, cmd):
+        if not cmd.isDone:
+            cmd.setState(cmd.Done)
+
+    def testDeadlineOrder(self):
+        # three long commands with no deadline, then short commands with tight and loose deadlines;
+        # all have the same priority
+        cmdInfoList = [
+            ('meda', 0.05, None),
+            ('meda', 0.05, None),
+            ('meda', 0.05, None),
+            ('medb', 0.01, 1.0),
+            ('medb', 0.01, 0.1),
+        ]
+        fifoQueue, fifoDoneList = self.runWorkload(cmdInfoList, useDeadlines=False)
+        edfQueue, edfDoneList = self.runWorkload(cmdInfoList, useDeadlines=True)
+        self.assertEqual([cmd.queueTimeLim for cmd in edfDoneList], [0.1, 1.0, None, None, None])
+        self.assertEqual((fifoQueue.numDeadlineMet, fifoQueue.numDeadlineMissed), (1, 1))
+        self.assertEqual((edfQueue.numDeadlineMet, edfQueue.numDeadlineMissed), (2, 0))
+        self.assertFalse(any(cmd.didFail for cmd in edfDoneList))
+
+    def testExpire(self):
+        # a higher priority command runs for longer than the deadline of a queued command
+        cmdInfoList = [
+            ('hia', 0.1, None),
+            ('lowa', 0.01, 0.05),
+            ('lowb', 0.01, 1.0),
+        ]
+        cmdQueue, doneList = self.runWorkload(cmdInfoList, useDeadlines=True)
+        self.assertEqual([cmd.cmdVerb for cmd in doneList], ['lowa', 'hia', 'lowb'])
+        self.assertTrue(doneList[0].didFail)
+        self.assertIn("Deadline passed", doneList[0].textMsg)
+        self.assertEqual(cmdQueue.numExpired, 1)
+        self.assertEqual(cmdQueue.numDeadlineMet, 1)
+
+    def testTimeLimNotDeadline(self):
+        # a command's own time limit only starts when it runs, so it does not give the command a deadline
+        clock = FakeClock()
+        prevClock = setClock(clock)
+        try:
+            cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, useDeadlines=True, clock=clock)
+            cmdList = []
+            for cmdVerb in ('hia', 'lowa'):
+                cmd = UserCmd(userID=0, cmdStr=cmdVerb, timeLim=0.05)
+                cmd.cmdVerb = cmdVerb
+                cmdQueue.addCmd(cmd, lambda cmd: clock.Timer(0.04, self.setDone, cmd))
+                cmdList.append(cmd)
+            clock.run()
+        finally:
+            setClock(prevClock)
+        self.assertFalse(any(cmd.didFail for cmd in cmdList))
+        self.assertEqual((cmdQueue.numExpired, cmdQueue.numDeadlineMet, cmdQueue.numDeadlineMissed), (0, 0, 0))
+
+
+class CmdQueueAgingTest(unittest.TestCase):
+    """Test priority aging in CommandQueue, in virtual time
+    """
+    def runWorkload(self, cmdVerbList, agingDict):
+        """Queue commands that each run for 0.01 sec and run them in virtual time, using FakeClock
+
+        Return (CommandQueue, list of (command verb, start time) in the order run)
+        """
+        clock = FakeClock()
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, agingDict=agingDict, clock=clock)
+        runList = []
+        def runFunc(cmd):
+            runList.append((cmd.cmdVerb, clock.time()))
+            clock.Timer(0.01, cmd.setState, cmd.Done)
+        for i, cmdVerb in enumerate(cmdVerbList):
+            cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+            cmd.cmdVerb = cmdVerb
+            cmdQueue.addCmd(cmd, runFunc)
+        clock.run()
+        self.assertEqual(len(runList), len(cmdVerbList))
+        return cmdQueue, runList
+
+    def testNoAging(self):
+        cmdVerbList = ['lowa'] + ['hia']*10
+        cmdQueue, runList = self.runWorkload(cmdVerbList, agingDict=None)
+        self.assertEqual([cmdVerb for cmdVerb, startTime in runList], ['hia']*10 + ['lowa'])
+
+    def testAging(self):
+        # lowa starts at priority 1 and rises by 100/sec, so after two hia commands (0.02 sec) it reaches
+        # priority 3; it was queued before the hia commands, so it runs next; lowb does not age, so it runs last
+        cmdVerbList = ['lowa', 'lowb'] + ['hia']*10
+        cmdQueue, runList = self.runWorkload(cmdVerbList, agingDict={'lowa': (100, None)})
+        self.assertEqual([cmdVerb for cmdVerb, startTime in runList], ['hia']*2 + ['lowa'] + ['hia']*8 + ['lowb'])
+        self.assertAlmostEqual(runList[2][1], 0.02)
+        waitTimeStats = cmdQueue.getWaitTimeStats()
+        self.assertEqual(sorted(waitTimeStats), [1, 3])
+        self.assertEqual(waitTimeStats[3]["num"], 10)
+        self.assertLessEqual(waitTimeStats[3][50], waitTimeStats[3][90])
+
+    def testMaxPriority(self):
+        # lowa may not rise above priority 2, so it never overtakes hia
+        cmdVerbList = ['lowa'] + ['hia']*5 + ['meda']
+        cmdQueue, runList = self.runWorkload(cmdVerbList, agingDict={'lowa': (100, 2)})
+        self.assertEqual([cmdVerb for cmdVerb, startTime in runList], ['hia']*5 + ['lowa', 'meda'])
+
+    def testBadAgingDict(self):
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, agingDict={'killa': (1, None)})
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, agingDict={'lowa': (-1, None)})
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, agingDict={'lowa': (1, None)},
+            useDeadlines=True)
+
+
+class CmdQueueBatchTest(unittest.TestCase):
+    """Test batch execution in CommandQueue
+    """
+    def setUp(self):
+        self.cmdQueue = CommandQueue(priorityDict=cmdPriorityDict)
+        self.deferred = Deferred()
+        self.runList = [] # list of lists of command strings, one per runFunc or batchFunc call
+        self.numDone = 0
+        self.numCmds = 0
+
+    def addCmd(self, cmdStr):
+        cmd = UserCmd(userID=0, cmdStr=cmdStr)
+        cmd.cmdVerb = cmdStr.split()[0]
+        cmd.addCallback(self.cmdCallback)
+        self.numCmds += 1
+        self.cmdQueue.addCmd(cmd, self.runFunc)
+
+    def cmdCallback(self, cmd):
+        if cmd.isDone:
+            self.assertFalse(cmd.didFail)
+            self.numDone += 1
+            if self.numDone == self.numCmds:
+                self.deferred.callback(None)
+
+    def runFunc(self, cmd):
+        self.batchFunc([cmd])
+
+    def batchFunc(self, cmdList):
+        self.runList.append([cmd.cmdStr for cmd in cmdList])
+        # finish each command individually, later
+        for cmd in cmdList:
+            Timer(0.01, cmd.setState, cmd.Done)
+
+    def testBatch(self):
+        self.cmdQueue.addBatchFunc('meda', self.batchFunc)
+        for cmdStr in ['meda 1', 'hia', 'meda 2', 'medb', 'meda 3', 'lowa', 'meda 4']:
+            self.addCmd(cmdStr)
+        def checkResults(cb):
+            self.assertEqual(self.runList, [['hia'], ['meda 1', 'meda 2', 'meda 3', 'meda 4'], ['medb'], ['lowa']])
+        return self.deferred.addCallback(checkResults)
+
+    def testMaxBatchSize(self):
+        self.cmdQueue.addBatchFunc('meda', self.batchFunc, maxBatchSize=2)
+        for cmdStr in ['meda 1', 'meda 2', 'meda 3', 'medb', 'meda 4', 'meda 5']:
+            self.addCmd(cmdStr)
+        def checkResults(cb):
+            self.assertEqual(self.runList, [['meda 1', 'meda 2'], ['meda 3', 'meda 4'], ['medb'], ['meda 5']])
+        return self.deferred.addCallback(checkResults)
+
+    def testCompatFunc(self):
+        # only batch commands with the same parity
+        def compatFunc(firstCmd, cmd):
+            return int(firstCmd.cmdStr.split()[1]) % 2 == int(cmd.cmdStr.split()[1]) % 2
+        self.cmdQueue.addBatchFunc('meda', self.batchFunc, compatFunc=compatFunc)
+        for cmdStr in ['meda 1', 'meda 2', 'meda 3', 'meda 4', 'meda 5']:
+            self.addCmd(cmdStr)
+        def checkResults(cb):
+            self.assertEqual(self.runList, [['meda 1', 'meda 3', 'meda 5'], ['meda 2', 'meda 4']])
+        return self.deferred.addCallback(checkResults)
+
+    def testMaxRunning(self):
+        # each command in a batch counts toward maxRunning
+        self.cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, resourceDict={'meda': [], 'hia': []}, maxRunning=3)
+        maxNumRunningList = []
+        def batchFunc(cmdList):
+            maxNumRunningList.append(len(self.cmdQueue.runningCmds))
+            self.batchFunc(cmdList)
+        self.cmdQueue.addBatchFunc('meda', batchFunc)
+        for cmdStr in ['hia', 'meda 1', 'meda 2', 'meda 3', 'meda 4', 'meda 5']:
+            self.addCmd(cmdStr)
+        def checkResults(cb):
+            # hia leaves room for a batch of 2; then the commands finish one at a time, freeing one slot each
+            self.assertEqual(self.runList, [['hia'], ['meda 1', 'meda 2'], ['meda 3'], ['meda 4'], ['meda 5']])
+            self.assertEqual(max(maxNumRunningList), 3)
+        return self.deferred.addCallback(checkResults)
+
+    def testBadBatchFunc(self):
+        self.assertRaises(RuntimeError, self.cmdQueue.addBatchFunc, 'killa', self.batchFunc)
+        self.assertRaises(RuntimeError, self.cmdQueue.addBatchFunc, 'randomCmd', self.batchFunc)
+        self.assertRaises(RuntimeError, self.cmdQueue.addBatchFunc, 'meda', self.batchFunc, maxBatchSize=0)
+
+
+class CmdQueueBoundedTest(unittest.TestCase):
+    """Test load shedding in a bounded CommandQueue
+    """
+    def queueCmds(self, cmdStrList, **kwargs):
+        """Queue commands (without running the queue) and return (CommandQueue, list of command strings shed)
+        """
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, **kwargs)
+        cmdQueue.queueTimer.start = lambda *args: None # do not run the queue
+        shedList = []
+        def cmdCallback(cmd):
+            if cmd.didFail:
+                shedList.append(cmd.cmdStr)
+        for cmdStr in cmdStrList:
+            cmd = UserCmd(userID=0, cmdStr=cmdStr)
+            cmd.cmdVerb = cmdStr.split()[0]
+            cmd.addCallback(cmdCallback)
+            cmdQueue.addCmd(cmd, nullCallFunc)
+        return cmdQueue, shedList
+
+    def queuedCmdStrs(self, cmdQueue):
+        return sorted(queuedCmd.cmdStr for queuedCmd in cmdQueue.cmdQueue)
+
+    def testRejectNew(self):
+        cmdQueue, shedList = self.queueCmds(['lowa 1', 'hia 1', 'meda 1', 'hia 2'], maxQueueSize=2)
+        self.assertEqual(shedList, ['meda 1', 'hia 2'])
+        self.assertEqual(self.queuedCmdStrs(cmdQueue), ['hia 1', 'lowa 1'])
+        self.assertEqual(cmdQueue.numShed, 2)
+        self.assertEqual(dict(cmdQueue.shedCountDict), {'meda': 1, 'hia': 1})
+
+    def testDropOldest(self):
+        cmdQueue, shedList = self.queueCmds(['lowa 1', 'hia 1', 'meda 1', 'hia 2'], maxQueueSize=2,
+            shedPolicy=CommandQueue.DropOldest)
+        self.assertEqual(shedList, ['lowa 1', 'hia 1'])
+        self.assertEqual(self.queuedCmdStrs(cmdQueue), ['hia 2', 'meda 1'])
+
+    def testDropLowest(self):
+        cmdQueue, shedList = self.queueCmds(['meda 1', 'hia 1', 'lowa 1', 'lowa 2', 'hia 2', 'medb 1'], maxQueueSize=3,
+            shedPolicy=CommandQueue.DropLowest)
+        self.assertEqual(shedList, ['lowa 2', 'lowa 1', 'medb 1'])
+        self.assertEqual(self.queuedCmdStrs(cmdQueue), ['hia 1', 'hia 2', 'meda 1'])
+
+    def testDropLowestTie(self):
+        # lowa and lowb have the same priority; the most recently queued of them is shed, whichever verb it has
+        for cmdStrList, shedCmdStr in (
+            (['lowa 1', 'lowb 1', 'hia 1'], 'lowb 1'),
+            (['lowb 1', 'lowa 1', 'hia 1'], 'lowa 1'),
+            (['lowb 1', 'lowa 1', 'lowb 2', 'hia 1'], 'lowb 2'),
+        ):
+            cmdQueue, shedList = self.queueCmds(cmdStrList, maxQueueSize=len(cmdStrList) - 1,
+                shedPolicy=CommandQueue.DropLowest)
+            self.assertEqual(shedList, [shedCmdStr])
+
+    def testPerVerbLimit(self):
+        cmdStrList = ['meda 1', 'meda 2', 'hia 1', 'meda 3', 'hia 2']
+        cmdQueue, shedList = self.queueCmds(cmdStrList, maxQueueSizeDict={'meda': 2})
+        self.assertEqual(shedList, ['meda 3'])
+        cmdQueue, shedList = self.queueCmds(cmdStrList, maxQueueSizeDict={'meda': 2},
+            shedPolicy=CommandQueue.DropOldest)
+        self.assertEqual(shedList, ['meda 1'])
+        self.assertEqual(self.queuedCmdStrs(cmdQueue), ['hia 1', 'hia 2', 'meda 2', 'meda 3'])
+        self.assertEqual(dict(cmdQueue.shedCountDict), {'meda': 1})
+
+    def testShedMessage(self):
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, maxQueueSize=1, shedPolicy=CommandQueue.DropOldest)
+        cmdQueue.queueTimer.start = lambda *args: None # do not run the queue
+        cmdList = []
+        for cmdStr in ('meda 1', 'meda 2'):
+            cmd = UserCmd(userID=0, cmdStr=cmdStr)
+            cmd.cmdVerb = 'meda'
+            cmdQueue.addCmd(cmd, nullCallFunc)
+            cmdList.append(cmd)
+        self.assertTrue(cmdList[0].didFail)
+        self.assertIn("'meda 2'", cmdList[0].textMsg)
+        self.assertIn("queue is full (more than 1 queued commands)", cmdList[0].textMsg)
+        cmd = UserCmd(userID=0, cmdStr='meda 3')
+        cmd.cmdVerb = 'meda'
+        cmdQueue.shedPolicy = CommandQueue.RejectNew
+        cmdQueue.addCmd(cmd, nullCallFunc)
+        self.assertTrue(cmd.didFail)
+        self.assertTrue(cmd.textMsg.startswith("Rejected: queue is full"))
+        self.assertFalse(cmdList[1].isDone)
+
+    def testImmediateNotShed(self):
+        cmdQueue, shedList = self.queueCmds(['hia 1', 'killa'], maxQueueSize=1)
+        self.assertEqual(shedList, ['hia 1']) # cancelled by killa, not shed
+        self.assertEqual(cmdQueue.numShed, 0)
+
+    def testBadArgs(self):
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, maxQueueSize=0)
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, shedPolicy='badPolicy')
+        self.assertRaises(RuntimeError, CommandQueue, priorityDict=cmdPriorityDict, maxQueueSizeDict={'randomCmd': 1})
+
+
+class CmdQueueStressTest(unittest.TestCase):
+    """Stress test for CommandQueue with many queued commands
+    """
+    NumCmds = 5000
+    def testManyCommands(self):
+        cmdVerbList = ['hia', 'meda', 'lowa']
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict)
+        rand = random.Random(0)
+        runList = []
+        deferred = Deferred()
+
+        def runFunc(cmd):
+            runList.append(cmd)
+            cmd.setState(cmd.Done)
+            if len(runList) + numCancelled == self.NumCmds:
+                deferred.callback(None)
+
+        cmdList = []
+        for i in range(self.NumCmds):
+            cmdVerb = rand.choice(cmdVerbList)
+            cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+            cmd.cmdVerb = cmdVerb
+            cmdList.append(cmd)
+
+        for cmd in cmdList:
+            cmdQueue.addCmd(cmd, runFunc)
+        self.assertEqual(len(cmdQueue), self.NumCmds)
+
+        # cancel every tenth command while it is queued
+        numCancelled = 0
+        for cmd in cmdList[1::10]:
+            cmd.setState(cmd.Cancelled)
+            numCancelled += 1
+        self.assertEqual(len(cmdQueue), self.NumCmds - numCancelled)
+
+        def checkResults(cb):
+            self.assertEqual(len(cmdQueue), 0)
+            self.assertFalse(any(cmd.didFail for cmd in runList))
+            # commands ran in order of decreasing priority, then in the order queued
+            cmdIndDict = dict((cmd, ind) for ind, cmd in enumerate(cmdList))
+            def sortKey(cmd):
+                return (-cmdPriorityDict.get(cmd.cmdVerb, 0), cmdIndDict[cmd])
+            self.assertEqual(runList, sorted(runList, key=sortKey))
+        deferred.addCallback(checkResults)
+        return deferred
+
+
+class CmdQueueSimulationTest(unittest.TestCase):
+    """Simulate CommandQueue workloads in virtual time, using FakeClock
+    """
+    NumCmds = 20000
+    def simulate(self, numCmds, seed=0, **kwargs):
+        """Run a random workload of commands with random arrival times, durations and deadlines
+
+        Commands arrive at an average rate a bit lower than the queue can run them.
+        State changes are not logged, to save time.
+        Return (CommandQueue, FakeClock, list of (time finished, cmdStr, state, queueTimeLim))
+        """
+        clock = FakeClock()
+        prevLogStateChanges = BaseCmd.LogStateChanges
+        BaseCmd.LogStateChanges = False
+        try:
+            cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, clock=clock, **kwargs)
+            rand = random.Random(seed)
+            doneList = []
+            def cmdCallback(cmd):
+                if cmd.isDone:
+                    doneList.append((clock.time(), cmd.cmdStr, cmd.state, cmd.queueTimeLim))
+            def setDone(cmd):
+                if not cmd.isDone:
+                    cmd.setState(cmd.Done)
+            def runFunc(cmd):
+                clock.Timer(cmd.duration, setDone, cmd)
+            arrivalTime = 0
+            for i in range(numCmds):
+                cmdVerb = rand.choice(['hia', 'meda', 'lowa'])
+                queueTimeLim = rand.choice([None, 0.5, 2.0])
+                cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+                cmd.cmdVerb = cmdVerb
+                cmd.duration = rand.expovariate(10)
+                cmd.queueTimeLim = queueTimeLim
+                cmd.addCallback(cmdCallback)
+                arrivalTime += rand.expovariate(9)
+                clock.Timer(arrivalTime, cmdQueue.addCmd, cmd, runFunc, queueTimeLim=queueTimeLim)
+            clock.run()
+        finally:
+            BaseCmd.LogStateChanges = prevLogStateChanges
+        return cmdQueue, clock, doneList
+
+    def testRepeatable(self):
+        cmdQueue1, clock1, doneList1 = self.simulate(2000, seed=5, useDeadlines=True)
+        cmdQueue2, clock2, doneList2 = self.simulate(2000, seed=5, useDeadlines=True)
+        self.assertEqual(len(doneList1), 2000)
+        self.assertEqual(doneList1, doneList2)
+        self.assertEqual(clock1.time(), clock2.time())
+        self.assertEqual(clock1.numPending, 0)
+        self.assertEqual(len(cmdQueue1), 0)
+        self.assertEqual(cmdQueue1.numExpired, cmdQueue2.numExpired)
+
+    def testDeadlinePolicy(self):
+        fifoQueue = self.simulate(5000)[0]
+        edfQueue = self.simulate(5000, useDeadlines=True)[0]
+        self.assertGreater(edfQueue.numDeadlineMet, fifoQueue.numDeadlineMet)
+
+    def testManyCommands(self):
+        cmdQueue, clock, doneList = self.simulate(self.NumCmds, useDeadlines=True)
+        self.assertEqual(len(doneList), self.NumCmds)
+        self.assertEqual(len(cmdQueue), 0)
+        self.assertEqual(clock.numPending, 0)
+        numTimed = sum(1 for doneTime, cmdStr, state, queueTimeLim in doneList if queueTimeLim)
+        self.assertEqual(cmdQueue.numDeadlineMet + cmdQueue.numDeadlineMissed + cmdQueue.numExpired, numTimed)
+
+
+class CmdQueueMetricsTest(unittest.TestCase):
+    """Test CommandQueue metrics, using FakeClock so that times are exact
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.killedList = []
+        self.cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, clock=self.clock, killFunc=self.killFunc)
+
+    def killFunc(self, runningCmd, killingCmd):
+        self.killedList.append(runningCmd.cmdStr)
+        runningCmd.setState(runningCmd.Cancelled)
+
+    def addCmd(self, cmdStr, duration=1.0):
+        """Queue a command that runs for the specified duration (sec) of virtual time
+        """
+        def setDone(cmd):
+            if not cmd.isDone:
+                cmd.setState(cmd.Done)
+        def runFunc(cmd):
+            self.clock.Timer(duration, setDone, cmd)
+        cmd = UserCmd(userID=0, cmdStr=cmdStr)
+        cmd.cmdVerb = cmdStr.split()[0]
+        self.cmdQueue.addCmd(cmd, runFunc)
+        return cmd
+
+    def testDepthAndTimes(self):
+        for i in range(5):
+            self.addCmd("meda %d" % (i,), duration=2.0)
+        self.addCmd("hia", duration=1.0)
+        self.clock.run()
+        metrics = self.cmdQueue.getMetrics()
+        self.assertEqual(metrics["depth"], 0)
+        self.assertEqual(metrics["maxDepth"], 6)
+        self.assertEqual(metrics["depthHistogram"], [(0, 0, 1), (1, 1, 1), (2, 3, 2), (4, 7, 2)])
+        verbStats = metrics["verbStats"]
+        self.assertEqual(sorted(verbStats), ["hia", "meda"])
+        self.assertEqual(verbStats["hia"], dict(numStarted=1, meanWait=0, maxWait=0, numRun=1, meanRun=1, maxRun=1))
+        # the meda commands wait for hia (1 sec) and each other (2 sec each)
+        self.assertEqual(verbStats["meda"], dict(numStarted=5, meanWait=5, maxWait=9, numRun=5, meanRun=2, maxRun=2))
+        self.assertEqual(self.clock.time(), 11)
+
+        self.cmdQueue.resetMetrics()
+        metrics = self.cmdQueue.getMetrics()
+        self.assertEqual((metrics["maxDepth"], metrics["depthHistogram"], metrics["verbStats"]), (0, [], {}))
+
+    def testRuleCounts(self):
+        self.cmdQueue.addRule(CommandQueue.CancelNew, newCmds=['lowa'], queuedCmds=['lowb'])
+        self.cmdQueue.addRule(CommandQueue.CancelQueued, newCmds=['meda'], queuedCmds=['meda'])
+        self.cmdQueue.addRule(CommandQueue.KillRunning, newCmds=['hib'], queuedCmds=['hia'])
+        self.addCmd("hia")
+        self.clock.run(maxTime=0) # start hia
+        self.addCmd("lowb")
+        self.addCmd("lowa") # cancelled by lowb
+        self.addCmd("meda 1")
+        self.addCmd("meda 2") # cancels meda 1
+        self.addCmd("hib") # kills hia
+        self.assertEqual(self.killedList, ["hia"])
+        ruleCounts = self.cmdQueue.getMetrics()["ruleCounts"]
+        self.assertEqual(ruleCounts, {CommandQueue.CancelNew: 1, CommandQueue.CancelQueued: 1, CommandQueue.KillRunning: 1})
+        self.clock.run()
+        self.assertEqual(self.cmdQueue.getVerbStats()["hia"]["numRun"], 1)
+
+    def testPreempted(self):
+        self.addCmd("hia")
+        self.clock.run(maxTime=0) # start hia
+        self.addCmd("meda")
+        self.addCmd("lowa")
+        self.addCmd("killa")
+        self.clock.run()
+        metrics = self.cmdQueue.getMetrics()
+        self.assertEqual(metrics["numPreempted"], 3)
+        self.assertEqual(sorted(metrics["verbStats"]), ["hia", "killa"])
+
+
+class CmdQueueThroughputTest(unittest.TestCase):
+    """Count the reactor iterations CommandQueue needs to run back-to-back commands, using FakeClock
+
+    Each zero second timer that fires stands for one reactor iteration; in a busy reactor
+    each iteration may be delayed by other work, so fewer iterations means more commands/sec.
+    """
+    NumCmds = 600
+
+    def runBusyQueue(self, runWhenDone):
+        """Queue NumCmds commands whose runFunc finishes them at once and run them
+
+        Return (number of timers fired, list of commands in the order run)
+        """
+        clock = FakeClock()
+        cmdQueue = CommandQueue(priorityDict=cmdPriorityDict, runWhenDone=runWhenDone, clock=clock)
+        runList = []
+        def runFunc(cmd):
+            runList.append(cmd)
+            cmd.setState(cmd.Done)
+        for i in range(self.NumCmds):
+            cmdVerb = ('hia', 'meda', 'lowa')[i % 3]
+            cmd = UserCmd(userID=0, cmdStr="%s %d" % (cmdVerb, i))
+            cmd.cmdVerb = cmdVerb
+            cmdQueue.addCmd(cmd, runFunc)
+        numFired = clock.run()
+        self.assertEqual(len(runList), self.NumCmds)
+        self.assertEqual(len(cmdQueue), 0)
+        self.assertEqual(clock.time(), 0)
+        return numFired, runList
+
+    def testRunWhenDone(self):
+        numEach = self.NumCmds // 3
+        for runWhenDone in (False, True):
+            numFired, runList = self.runBusyQueue(runWhenDone=runWhenDone)
+            cmdVerbList = [cmd.cmdVerb for cmd in runList]
+            self.assertEqual(cmdVerbList, ['hia']*numEach + ['meda']*numEach + ['lowa']*numEach)
+            if runWhenDone:
+                # each finished command starts the next at once; runQueue yields to the reactor (starts a timer)
+                # after every MaxSyncPasses commands, including the last, so the final timer finds nothing to do
+                self.assertEqual(numFired, self.NumCmds // CommandQueue.MaxSyncPasses + 1)
+            else:
+                # one timer starts the first command, then each finished command starts a timer
+                self.assertEqual(numFired, self.NumCmds + 1)
+
+
 if __name__ == '__main__':
     from unittest import main
     main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test ConnPool, using fake connections and a fake clock
+"""
+import unittest
+
+from twistedActor import ConnPool, FakeClock, setClock
+
+class FakeConn(object):
+    """A fake connection that connects after connectDelay seconds (or fails to, if failConnect)
+    """
+    def __init__(self, clock, connectDelay=0.1, failConnect=False):
+        self.clock = clock
+        self.connectDelay = connectDelay
+        self.failConnect = failConnect
+        self.state = "Disconnected"
+        self.reason = ""
+        self.readCallbackList = []
+        self.stateCallbackList = []
+        self.writtenList = []
+
+    @property
+    def fullState(self):
+        return (self.state, self.reason)
+
+    @property
+    def isConnected(self):
+        return self.state == "Connected"
+
+    @property
+    def isDisconnected(self):
+        return self.state in ("Disconnected", "Failed")
+
+    @property
+    def isDone(self):
+        return self.state in ("Connected", "Disconnected", "Failed")
+
+    def addReadCallback(self, callFunc):
+        self.readCallbackList.append(callFunc)
+
+    def addStateCallback(self, callFunc):
+        self.stateCallbackList.append(callFunc)
+
+    def removeReadCallback(self, callFunc):
+        self.readCallbackList.remove(callFunc)
+
+    def removeStateCallback(self, callFunc):
+        self.stateCallbackList.remove(callFunc)
+
+    @property
+    def numCallbacks(self):
+        return len(self.readCallbackList) + len(self.stateCallbackList)
+
+    def connect(self, timeLim=None):
+        self.setState("Connecting")
+        if self.failConnect:
+            self.clock.Timer(self.connectDelay, self.setState, "Failed", "connection refused")
+        else:
+            self.clock.Timer(self.connectDelay, self.setState, "Connected")
+
+    def disconnect(self):
+        if self.isDisconnected:
+            return
+        self.setState("Disconnecting")
+        self.clock.Timer(0.01, self.setState, "Disconnected")
+
+    def setState(self, state, reason=""):
+        if self.isDisconnected and state == "Connected":
+            return # disconnected while connecting
+        self.state = state
+        self.reason = reason
+        for callFunc in self.stateCallbackList:
+            callFunc(self)
+
+    def read(self, data):
+        for callFunc in self.readCallbackList:
+            callFunc(None, data)
+
+    def writeLine(self, data):
+        self.writtenList.append(data)
+
+
+class TestConnPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.prevClock = setClock(self.clock)
+        self.failConnect = False
+        self.connList = []
+        self.readList = []
+        self.memberEventList = []
+        self.stateList = []
+
+    def tearDown(self):
+        setClock(self.prevClock)
+
+    def makeConn(self):
+        conn = FakeConn(self.clock, failConnect=self.failConnect)
+        self.connList.append(conn)
+        return conn
+
+    def makePool(self, **kwargs):
+        return ConnPool(
+            connFactory = self.makeConn,
+            readCallback = lambda member, data: self.readList.append((member, data)),
+            memberCallback = lambda member: self.memberEventList.append((member, member.isConnected)),
+            stateCallback = lambda pool: self.stateList.append(pool.fullState),
+            **kwargs
+        )
+
+    def testConnectDisconnect(self):
+        pool = self.makePool(minSize=2, maxSize=3)
+        pool.connect()
+        self.assertEqual(pool.state, pool.Connecting)
+        self.assertEqual(len(pool.memberList), 2)
+        self.assertRaises(RuntimeError, pool.connect)
+        self.clock.run()
+        self.assertTrue(pool.isConnected)
+        self.assertEqual(self.memberEventList, [(conn, True) for conn in self.connList])
+
+        self.memberEventList = []
+        pool.disconnect()
+        self.assertEqual(pool.state, pool.Disconnecting)
+        self.clock.run()
+        self.assertEqual(pool.state, pool.Disconnected)
+        self.assertTrue(all(conn.numCallbacks == 0 for conn in self.connList))
+        self.assertEqual(self.stateList,
+            [("Connecting", ""), ("Connected", ""), ("Disconnecting", ""), ("Disconnected", "")])
+        self.assertEqual(pool.memberList, [])
+        self.assertEqual(self.memberEventList, [(conn, False) for conn in self.connList])
+
+    def testAcquireRelease(self):
+        pool = self.makePool(minSize=2, maxSize=3, idleTime=10)
+        pool.connect()
+        self.clock.run()
+        member0 = pool.acquire()
+        member1 = pool.acquire()
+        self.assertEqual([member0, member1], self.connList)
+        self.assertEqual(pool.numBusy, 2)
+        # all members are busy, so acquire opens another member
+        self.assertIsNone(pool.acquire())
+        self.assertIsNone(pool.acquire()) # but only one at a time
+        self.assertEqual(pool.numOpened, 3)
+        self.clock.advance(0.1)
+        self.assertEqual(self.memberEventList[-1], (self.connList[2], True))
+        member2 = pool.acquire()
+        self.assertIs(member2, self.connList[2])
+        self.assertIsNone(pool.acquire()) # maxSize members are open
+        self.assertEqual((pool.numOpened, pool.maxNumBusy), (3, 3))
+
+        member2.read("reply")
+        self.assertEqual(self.readList, [(member2, "reply")])
+
+        # release members; the extra member is closed once it has been idle for idleTime
+        pool.release(member2)
+        pool.release(member0)
+        self.assertEqual(pool.numBusy, 1)
+        self.assertIs(pool.acquire(), member0) # the oldest idle member is used first
+        pool.release(member0)
+        self.clock.advance(9.9)
+        self.assertEqual(len(pool.memberList), 3)
+        self.clock.advance(0.2)
+        self.assertEqual(pool.memberList, [member0, member1])
+        self.assertEqual(pool.numIdleClosed, 1)
+        self.clock.run()
+        self.assertEqual(member2.state, "Disconnected")
+        self.assertEqual(member2.numCallbacks, 0)
+        self.assertTrue(pool.isConnected)
+
+    def testLostMember(self):
+        pool = self.makePool(minSize=2, maxSize=2, retryInterval=5)
+        pool.connect()
+        self.clock.run()
+        member0 = pool.acquire()
+        member0.setState("Failed", "connection reset")
+        self.assertEqual(self.memberEventList[-1], (member0, False))
+        self.assertEqual(pool.numLost, 1)
+        self.assertEqual(pool.memberList, [self.connList[1]])
+        self.assertTrue(pool.isConnected)
+        # the lost member is replaced after retryInterval
+        self.clock.advance(5)
+        self.assertEqual(pool.numOpened, 3)
+        self.clock.run()
+        self.assertEqual(pool.memberList, self.connList[1:])
+        self.assertTrue(all(member.isConnected for member in pool.memberList))
+        self.assertEqual(member0.numCallbacks, 0)
+
+    def testDiscard(self):
+        pool = self.makePool(minSize=1, maxSize=2)
+        pool.connect()
+        self.clock.run()
+        member0 = pool.acquire()
+        pool.discard(member0, reason="timed out")
+        self.assertEqual(pool.numDiscarded, 1)
+        # the replacement is opened at once, and the pool stays connected while it connects
+        self.assertEqual(pool.memberList, [self.connList[1]])
+        self.assertTrue(pool.isConnected)
+        self.assertIsNone(pool.acquire())
+        self.clock.run()
+        self.assertIs(pool.acquire(), self.connList[1])
+        self.assertEqual(member0.state, "Disconnected")
+        self.assertEqual(member0.numCallbacks, 0)
+
+    def testDiscardAboveMinSize(self):
+        pool = self.makePool(minSize=1, maxSize=3)
+        pool.connect()
+        self.clock.run()
+        # grow the pool to maxSize; acquire opens one member at a time
+        memberList = []
+        while len(memberList) < 3:
+            member = pool.acquire()
+            if member is None:
+                self.clock.advance(0.1)
+            else:
+                memberList.append(member)
+        self.assertEqual(pool.numOpened, 3)
+        # no replacement is needed while at least minSize members remain
+        pool.discard(memberList[0])
+        self.assertEqual(pool.numOpened, 3)
+        self.assertEqual(pool.memberList, memberList[1:])
+        self.clock.run()
+        self.assertEqual(memberList[0].numCallbacks, 0)
+        memberList[0].read("late reply")
+        self.assertEqual(self.readList, [])
+
+    def testConnectFails(self):
+        self.failConnect = True
+        pool = self.makePool(minSize=2, maxSize=2)
+        pool.connect()
+        self.clock.run()
+        self.assertEqual(pool.fullState, ("Failed", "connection refused"))
+        self.assertTrue(pool.didFail and pool.isDisconnected)
+        self.assertEqual(pool.numLost, 2)
+        self.assertEqual(self.clock.numPending, 0) # no retries
+        pool.disconnect() # no effect
+        self.assertEqual(pool.state, pool.Failed)
+
+        # the pool may be connected again
+        self.failConnect = False
+        pool.connect()
+        self.clock.run()
+        self.assertTrue(pool.isConnected)
+
+    def testAllLost(self):
+        pool = self.makePool(minSize=2, maxSize=2)
+        pool.connect()
+        self.clock.run()
+        for member in pool.memberList:
+            member.setState("Failed", "connection reset")
+        self.assertEqual(pool.fullState, ("Failed", "connection reset"))
+        self.assertEqual(pool.memberList, [])
+        self.clock.run()
+        self.assertEqual(pool.numOpened, 2) # no retries once the pool has failed
+
+    def testBadArgs(self):
+        self.assertRaises(RuntimeError, ConnPool, connFactory=None)
+        self.assertRaises(RuntimeError, ConnPool, connFactory=self.makeConn, minSize=0)
+        self.assertRaises(RuntimeError, ConnPool, connFactory=self.makeConn, minSize=3, maxSize=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
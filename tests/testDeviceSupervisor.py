@@ -0,0 +1,328 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test DeviceSupervisor, using a fake device and a fake clock, and a Device whose init sends a command
+"""
+import unittest
+
+from RO.AddCallback import BaseMixin
+from RO.Comm.TwistedTimer import Timer
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest as trialUnittest
+
+from twistedActor import DevCmd, Device, DeviceSupervisor, FakeClock, UserCmd, setClock
+
+class FakeConn(object):
+    def __init__(self, dev):
+        self.dev = dev
+
+    def disconnect(self):
+        self.dev.setState("Disconnected", "disconnected by supervisor")
+
+
+class FakeDevice(BaseMixin):
+    """A fake device that takes 0.1 sec to connect and 0.01 sec to run a command
+
+    startCmd checks the supervisor the way Device.startCmd does.
+    """
+    DefaultTimeLim = 5
+
+    def __init__(self, clock):
+        BaseMixin.__init__(self)
+        self.clock = clock
+        self.name = "fake"
+        self.conn = FakeConn(self)
+        self.state = "Disconnected"
+        self.reason = ""
+        self.supervisor = None
+        self._wantConn = False
+        self.connectOK = True
+        self.failCmdSet = set()
+        self.connectTimeList = []
+        self.cmdStrList = []
+
+    @property
+    def isConnected(self):
+        return self.state == "Connected"
+
+    @property
+    def isConnecting(self):
+        return self.state == "Connecting"
+
+    @property
+    def isDisconnecting(self):
+        return self.state in ("Disconnected", "Failed", "Disconnecting")
+
+    @property
+    def wantConn(self):
+        return self._wantConn
+
+    def setState(self, state, reason=""):
+        self.state = state
+        self.reason = reason
+        self._doCallbacks()
+
+    def connect(self, userCmd=None, timeLim=None):
+        self._wantConn = True
+        self.connectTimeList.append(self.clock.time())
+        userCmd = UserCmd()
+        self.setState("Connecting")
+        self.clock.Timer(0.1, self._finishConnect, userCmd)
+        return userCmd
+
+    def _finishConnect(self, userCmd):
+        if self.connectOK:
+            self.setState("Connected")
+            userCmd.setState(userCmd.Done)
+        else:
+            self.setState("Failed", "connection refused")
+            userCmd.setState(userCmd.Failed, textMsg="connection refused")
+
+    def disconnect(self, userCmd=None, timeLim=None):
+        self._wantConn = False
+        self.setState("Disconnected")
+
+    def startCmd(self, cmdStr, callFunc=None, userCmd=None, timeLim=None):
+        devCmd = DevCmd(cmdStr, callFunc=callFunc, timeLim=timeLim)
+        if self.supervisor is not None and self.supervisor.isOpen:
+            self.supervisor.failFast(devCmd)
+        elif not self.isConnected:
+            devCmd.setState(devCmd.Failed, textMsg="not connected")
+        else:
+            self.cmdStrList.append(cmdStr)
+            newState = devCmd.Failed if cmdStr in self.failCmdSet else devCmd.Done
+            self.clock.Timer(0.01, devCmd.setState, newState)
+        return devCmd
+
+
+class TestDeviceSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.prevClock = setClock(self.clock)
+        self.dev = FakeDevice(self.clock)
+        self.stateList = []
+        self.supervisor = DeviceSupervisor(self.dev, setupCmdList=("setup1", "setup2"), minDelay=1, maxDelay=3,
+            jitter=0, callFunc=lambda sup: self.stateList.append(sup.state))
+        self.dev.connect()
+        self.clock.run()
+        self.assertTrue(self.dev.isConnected)
+
+    def tearDown(self):
+        setClock(self.prevClock)
+
+    def testReconnect(self):
+        self.assertIs(self.dev.supervisor, self.supervisor)
+        self.assertRaises(RuntimeError, DeviceSupervisor, self.dev)
+        self.dev.connectOK = False
+        lossTime = self.clock.time()
+        self.dev.setState("Disconnected", "connection lost")
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Open)
+        self.assertEqual(self.supervisor.reason, "connection lost")
+
+        devCmd = self.dev.startCmd("status")
+        self.assertTrue(devCmd.didFail)
+        self.assertIn("connection lost", devCmd.textMsg)
+        self.assertEqual(self.supervisor.numFastFails, 1)
+
+        # attempts are made after 1, 2, 3 (the maximum), 3... sec, each taking 0.1 sec to fail
+        self.clock.advance(6.35) # until the third attempt has failed
+        self.dev.connectOK = True
+        self.clock.run()
+        delayList = [t1 - t0 for t0, t1 in zip([lossTime] + self.dev.connectTimeList[1:], self.dev.connectTimeList[1:])]
+        for delay, predDelay in zip(delayList, (1, 2.1, 3.1, 3.1)):
+            self.assertAlmostEqual(delay, predDelay)
+        self.assertEqual(len(delayList), 4)
+
+        self.assertEqual(self.dev.cmdStrList, ["setup1", "setup2"])
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+        self.assertFalse(self.dev.startCmd("status").didFail)
+        metrics = self.supervisor.getMetrics()
+        self.assertEqual((metrics["numOutages"], metrics["numAttempts"], metrics["numRecoveries"]), (1, 4, 1))
+        self.assertAlmostEqual(metrics["totalOutageTime"], 1 + 2.1 + 3.1 + 3.1 + 0.1 + 0.02)
+        self.assertEqual(metrics["outageTime"], 0)
+        self.assertEqual(self.stateList, ["Open", "HalfOpen"] * 4 + ["Closed"])
+        self.assertEqual(metrics["numStateChanges"], 9)
+
+    def testSetupFails(self):
+        self.dev.failCmdSet.add("setup2")
+        self.dev.setState("Disconnected", "connection lost")
+        self.clock.advance(1.15) # reconnected; setup2 is failing
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Open)
+        self.assertIn("setup2", self.supervisor.reason)
+        self.assertTrue(self.dev.isConnected)
+        self.assertTrue(self.dev.startCmd("status").didFail) # the circuit is still open
+
+        # the next attempt drops the connection and starts afresh
+        self.dev.failCmdSet.clear()
+        self.clock.run()
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+        self.assertEqual(self.dev.cmdStrList, ["setup1", "setup2", "setup1", "setup2"])
+        self.assertEqual(self.supervisor.numAttempts, 2)
+
+    def testUserDisconnect(self):
+        self.dev.disconnect()
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+
+        # a user disconnects the device while the circuit is open: supervision stops
+        self.dev.connect()
+        self.clock.run()
+        self.dev.setState("Disconnected", "connection lost")
+        self.dev.disconnect()
+        self.assertFalse(self.supervisor.isOpen)
+        self.assertEqual(self.dev.startCmd("status").textMsg, "not connected")
+        self.clock.run()
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+        self.assertEqual((self.supervisor.numAttempts, self.supervisor.numRecoveries), (0, 0))
+        self.assertEqual(len(self.dev.connectTimeList), 2)
+
+    def testUserReconnect(self):
+        self.dev.setState("Disconnected", "connection lost")
+        self.dev.connect()
+        # commands started while connecting (e.g. by init) are not failed fast
+        self.assertFalse(self.supervisor.isOpen)
+        self.assertEqual(self.dev.startCmd("init").textMsg, "not connected")
+        self.clock.run()
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+        self.assertEqual(self.dev.cmdStrList, ["setup1", "setup2"])
+        self.assertEqual(len(self.dev.connectTimeList), 2) # the supervisor did not connect again
+
+    def testUserConnectFails(self):
+        # a connection attempt started by a user while the circuit is closed fails: the circuit opens
+        self.dev.disconnect()
+        self.dev.connectOK = False
+        self.dev.connect()
+        self.clock.advance(0.1)
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Open)
+        self.assertEqual(self.supervisor.reason, "connection refused")
+        self.assertEqual(self.supervisor.numOutages, 1)
+        # the reason does not grow with each failed attempt
+        self.clock.advance(3.5)
+        self.assertEqual(self.supervisor.numAttempts, 2)
+        self.assertEqual(self.supervisor.reason, "connection refused")
+        self.assertEqual(self.dev.startCmd("status").textMsg, "fake status failed: not connected (connection refused); reconnecting")
+        self.dev.connectOK = True
+        self.clock.run()
+        self.assertEqual(self.supervisor.state, DeviceSupervisor.Closed)
+        self.assertEqual(self.dev.cmdStrList, ["setup1", "setup2"])
+        self.assertEqual(self.supervisor.numRecoveries, 1)
+
+    def testJitter(self):
+        supervisor = DeviceSupervisor(FakeDevice(self.clock), minDelay=2, maxDelay=100, jitter=0.25)
+        delayList = [supervisor.getDelay() for i in range(1000)]
+        self.assertTrue(all(1.5 <= delay <= 2.5 for delay in delayList))
+        self.assertGreater(max(delayList) - min(delayList), 0.5)
+
+    def testBadArgs(self):
+        for kwargs in (
+            dict(minDelay=0),
+            dict(minDelay=2, maxDelay=1),
+            dict(backoffFactor=0.5),
+            dict(jitter=1),
+        ):
+            self.assertRaises(RuntimeError, DeviceSupervisor, FakeDevice(self.clock), **kwargs)
+
+
+class FakeTCPConn(BaseMixin):
+    """A fake connection that connects (or fails to, if not connectOK) after 0.01 sec
+    """
+    def __init__(self):
+        BaseMixin.__init__(self)
+        self.state = "Disconnected"
+        self.reason = ""
+        self.connectOK = True
+
+    @property
+    def fullState(self):
+        return (self.state, self.reason)
+
+    @property
+    def isConnected(self):
+        return self.state == "Connected"
+
+    @property
+    def isDisconnected(self):
+        return self.state in ("Disconnected", "Failed")
+
+    @property
+    def didFail(self):
+        return self.state == "Failed"
+
+    @property
+    def mayConnect(self):
+        return self.state not in ("Connected", "Connecting")
+
+    def addStateCallback(self, callFunc, callNow=False):
+        self.addCallback(callFunc, callNow=callNow)
+
+    def removeStateCallback(self, callFunc):
+        return self.removeCallback(callFunc, doRaise=False)
+
+    def connect(self, timeLim=None):
+        self.setState("Connecting")
+        if self.connectOK:
+            Timer(0.01, self.setState, "Connected")
+        else:
+            Timer(0.01, self.setState, "Failed", "connection refused")
+
+    def disconnect(self):
+        if not self.isDisconnected:
+            self.setState("Disconnected")
+
+    def setState(self, state, reason=""):
+        self.state = state
+        self.reason = reason
+        self._doCallbacks()
+
+
+class InitDevice(Device):
+    """A Device whose init sends a command, as most real devices do; each command takes 0.01 sec
+    """
+    def __init__(self):
+        Device.__init__(self, name="initDev", conn=FakeTCPConn())
+        self.cmdStrList = []
+
+    def init(self, userCmd=None, timeLim=None, getStatus=True):
+        self.startCmd("init", userCmd=userCmd, timeLim=timeLim)
+
+    def sendCmd(self, devCmd):
+        self.cmdStrList.append(devCmd.cmdStr)
+        Timer(0.01, devCmd.setState, devCmd.Done)
+
+
+class TestSupervisedDevice(trialUnittest.TestCase):
+    """Reconnect a real Device whose init sends a command, in real time
+    """
+    timeout = 5 # sec; without recovery the test would wait for trial's default of 120 sec
+    def testReconnect(self):
+        dev = InitDevice()
+        deferred = Deferred()
+        reasonList = []
+        def supervisorCallback(supervisor):
+            if supervisor.state == supervisor.Open:
+                reasonList.append(supervisor.reason)
+                if supervisor.numAttempts >= 3:
+                    dev.conn.connectOK = True
+            elif supervisor.state == supervisor.Closed and supervisor.numRecoveries > 0:
+                # give the connection a moment to finish with its timers
+                Timer(0.05, deferred.callback, None)
+        supervisor = DeviceSupervisor(dev, setupCmdList=("setup",), minDelay=0.01, maxDelay=0.02, jitter=0,
+            callFunc=supervisorCallback)
+        def lose(userCmd):
+            if userCmd.isDone:
+                self.assertFalse(userCmd.didFail)
+                dev.conn.connectOK = False
+                dev.conn.setState("Disconnected", "connection lost")
+        dev.connect().addCallback(lose)
+
+        def checkResults(dumArg):
+            self.assertTrue(dev.isConnected)
+            self.assertEqual(dev.cmdStrList, ["init", "init", "setup"])
+            self.assertEqual((supervisor.numAttempts, supervisor.numRecoveries), (4, 1))
+            self.assertEqual(supervisor.numFastFails, 0)
+            # the first reason is the lost connection; each failed attempt reports why it failed, without nesting
+            self.assertEqual(len(set(reasonList[1:])), 1)
+            self.assertNotIn("not connected", reasonList[-1])
+        return deferred.addCallback(checkResults)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,9 +2,14 @@
 from __future__ import division, absolute_import
 """Ensure that command.LinkCommands works correctly
 """
+import time
 import unittest
 
-from twistedActor import LinkCommands, BaseCmd
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase as TrialTestCase
+from RO.Comm.TwistedTimer import Timer
+
+from twistedActor import LinkCommands, RaceCommands, BaseCmd
 
 class TestLinker(unittest.TestCase):
     def setUp(self):
@@ -37,7 +42,153 @@ class TestLinker(unittest.TestCase):
             else:
                 cmd.setState("done")
         self.assertTrue(self.mainCmd.state=="failed")   
-             
+
+
+class TestRace(unittest.TestCase):
+    def setUp(self):
+        self.subCmdList = []
+        for ind in range(3):
+            self.subCmdList.append(BaseCmd('subCmd'+str(ind)))
+        self.mainCmd = BaseCmd('main')
+
+    def testFirstSuccessWins(self):
+        RaceCommands(self.mainCmd, self.subCmdList)
+        self.subCmdList[0].setState("failed", textMsg="broken")
+        self.assertFalse(self.mainCmd.isDone)
+        self.subCmdList[2].setState("done", textMsg="answer")
+        self.assertEqual(self.mainCmd.state, "done")
+        self.assertEqual(self.mainCmd.textMsg, "answer")
+        self.assertEqual(self.subCmdList[1].state, "cancelled")
+
+    def testDetach(self):
+        RaceCommands(self.mainCmd, self.subCmdList, cancelOthers=False)
+        self.subCmdList[1].setState("done")
+        self.assertEqual(self.mainCmd.state, "done")
+        self.assertEqual(self.subCmdList[0].state, "ready")
+        self.subCmdList[0].setState("failed") # ignored
+        self.assertEqual(self.mainCmd.state, "done")
+
+    def testAllFail(self):
+        RaceCommands(self.mainCmd, self.subCmdList)
+        for cmd in self.subCmdList:
+            cmd.setState("failed", textMsg="broken")
+        self.assertEqual(self.mainCmd.state, "failed")
+
+    def testAlreadyDone(self):
+        self.subCmdList[1].setState("done")
+        RaceCommands(self.mainCmd, self.subCmdList)
+        self.assertEqual(self.mainCmd.state, "done")
+
+    def testHedgeAfterFailure(self):
+        # the hedge commands start as soon as the primary fails, without waiting for hedgeDelay
+        hedgeCmd = BaseCmd("hedge")
+        RaceCommands(self.mainCmd, self.subCmdList[0:1], hedgeFuncList=[lambda: hedgeCmd], hedgeDelay=100)
+        self.assertFalse(hasattr(hedgeCmd, "mainCmd"))
+        self.subCmdList[0].setState("failed")
+        self.assertTrue(hedgeCmd.mainCmd is self.mainCmd)
+        self.assertFalse(self.mainCmd.isDone)
+        hedgeCmd.setState("done")
+        self.assertEqual(self.mainCmd.state, "done")
+
+
+class TestHedgeDelay(TrialTestCase):
+    def setUp(self):
+        self.mainCmd = BaseCmd('main')
+        self.primaryCmd = BaseCmd('primary')
+        self.hedgeCmdList = []
+
+    def startHedge(self):
+        hedgeCmd = BaseCmd('hedge')
+        self.hedgeCmdList.append(hedgeCmd)
+        return hedgeCmd
+
+    def testPrimaryFast(self):
+        RaceCommands(self.mainCmd, [self.primaryCmd], hedgeFuncList=[self.startHedge], hedgeDelay=0.05)
+        self.primaryCmd.setState("done")
+        d = Deferred()
+        def checkResults():
+            self.assertEqual(self.mainCmd.state, "done")
+            self.assertEqual(self.hedgeCmdList, [])
+            d.callback("done")
+        Timer(0.1, checkResults)
+        return d
+
+    def testPrimarySlow(self):
+        RaceCommands(self.mainCmd, [self.primaryCmd], hedgeFuncList=[self.startHedge], hedgeDelay=0.05)
+        d = Deferred()
+        def checkResults():
+            self.assertEqual(len(self.hedgeCmdList), 1)
+            self.assertFalse(self.mainCmd.isDone)
+            self.hedgeCmdList[0].setState("done")
+            self.assertEqual(self.mainCmd.state, "done")
+            self.assertEqual(self.primaryCmd.state, "cancelled")
+            d.callback("done")
+        Timer(0.1, checkResults)
+        return d
+
+
+class TestWideLinkage(unittest.TestCase):
+    """Test and benchmark BaseCmd.linkCommands with many sub-commands linked to one parent
+    """
+    NumSubCmds = 10000
+
+    def setUp(self):
+        self.subCmdList = [BaseCmd('subCmd%s' % (ind,)) for ind in range(self.NumSubCmds)]
+        self.mainCmd = BaseCmd('main')
+        self.mainCmd.linkCommands(self.subCmdList)
+
+    def runSubCmds(self, failInd=None):
+        startTime = time.time()
+        for ind, cmd in enumerate(self.subCmdList):
+            cmd.setState(cmd.Running)
+            self.assertEqual(self.mainCmd.state, self.mainCmd.Running)
+        for ind, cmd in enumerate(self.subCmdList):
+            self.assertFalse(self.mainCmd.isDone)
+            cmd.setState(cmd.Failed if ind == failInd else cmd.Done, textMsg="failed %s" % (ind,))
+        print("%s: finished %d linked sub-commands in %0.3f sec" % \
+            (self.id(), self.NumSubCmds, time.time() - startTime))
+
+    def testPass(self):
+        self.runSubCmds()
+        self.assertEqual(self.mainCmd.state, self.mainCmd.Done)
+
+    def testFail(self):
+        self.runSubCmds(failInd=self.NumSubCmds // 2)
+        self.assertEqual(self.mainCmd.state, self.mainCmd.Failed)
+        self.assertEqual(self.mainCmd.textMsg, "subCmd%d: failed %d" % (self.NumSubCmds // 2, self.NumSubCmds // 2))
+
+
+class TestDeepLinkage(unittest.TestCase):
+    """Test BaseCmd.linkCommands with very deep chains of commands
+    """
+    ChainLen = 1000
+
+    def writeToUsers(self, msgCode, msgStr, cmd, userID, cmdID):
+        self.writeList.append((msgStr, cmd))
+
+    def setUp(self):
+        self.writeList = []
+        self.cmdList = [BaseCmd('cmd%s' % (ind,)) for ind in range(self.ChainLen)]
+        self.cmdList[0].setWriteToUsers(self.writeToUsers)
+
+    def checkChain(self):
+        rootCmd = self.cmdList[0]
+        for cmd in self.cmdList:
+            self.assertTrue(cmd.eldestParentCmd is rootCmd)
+        self.cmdList[-1].writeToUsers("i", "text=deep")
+        self.assertEqual(self.writeList, [("text=deep", rootCmd)])
+
+    def testLinkTopDown(self):
+        for parentCmd, subCmd in zip(self.cmdList[:-1], self.cmdList[1:]):
+            parentCmd.linkCommands([subCmd])
+        self.checkChain()
+
+    def testLinkBottomUp(self):
+        # link the deepest pair first, so the cached root of each existing sub-tree must be updated
+        for parentCmd, subCmd in reversed(zip(self.cmdList[:-1], self.cmdList[1:])):
+            parentCmd.linkCommands([subCmd])
+        self.checkChain()
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,171 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test PollScheduler, using fake devices and a fake clock
+"""
+import unittest
+
+from twistedActor import DevCmd, FakeClock, PollScheduler, setClock
+
+class FakeDevice(object):
+    """A fake device whose commands take cmdTime seconds
+
+    Like Device, it tells its poll scheduler when it starts a command and reports numRunningCmds.
+    """
+    DefaultTimeLim = 5
+
+    def __init__(self, clock, name, cmdTime=0.01):
+        self.clock = clock
+        self.name = name
+        self.cmdTime = cmdTime
+        self.isConnected = True
+        self.pollScheduler = None
+        self.numRunningCmds = 0
+        self.failCmds = False
+        self.sendList = [] # list of (time, cmdStr)
+
+    def startCmd(self, cmdStr, timeLim=None, cmdTime=None):
+        devCmd = DevCmd(cmdStr, timeLim=timeLim)
+        self.sendList.append((self.clock.time(), cmdStr))
+        self.numRunningCmds += 1
+        if self.pollScheduler is not None:
+            self.pollScheduler.noteActivity(self)
+        self.clock.Timer(self.cmdTime if cmdTime is None else cmdTime, self._finishCmd, devCmd)
+        return devCmd
+
+    def _finishCmd(self, devCmd):
+        self.numRunningCmds -= 1
+        devCmd.setState(devCmd.Failed if self.failCmds else devCmd.Done)
+
+    def sendTimes(self, cmdStr, startTime=0, endTime=1e9):
+        return [t for t, sentCmdStr in self.sendList if sentCmdStr == cmdStr and startTime <= t < endTime]
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.prevClock = setClock(self.clock)
+
+    def tearDown(self):
+        setClock(self.prevClock)
+
+    def testStagger(self):
+        """Polls of many devices with the same interval are spread out
+        """
+        scheduler = PollScheduler(idleTime=100)
+        devList = [FakeDevice(self.clock, "dev%d" % (i,)) for i in range(10)]
+        for dev in devList:
+            scheduler.addPoll(dev, "status", interval=1)
+        self.clock.run(maxTime=10)
+        self.assertEqual(scheduler.maxPollsPerTick, 1)
+        sendTimeList = sorted(dev.sendTimes("status")[0] for dev in devList)
+        self.assertGreater(min(t1 - t0 for t0, t1 in zip(sendTimeList[:-1], sendTimeList[1:])), 0.05)
+        for dev in devList:
+            self.assertEqual(len(dev.sendTimes("status", endTime=10)), 10)
+        metrics = scheduler.getMetrics()
+        self.assertEqual(len(metrics["polls"]), 10)
+        self.assertEqual(metrics["polls"]["dev0 status"]["numSent"], 11) # dev0 is polled at 0, 1, ... 10 sec
+        self.assertAlmostEqual(metrics["polls"]["dev0 status"]["meanCost"], 0.01)
+        self.assertAlmostEqual(metrics["polls"]["dev0 status"]["maxJitter"], 0)
+
+    def testCoalesce(self):
+        """Polls of one device that are due at nearly the same time are sent together
+        """
+        scheduler = PollScheduler(idleTime=100, coalesceTime=0.7)
+        dev = FakeDevice(self.clock, "dev")
+        scheduler.addPoll(dev, "status1", interval=1)
+        scheduler.addPoll(dev, "status2", interval=1) # staggered by 0.618 sec
+        self.clock.run(maxTime=9.5)
+        self.assertEqual(dev.sendTimes("status1"), dev.sendTimes("status2"))
+        self.assertEqual(scheduler.maxPollsPerTick, 2)
+        self.assertEqual(scheduler.numTicks, 10)
+        metrics = scheduler.getMetrics()
+        self.assertAlmostEqual(metrics["polls"]["dev status2"]["maxJitter"], 0.618, places=3)
+
+    def testAdaptive(self):
+        """Polls run slower once the device is idle, and faster while it is busy
+        """
+        scheduler = PollScheduler(busyFactor=0.25, idleFactor=4, idleTime=5)
+        dev = FakeDevice(self.clock, "dev")
+        scheduler.addPoll(dev, "status", interval=1)
+        self.clock.run(maxTime=12.5)
+        self.assertEqual(dev.sendTimes("status"), [0, 1, 2, 3, 4, 8, 12])
+        self.assertEqual(scheduler.getRegime(dev), scheduler.Idle)
+
+        # start a command that takes 2 seconds; the device is polled at once, then every 0.25 sec
+        dev.startCmd("move", cmdTime=2)
+        self.assertEqual(scheduler.getRegime(dev), scheduler.Busy)
+        self.clock.run(maxTime=14.4)
+        self.assertEqual(dev.sendTimes("status", 12.5), [12.5, 12.75, 13, 13.25, 13.5, 13.75, 14, 14.25])
+
+        # the command is done; polls run at their nominal interval until the device has been idle
+        # for idleTime since the last busy tick (14.25 sec)
+        self.clock.run(maxTime=30)
+        self.assertEqual(dev.sendTimes("status", 14.4), [15.25, 16.25, 17.25, 18.25, 22.25, 26.25])
+
+    def testNoteActivity(self):
+        """Activity only reschedules polls if it changes the device's regime
+        """
+        scheduler = PollScheduler(busyFactor=0.25, idleTime=100)
+        dev = FakeDevice(self.clock, "dev")
+        scheduler.addPoll(dev, "status", interval=1)
+        self.clock.run(maxTime=0.5)
+        self.assertEqual(scheduler.numTicks, 1)
+
+        # the first command makes the device busy, so the overdue poll runs on the next tick;
+        # more commands leave the regime unchanged and do not add ticks
+        for i in range(100):
+            dev.startCmd("move", cmdTime=0.1)
+        self.assertEqual(self.clock.run(maxTime=0.5), 1) # one tick; the commands finish later
+        self.assertEqual(scheduler.numTicks, 2)
+        self.assertEqual(dev.sendTimes("status"), [0, 0.5])
+
+        # commands that do not make the device busy do not add ticks
+        scheduler = PollScheduler(idleTime=100)
+        dev = FakeDevice(self.clock, "dev2")
+        scheduler.addPoll(dev, "status", interval=1, isBusyFunc=lambda dev: False)
+        startTime = self.clock.time()
+        for i in range(10):
+            self.clock.advance(0.5)
+            dev.startCmd("move")
+        self.assertEqual(scheduler.numTicks, 6) # at 0, 1, ... 5 sec
+        self.assertEqual(dev.sendTimes("status"), [startTime + i for i in range(6)])
+
+    def testSkip(self):
+        scheduler = PollScheduler(idleTime=100)
+        dev = FakeDevice(self.clock, "dev", cmdTime=1.5)
+        poll = scheduler.addPoll(dev, "status", interval=1)
+        self.clock.run(maxTime=4.5)
+        # each poll takes 1.5 sec, so every other poll is skipped
+        self.assertEqual(dev.sendTimes("status"), [0, 2, 4])
+        self.assertEqual((poll.numSent, poll.numSkipped), (3, 2))
+
+        dev.isConnected = False
+        dev.failCmds = True
+        self.clock.run(maxTime=10)
+        self.assertEqual(poll.numSent, 3)
+        self.assertEqual(poll.numFailed, 1) # the poll started at 4 sec
+
+    def testAddRemove(self):
+        scheduler = PollScheduler()
+        dev = FakeDevice(self.clock, "dev")
+        poll1 = scheduler.addPoll(dev, "status1", interval=1)
+        poll2 = scheduler.addPoll(dev, "status2", interval=1, name="fast")
+        self.assertEqual(dev.pollScheduler, scheduler)
+        self.assertEqual([poll.name for poll in scheduler.pollList], ["dev status1", "fast"])
+        self.assertRaises(RuntimeError, PollScheduler().addPoll, dev, "status3", interval=1)
+        self.assertRaises(RuntimeError, scheduler.addPoll, dev, "status3", interval=0)
+        scheduler.removePoll(poll1)
+        self.assertRaises(RuntimeError, scheduler.removePoll, poll1)
+        self.assertEqual(scheduler.pollList, [poll2])
+        scheduler.removePoll(poll2)
+        self.assertIsNone(dev.pollScheduler)
+        self.assertEqual(self.clock.numPending, 0)
+
+    def testBadArgs(self):
+        self.assertRaises(RuntimeError, PollScheduler, busyFactor=0)
+        self.assertRaises(RuntimeError, PollScheduler, busyFactor=2)
+        self.assertRaises(RuntimeError, PollScheduler, idleFactor=0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test ReplyRouter
+"""
+import re
+import unittest
+
+from twistedActor import ReplyRouter
+
+class TestReplyRouter(unittest.TestCase):
+    def setUp(self):
+        self.callList = []
+        self.router = ReplyRouter(fallbackFunc=self.record("fallback"))
+
+    def record(self, name):
+        """Return a handler that records its name and arguments in self.callList
+        """
+        def handler(*args):
+            self.callList.append((name,) + args)
+        return handler
+
+    def testPrefix(self):
+        self.router.addPrefix("ERR", self.record("err"))
+        self.router.addPrefix("ERROR:", self.record("error"))
+        self.router.addPrefix("OK", self.record("ok"))
+        for replyStr in ("OK", "ERROR: bad", "ERR 5", "ok", "other"):
+            self.router.dispatch(replyStr)
+        self.assertEqual(self.callList, [
+            ("ok", "OK"),
+            ("error", "ERROR: bad"),
+            ("err", "ERR 5"),
+            ("fallback", "ok"),
+            ("fallback", "other"),
+        ])
+        self.assertEqual(dict(self.router.hitCountDict), {"prefix:OK": 1, "prefix:ERROR:": 1, "prefix:ERR": 1})
+        self.assertEqual(self.router.numUnmatched, 2)
+        self.assertRaises(RuntimeError, self.router.addPrefix, "OK", self.record("ok2"))
+        self.assertRaises(RuntimeError, self.router.addPrefix, "", self.record("empty"))
+
+    def testKeyword(self):
+        self.router.addKeyword("Pos", self.record("pos"))
+        self.router.addKeyword("state", self.record("state"), name="stateKW")
+        self.assertTrue(self.router.dispatch("pos=1.0, 2.0; STATE = Moving; other=5"))
+        self.assertFalse(self.router.dispatch("other=5"))
+        self.assertEqual(self.callList, [
+            ("pos", "Pos", "1.0, 2.0", "pos=1.0, 2.0; STATE = Moving; other=5"),
+            ("state", "state", "Moving", "pos=1.0, 2.0; STATE = Moving; other=5"),
+            ("fallback", "other=5"),
+        ])
+        self.assertEqual(dict(self.router.hitCountDict), {"keyword:Pos": 1, "stateKW": 1})
+        self.assertRaises(RuntimeError, self.router.addKeyword, "POS", self.record("pos2"))
+
+    def testRegex(self):
+        self.router.addRegex(r"(\d+) done$", lambda match: self.callList.append(("done", match.group(1))))
+        self.router.addRegex(re.compile(r"T=(\d+)"), lambda match: self.callList.append(("temp", match.group(1))),
+            prefix="T=", name="temp")
+        self.router.addPrefix("T", self.record("t"))
+        for replyStr in ("12 done", "T=35", "T=x", "12 done!"):
+            self.router.dispatch(replyStr)
+        self.assertEqual(self.callList, [
+            ("done", "12"),
+            ("temp", "35"),
+            ("t", "T=x"), # regex for prefix T= did not match, so the shorter prefix T is used
+            ("fallback", "12 done!"),
+        ])
+        self.assertEqual(self.router.hitCountDict["temp"], 1)
+
+    def testOrder(self):
+        """Prefixes are tried before keywords, and keywords before regular expressions
+        """
+        self.router.addRegex(r".*", self.record("regex"))
+        self.router.addKeyword("a", self.record("keyword"))
+        self.router.addPrefix("a=1", self.record("prefix"))
+        for replyStr in ("a=1", "a=2", "b=2"):
+            self.router.dispatch(replyStr)
+        self.assertEqual([call[0] for call in self.callList], ["prefix", "keyword", "regex"])
+
+    def testHasHandlers(self):
+        router = ReplyRouter()
+        self.assertFalse(router.hasHandlers)
+        self.assertFalse(router.dispatch("anything"))
+        self.assertEqual(router.numUnmatched, 1)
+        router.addPrefix("x", self.record("x"))
+        self.assertTrue(router.hasHandlers)
+
+    def testManyPatterns(self):
+        """A device with many reply types: the router finds the same handler as a chain of regular expressions
+        """
+        numPatterns = 50
+        regexList = [(re.compile(r"REPLY%02d (.*)" % (i,)), self.record(i)) for i in range(numPatterns)]
+        def handleReplyChain(replyStr):
+            for regex, func in regexList:
+                match = regex.match(replyStr)
+                if match:
+                    func(match.group(1))
+                    return
+        router = ReplyRouter()
+        for i in range(numPatterns):
+            router.addPrefix("REPLY%02d " % (i,), lambda replyStr, i=i: self.callList.append((i, replyStr[8:])))
+        replyList = ["REPLY%02d %s" % (i % numPatterns, i) for i in range(1000)]
+
+        for replyStr in replyList:
+            handleReplyChain(replyStr)
+        chainCallList = self.callList
+        self.callList = []
+        for replyStr in replyList:
+            router.dispatch(replyStr)
+        self.assertEqual(self.callList, chainCallList)
+        self.assertEqual(sum(router.hitCountDict.itervalues()), len(replyList))
+        self.assertEqual(set(router.hitCountDict.itervalues()), set([len(replyList) // numPatterns]))
+        self.assertEqual(router.numUnmatched, 0)
+
+if __name__ == "__main__":
+    unittest.main()
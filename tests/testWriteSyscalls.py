@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+from __future__ import division, absolute_import
+"""Test socket writes per device command, for commands written in one reactor iteration or several
+
+TCPDevice writes each command with conn.writeLine; this counts how many send calls that costs.
+"""
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred
+
+import RO.Comm.Generic
+RO.Comm.Generic.setFramework("twisted")
+from RO.Comm.TCPConnection import TCPConnection
+from RO.Comm.TwistedSocket import TCPServer
+from RO.Comm.TwistedTimer import Timer
+
+class CountingSocket(object):
+    """Wrap a socket and count calls to send
+    """
+    def __init__(self, sock):
+        self._sock = sock
+        self.numSends = 0
+
+    def send(self, data):
+        self.numSends += 1
+        return self._sock.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+class TestWriteSyscalls(unittest.TestCase):
+    NumCmds = 500
+
+    def setUp(self):
+        self.receivedList = []
+        self.conn = None
+        self.counter = None
+        self.connDeferred = Deferred()
+        self.server = TCPServer(port=0, sockReadCallback=self.serverRead, stateCallback=self.serverState)
+        return self.connDeferred
+
+    def tearDown(self):
+        deferred = Deferred()
+        def checkClosed(*args):
+            if self.conn.isDisconnected and self.server.isDone and not deferred.called:
+                deferred.callback(None)
+        self.conn.addStateCallback(checkClosed)
+        self.server.addStateCallback(checkClosed)
+        self.conn.disconnect()
+        self.server.close()
+        checkClosed()
+        return deferred
+
+    def serverState(self, server):
+        if server.isReady and self.conn is None:
+            self.conn = TCPConnection(host="localhost", port=server.port, readLines=True,
+                stateCallback=self.connState)
+            self.conn.connect()
+
+    def connState(self, conn):
+        if conn.isConnected and not self.connDeferred.called:
+            transport = conn._sock._protocol.transport
+            self.counter = transport.socket = CountingSocket(transport.socket)
+            self.connDeferred.callback(None)
+
+    def serverRead(self, sock):
+        while True:
+            line = sock.readLine()
+            if line is None:
+                break
+            self.receivedList.append(line)
+
+    def waitForLines(self, numLines):
+        deferred = Deferred()
+        def check():
+            if len(self.receivedList) >= numLines:
+                deferred.callback(None)
+            else:
+                Timer(0.01, check)
+        check()
+        return deferred
+
+    def checkReceived(self):
+        """Check that the server received every command, in order
+        """
+        self.assertEqual(self.receivedList, ["%d status" % (i,) for i in range(self.NumCmds)])
+
+    def testOneIteration(self):
+        """Write all commands in one reactor iteration, as DeviceSet.startCmdDict does
+        """
+        for i in range(self.NumCmds):
+            self.conn.writeLine("%d status" % (i,))
+        def checkResults(result):
+            self.checkReceived()
+            self.assertLess(self.counter.numSends / self.NumCmds, 0.1)
+        return self.waitForLines(self.NumCmds).addCallback(checkResults)
+
+    def testManyIterations(self):
+        """Write one command per reactor iteration
+        """
+        def writeNext(i):
+            self.conn.writeLine("%d status" % (i,))
+            if i + 1 < self.NumCmds:
+                Timer(0, writeNext, i + 1)
+        writeNext(0)
+        def checkResults(result):
+            self.checkReceived()
+            self.assertLessEqual(self.counter.numSends, self.NumCmds)
+        return self.waitForLines(self.NumCmds).addCallback(checkResults)